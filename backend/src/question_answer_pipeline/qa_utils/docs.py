@@ -1,5 +1,4 @@
-from typing import List, Optional, Tuple, Dict, Callable, Any, Union
-from functools import reduce
+from typing import List, Optional, Tuple, Dict, Callable, Any, Union, Set
 import os
 import os
 from pathlib import Path
@@ -12,15 +11,25 @@ from .qaprompts import (
     citation_prompt,
     make_chain,
 )
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 from .readers import read_doc
+from .summarizer import get_summary_executor
+from .lexical import lexical_prefilter
+from .mmr import maximal_marginal_relevance, normalize_rows
+from .indexes import (IndexSpec, build_index, trained_index_file, apply_search_params, restricted_search_params,
+                      rescore)
 from langchain.vectorstores import FAISS
-from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.chat_models import ChatOpenAI
 from langchain.llms.base import LLM
 from langchain.callbacks import get_openai_callback
 from langchain.cache import SQLiteCache
+from langchain.docstore.document import Document
 import langchain
+import threading
+import uuid
+import numpy as np
 from datetime import datetime
 
 CACHE_PATH = Path.home() / ".paperqa" / "llm_cache.db"
@@ -42,6 +51,8 @@ class Answer:
     tokens: int = 0
     question_embedding: List[float] = None
     from_embed: bool = False
+    summary_stats: Dict[str, float] = None  # queue wait / call time of the chunk summaries
+    skipped_summaries: int = 0  # chunks dropped by the lexical pre-filter (LLM calls saved)
 
     def __post_init__(self):
         """Initialize the answer."""
@@ -55,6 +66,19 @@ class Answer:
         return self.formatted_answer
 
 
+class NoEmbeddings(Embeddings):
+    """
+    Default embedding model of Docs: documents are added with their stored vectors and searched with question
+    embeddings, so nothing is embedded implicitly. Pass e.g. embedding=OpenAIEmbeddings() to Docs to allow it.
+    """
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise ValueError("Docs has no embedding model, add documents with their embeddings or pass embedding=")
+
+    def embed_query(self, text: str) -> List[float]:
+        raise ValueError("Docs has no embedding model, search with a question embedding or pass embedding=")
+
+
 class Docs:
     """A collection of documents to be used for answering questions."""
 
@@ -65,6 +89,10 @@ class Docs:
             summary_llm: Optional[Union[LLM, str]] = None,
             name: str = "default",
             index_path: Optional[Path] = None,
+            embedding: Optional[Embeddings] = None,
+            index_spec: Optional[IndexSpec] = None,
+            trained_index_path: Optional[Path] = None,
+            full_vectors: Optional[Callable[[str], Any]] = None,
     ) -> None:
         """Initialize the collection of documents.
 
@@ -76,11 +104,30 @@ class Docs:
             summary_llm: The language model to use for summarizing documents. If None, llm is used.
             name: The name of the collection.
             index_path: The path to the index file IF pickled. If None, defaults to using name in $HOME/.paperqa/name
+            embedding: The model used to embed texts added without embeddings and questions searched without one.
+                If None, nothing is embedded and both raise an error.
+            index_spec: The faiss index to build (flat, IVF or HNSW, optionally compressed). If None, a flat index.
+                Searches restricted to unique_ids scan those rows exactly up to index_spec.exact_rows of them.
+                An index that needs training is searched as a flat one until index_spec.training_size vectors
+                were added, then trained on all of them.
+            trained_index_path: Directory where trained indexes are kept so they are trained only once.
+            full_vectors: Returns the full precision embeddings of a document's chunks by unique_id, e.g.
+                EmbeddingStore.get_embeddings. When the index_spec codec compresses the index, searches score
+                (and with index_spec.rescore re-score) chunks with these instead of the compressed vectors.
         """
         self.docs = dict()  # self.docs[path] = dict(texts=texts, metadata=metadata, key=key)
         self.chunk_size_limit = chunk_size_limit
         self.keys = set()
         self._faiss_index = None
+        self._rows_by_id = dict()  # self._rows_by_id[unique_id] = faiss rows of that document's chunks
+        self._row_ids = []  # self._row_ids[row] = unique_id of the document of that faiss row
+        self._lock = threading.RLock()  # docs can be shared between requests and updated from worker threads
+        self.embedding = embedding if embedding is not None else NoEmbeddings()
+        self.index_spec = index_spec if index_spec is not None else IndexSpec()
+        self.trained_index_path = trained_index_path
+        self._training_deferred = False  # a flat index stands in until index_spec has enough vectors to train on
+        self._built_spec = None  # what the faiss index was built as, index_spec unless there was too little to train on
+        self.full_vectors = full_vectors
         self.update_llm(llm, summary_llm)
         if index_path is None:
             index_path = Path.home() / ".paperqa" / name
@@ -167,7 +214,7 @@ class Docs:
 
         self.docs[path] = dict(texts=texts, metadata=metadata, key=key)
         if self._faiss_index is not None:
-            self._faiss_index.add_texts(texts, metadatas=metadata)
+            self._add_vectors(texts, self.embedding.embed_documents(texts), metadata)
 
     def add_from_embeddings(
             self,
@@ -179,12 +226,35 @@ class Docs:
     ) -> None:
 
         """Add a document to the collection."""
+        self.add_many_from_embeddings([(path, texts, text_embeddings, metadatas)])
 
-        # first check to see if we already have this document
-        # this way we don't make api call to create citation on file we already have
-        if path in self.docs:
-            raise ValueError(f"Document {path} already in collection.")
+    def add_many_from_embeddings(self, documents: List[Tuple[str, List[str], Any, List[dict]]]) -> None:
+        """Add documents with their embeddings to the collection, with a single bulk add to the index.
 
+        Args:
+            documents: (path, texts, text_embeddings, metadatas) per document, text_embeddings being a
+                (len(texts), dim) array or list of vectors.
+        """
+        with self._lock:
+            # first check to see if we already have these documents
+            for path, _, _, _ in documents:
+                if path in self.docs:
+                    raise ValueError(f"Document {path} already in collection.")
+
+            documents = [document for document in documents if len(document[1]) > 0]
+            for path, texts, _, metadatas in documents:
+                self._register(path, texts, metadatas)
+            if not documents:
+                return
+
+            # one contiguous float32 array for the whole batch
+            vectors = np.concatenate([np.asarray(embeddings, dtype=np.float32) for _, _, embeddings, _ in documents])
+            self._add_vectors([text for _, texts, _, _ in documents for text in texts],
+                              vectors,
+                              [metadata for _, _, _, metadatas in documents for metadata in metadatas])
+
+    def _register(self, path, texts, metadatas) -> None:
+        """Give the document a unique key and record it in self.docs"""
         key = metadatas[0]['dockey']
 
         suffix = ""
@@ -203,20 +273,67 @@ class Docs:
 
         self.docs[path] = dict(texts=texts, metadata=metadatas, key=key)
 
-        if self._faiss_index is not None:
-            self._faiss_index.add_embeddings([*zip(texts, text_embeddings)],
-                                             metadatas=metadatas)
+    def _add_vectors(self, texts, vectors, metadatas) -> None:
+        """Add texts and their embeddings to the faiss index (created on first use) with one index.add"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self._faiss_index is None:
+            # instantiate FAISS
+            self._faiss_index = FAISS(self.embedding.embed_query, self._new_index(vectors), InMemoryDocstore({}), {})
+        elif self._training_deferred and self._faiss_index.index.ntotal + len(vectors) >= self.index_spec.training_size:
+            self._train_index(vectors)
+
+        start = len(self._faiss_index.index_to_docstore_id)
+        ids = [str(uuid.uuid4()) for _ in texts]
+        self._faiss_index.index.add(vectors)
+        self._faiss_index.docstore.add({_id: Document(page_content=text, metadata=metadata)
+                                        for _id, text, metadata in zip(ids, texts, metadatas)})
+        self._faiss_index.index_to_docstore_id.update(enumerate(ids, start))
+        self._track_rows(metadatas, start=start)
+
+    def _new_index(self, vectors):
+        """
+        Empty index of index_spec, trained on a sample of the first vectors. If they are too few to train it on
+        (and no trained index is kept in trained_index_path), a flat index until _train_index replaces it.
+        """
+        needed = self.index_spec.training_size
+        self._training_deferred = len(vectors) < needed and (
+                self.trained_index_path is None
+                or not os.path.exists(trained_index_file(self.index_spec, vectors.shape[1], self.trained_index_path)))
+        if self._training_deferred:
+            print(f'Only {len(vectors)} vectors, searching a flat index until there are {needed} to train '
+                  f'{self.index_spec.factory_string()} on')
+            index, self._built_spec = build_index(IndexSpec(), vectors)
         else:
-            """Instantiate FAISS"""
-            self._faiss_index = FAISS.from_embeddings([*zip(texts, text_embeddings)],
-                                                      metadatas=metadatas,
-                                                      embedding=OpenAIEmbeddings())
+            index, self._built_spec = build_index(self.index_spec, vectors, self.trained_index_path)
+        return index
+
+    def _train_index(self, vectors):
+        """
+        Replace the flat index by one of index_spec trained on the vectors it holds and the ones about to be added
+        (which the caller adds). Rows keep their order, so the docstore ids, _rows_by_id and _row_ids stay valid.
+        """
+        flat = self._faiss_index.index
+        held = flat.reconstruct_n(0, flat.ntotal)
+        index, built_spec = build_index(self.index_spec, np.concatenate([held, vectors]), self.trained_index_path)
+        index.add(held)
+        self._faiss_index.index, self._built_spec = index, built_spec
+        self._training_deferred = False
+
+    def _track_rows(self, metadatas, start):
+        """Record which faiss rows belong to which document, rows are assigned in insertion order."""
+        for row, metadata in enumerate(metadatas, start):
+            self._rows_by_id.setdefault(metadata.get('unique_id'), []).append(row)
+            self._row_ids.append(metadata.get('unique_id'))
 
     def clear(self) -> None:
         """Clear the collection of documents."""
         self.docs = dict()
         self.keys = set()
         self._faiss_index = None
+        self._rows_by_id = dict()
+        self._row_ids = []
+        self._training_deferred = False
+        self._built_spec = None
         # delete index file
         pkl = self.index_path / "index.pkl"
         if pkl.exists():
@@ -245,6 +362,9 @@ class Docs:
         if self._faiss_index is not None:
             state["_faiss_index"].save_local(self.index_path)
         del state["_faiss_index"]
+        del state["_lock"]
+        # e.g. a bound EmbeddingStore method, set it again after loading
+        del state["full_vectors"]
         # remove LLMs (they can have callbacks, which can't be pickled)
         del state["summary_chain"]
         del state["qa_chain"]
@@ -254,8 +374,25 @@ class Docs:
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self.full_vectors = None
+        if "embedding" not in state:
+            self.embedding = NoEmbeddings()
+        if "index_spec" not in state:
+            self.index_spec = IndexSpec()
+            self.trained_index_path = None
+        if "_training_deferred" not in state:
+            self._training_deferred = False
+        if "_built_spec" not in state:
+            self._built_spec = self.index_spec
+        if "_row_ids" not in state:
+            self._row_ids = [None] * sum(len(rows) for rows in self._rows_by_id.values())
+            for unique_id, rows in self._rows_by_id.items():
+                for row in rows:
+                    self._row_ids[row] = unique_id
         try:
-            self._faiss_index = FAISS.load_local(self.index_path, OpenAIEmbeddings())
+            self._faiss_index = FAISS.load_local(self.index_path, self.embedding)
+            apply_search_params(self._faiss_index.index, self.index_spec)
         except:
             # they use some special exception type, but I don't want to import it
             self._faiss_index = None
@@ -263,15 +400,12 @@ class Docs:
 
     def _build_faiss_index(self):
         if self._faiss_index is None:
-            texts = reduce(
-                lambda x, y: x + y, [doc["texts"] for doc in self.docs.values()], []
-            )
-            metadatas = reduce(
-                lambda x, y: x + y, [doc["metadata"] for doc in self.docs.values()], []
-            )
-            self._faiss_index = FAISS.from_texts(
-                texts, OpenAIEmbeddings(), metadatas=metadatas
-            )
+            texts = [text for doc in self.docs.values() for text in doc["texts"]]
+            metadatas = [metadata for doc in self.docs.values() for metadata in doc["metadata"]]
+            self._rows_by_id = dict()
+            self._row_ids = []
+            if texts:
+                self._add_vectors(texts, self.embedding.embed_documents(texts), metadatas)
 
     async def get_evidence(
             self,
@@ -280,9 +414,16 @@ class Docs:
             max_sources: int = 5,
             marginal_relevance: bool = True,
             key_filter: Optional[List[str]] = None,
+            unique_ids: Optional[Set[str]] = None,
+            prefilter_threshold: Optional[float] = None,
+            early_exit: bool = False,
+            keep_rank_order: bool = True,
+            on_evidence: Optional[Callable[[Document, str], None]] = None,
     ) -> str:
+        # the index lock is held by writers in worker threads (bulk adds, index training), so searching is done off
+        # the event loop instead of stalling every request behind an ingest
         if self._faiss_index is None:
-            self._build_faiss_index()
+            await asyncio.to_thread(self._build_faiss_index)
 
         # perform vectorsearch
         _k = k
@@ -290,31 +431,64 @@ class Docs:
         if key_filter is not None:
             _k = k * 10  # heuristic
 
-        docs = self.vector_search(answer, _k, marginal_relevance=marginal_relevance)
+        docs = await asyncio.to_thread(self.vector_search, answer, _k, marginal_relevance=marginal_relevance,
+                                       unique_ids=unique_ids)
+
+        if prefilter_threshold is not None:
+            # cheap local relevance check, chunks without question terms mostly come back "Not applicable"
+            docs, answer.skipped_summaries = lexical_prefilter(docs, answer.question, prefilter_threshold,
+                                                               min_keep=max_sources)
+            print(f'Lexical pre-filter skipped {answer.skipped_summaries} summaries')
+        # indices of the docs whose summaries are used, and the papers they come from
+        accepted = []
+        sources = set()
+
+        def accept(i, summary):
+            """keep the summary of docs[i] if it is relevant, True once max_sources papers are covered"""
+            doc = docs[i]
+            if key_filter is not None and doc.metadata["dockey"] not in key_filter:
+                return False
+            if "Not applicable" not in summary:
+                accepted.append(i)
+                sources.add(doc.metadata['unique_id'])
+            return len(sources) == max_sources
+
+        def on_summary(i, summary):
+            """called as each summary completes, relevant ones are reported to on_evidence right away"""
+            if on_evidence is not None and "Not applicable" not in summary:
+                on_evidence(docs[i], summary)
+            return early_exit and accept(i, summary)
+
         # get summaries
         print(f'OpenAI summarization started at {datetime.now().time().strftime("%X")}')
         print(f'Summarizing {len(docs)} docs.')
-        llm_summaries = await async_get_summaries(docs, answer.question)
+        if early_exit or on_evidence is not None:
+            # take summaries as they complete (and with early_exit, cancel the rest once there is enough evidence)
+            llm_summaries, answer.summary_stats = await async_get_summaries(docs, answer.question,
+                                                                            accept=on_summary)
+        else:
+            llm_summaries, answer.summary_stats = await async_get_summaries(docs, answer.question)
+
+        if early_exit:
+            if keep_rank_order:
+                accepted.sort()
+        else:
+            for i in range(len(docs)):
+                if accept(i, llm_summaries[i]):
+                    break
         print(f'OpenAI summarization finished at {datetime.now().time().strftime("%X")}')
+        print(f'Summarization stats: {answer.summary_stats}')
 
         # Grab the information from the nearest neigbors metadata
-        for i, doc in enumerate(docs):
-            if key_filter is not None and doc.metadata["dockey"] not in key_filter:
-                continue
-
-            c = (
+        for i in accepted:
+            doc = docs[i]
+            answer.contexts[doc.metadata['unique_id']] = (
                 doc.metadata["key"],
                 doc.metadata["citation"],
                 llm_summaries[i],
                 doc.page_content
             )
 
-            if "Not applicable" not in c[2]:
-                answer.contexts[doc.metadata['unique_id']] = c
-
-            if len(answer.contexts) == max_sources:
-                break
-
         # Create context_str which has relevant sources and their citation
         # will be fed into LLM for final answer
         context_str = "\n\n".join(
@@ -335,7 +509,12 @@ class Docs:
             length_prompt: str = "about 100 words",
             marginal_relevance: bool = True,
             embedding: Optional[List[float]] = None,
-            vector_search_only: bool = False
+            vector_search_only: bool = False,
+            unique_ids: Optional[Set[str]] = None,
+            prefilter_threshold: Optional[float] = None,
+            early_exit: bool = False,
+            keep_rank_order: bool = True,
+            on_evidence: Optional[Callable[[Document, str], None]] = None,
     ):
 
         if k < max_sources:
@@ -353,6 +532,11 @@ class Docs:
                 k=k,
                 max_sources=max_sources,
                 marginal_relevance=marginal_relevance,
+                unique_ids=unique_ids,
+                prefilter_threshold=prefilter_threshold,
+                early_exit=early_exit,
+                keep_rank_order=keep_rank_order,
+                on_evidence=on_evidence,
             )
             tokens += cb.total_tokens
 
@@ -369,7 +553,7 @@ class Docs:
             answer.formatted_answer = formatted_answer  # polished answer
         elif not vector_search_only:
             with get_openai_callback() as cb:
-                answer_text = self.qa_chain.run(
+                answer_text = await self.qa_chain.arun(
                     question=query, context_str=context_str, length=length_prompt
                 )
                 tokens += cb.total_tokens
@@ -400,43 +584,152 @@ class Docs:
 
         return answer
 
-    def vector_search(self, answer, _k, marginal_relevance=True):
-        # want to work through indices but less k
-        if marginal_relevance:
-            if not answer.from_embed:
-                docs = self._faiss_index.max_marginal_relevance_search(
-                    answer.question, k=_k, fetch_k=5 * _k
-                )
-            else:
-                docs = self._faiss_index.max_marginal_relevance_search_by_vector(
-                    answer.question_embedding, k=_k, fetch_k=5 * _k
-                )
+    def vector_search(self, answer, _k, marginal_relevance=True, unique_ids=None):
+        """
+        unique_ids: restrict the search to chunks of these documents (metadata['unique_id']). Lets one
+            long-lived Docs serve every request instead of building an index per request. Restricted searches
+            only go through the faiss index when they cover many rows (see _filtered_vector_search).
+        """
+        if unique_ids is not None:
+            return self._filtered_vector_search(answer, _k, unique_ids, marginal_relevance=marginal_relevance)
+
+        with self._lock:
+            embedding = self._question_embedding(answer)
+            # want to work through indices but less k
+            if marginal_relevance:
+                return self._mmr_search(embedding, _k, fetch_k=5 * _k)
+            indices, _ = self._nearest(embedding, _k)
+            return self._rows_to_documents(indices)
+
+    def _question_embedding(self, answer):
+        if answer.from_embed:
+            return np.array([answer.question_embedding], dtype=np.float32)
+        return np.array([self._faiss_index.embedding_function(answer.question)], dtype=np.float32)
+
+    def _mmr_search(self, embedding, _k, fetch_k):
+        """
+        fetch_k nearest chunks, then the _k of them picked by (numpy) maximal marginal relevance.
+        Caller holds self._lock.
+        """
+        indices, embeddings = self._nearest(embedding, fetch_k)
+        if len(indices) == 0:
+            return []
+        return self._mmr_select(embedding, indices, embeddings, _k)
+
+    def _nearest(self, embedding, k, rows=None):
+        """
+        Rows of the k nearest chunks in the index (among rows if given), nearest first, and their embeddings.
+        Caller holds self._lock.
+        """
+        rescoring = self.index_spec.rescore > 0 and self._full_precision
+        fetch_k = k * self.index_spec.rescore if rescoring else k
+        if rows is None:
+            _, indices = self._faiss_index.index.search(embedding, fetch_k)
         else:
-            docs = self._faiss_index.similarity_search(
-                answer.question, k=_k, fetch_k=5 * _k
-            )
+            # params only point to the selector, which has to live until the search is done
+            params, selector = restricted_search_params(self._built_spec, rows)
+            _, indices = self._faiss_index.index.search(embedding, fetch_k, params=params)
+        indices = indices[0][indices[0] != -1]
+        if len(indices) == 0:
+            return indices, np.empty((0, self._faiss_index.index.d), dtype=np.float32)
+        embeddings = self._embeddings(indices)
+        if rescoring:
+            # distances of a compressed index are approximate, keep the nearest by exact distance
+            indices, embeddings = rescore(embedding, indices, embeddings, k)
+        return indices, embeddings
 
-        return docs
+    @property
+    def _full_precision(self):
+        """the index is compressed and full precision vectors can be read instead"""
+        return self.index_spec.compressed and self.full_vectors is not None
+
+    def _embeddings(self, rows):
+        """Embeddings of faiss rows, full precision if possible. Caller holds self._lock."""
+        if not self._full_precision:
+            return self._faiss_index.index.reconstruct_batch(rows)
+        rows = np.asarray(rows, dtype=np.int64)
+        embeddings = np.empty((len(rows), self._faiss_index.index.d), dtype=np.float32)
+        positions_by_id = dict()
+        for i, row in enumerate(rows):
+            positions_by_id.setdefault(self._row_ids[row], []).append(i)
+        # one read per document: its chunks are added together, so they are consecutive rows in chunk order
+        for unique_id, positions in positions_by_id.items():
+            positions = np.array(positions)
+            embeddings[positions] = self.full_vectors(unique_id)[rows[positions] - self._rows_by_id[unique_id][0]]
+        return embeddings
+
+    def index_stats(self) -> Dict[str, Any]:
+        """
+        Index type as built (a flat one while training is deferred) and the memory its vectors take, compared to
+        storing them as float32. Doesn't take the lock, so it answers during a bulk add or training, with the
+        counts of the moment.
+        """
+        faiss_index, built_spec = self._faiss_index, self._built_spec
+        if faiss_index is None or built_spec is None:
+            return dict(spec=None, requested_spec=asdict(self.index_spec), vectors=0)
+        n, dim = faiss_index.index.ntotal, faiss_index.index.d
+        vector_bytes = n * built_spec.bytes_per_vector(dim)
+        return dict(spec=asdict(built_spec),
+                    requested_spec=asdict(self.index_spec),
+                    training_deferred=self._training_deferred,
+                    vectors=n,
+                    vector_bytes=vector_bytes,
+                    float32_bytes=4 * n * dim,
+                    memory_saved=round(1 - vector_bytes / (4 * n * dim), 4) if n else 0.0)
+
+    def _mmr_select(self, embedding, indices, embeddings, _k):
+        selected = maximal_marginal_relevance(normalize_rows(embedding), normalize_rows(embeddings), k=_k,
+                                              normalized=True)
+        return self._rows_to_documents(indices[selected])
+
+    def _rows_to_documents(self, rows):
+        return [self._faiss_index.docstore.search(self._faiss_index.index_to_docstore_id[int(row)]) for row in rows]
+
+    def _filtered_vector_search(self, answer, _k, unique_ids, marginal_relevance=True):
+        """
+        Search over the rows of the requested documents. More than index_spec.exact_rows rows are searched in an
+        ivf / hnsw index restricted to them. Fewer are scanned exactly: scoring a few papers directly is cheaper than
+        probing the index, and a restrictive filter makes the index miss rows (IVF probes clusters without them,
+        HNSW walks a graph of mostly excluded nodes). The scan is also the fallback when the index finds too few.
+        """
+        embedding = self._question_embedding(answer)
+
+        with self._lock:
+            rows = np.array([row for uid in unique_ids for row in self._rows_by_id.get(uid, [])], dtype=np.int64)
+            if len(rows) == 0:
+                return []
+            fetch_k = 5 * _k if marginal_relevance else _k
+            nearest = None
+            if len(rows) > self.index_spec.exact_rows and self._built_spec.kind != 'flat':
+                nearest, embeddings = self._nearest(embedding, fetch_k, rows=rows)
+                if len(nearest) < min(fetch_k, len(rows)):
+                    nearest = None
+            if nearest is None:
+                embeddings = self._embeddings(rows)
+                distances = ((embeddings - embedding) ** 2).sum(axis=1)
+                order = np.argsort(distances, kind='stable')[:fetch_k]
+                nearest, embeddings = rows[order], embeddings[order]
+            if marginal_relevance:
+                return self._mmr_select(embedding, nearest, embeddings, _k)
+            return self._rows_to_documents(nearest)
 
 
 import asyncio
 
 
 async def async_openAI_call(doc, question, n):
-    llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
-    summary_chain = make_chain(prompt=summary_prompt, llm=llm)
-    summary = await summary_chain.arun(
-        question=question,
-        context_str=doc.page_content,
-        citation=doc.metadata["citation"],
-    )
+    summary, _ = await get_summary_executor().summarize(doc, question)
 
     return summary
 
 
-async def async_get_summaries(docs, question):
-    coroutines = [async_openAI_call(doc, question, i) for i, doc in enumerate(docs)]
-
-    summaries = await asyncio.gather(*coroutines)
-
-    return summaries
+async def async_get_summaries(docs, question, accept=None):
+    """
+    Summaries for every doc, through the shared, rate limit aware summary executor.
+    If accept is given, summaries are handed to accept(index, summary) as they complete and the remaining calls
+    are cancelled once it returns True (their summaries are None).
+    :return: summaries, dict with queue wait / call time statistics
+    """
+    if accept is None:
+        return await get_summary_executor().summarize_all(docs, question)
+    return await get_summary_executor().summarize_until(docs, question, accept)
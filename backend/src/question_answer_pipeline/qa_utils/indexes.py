@@ -0,0 +1,303 @@
+import os
+import time
+from dataclasses import dataclass, asdict, replace
+import numpy as np
+
+INDEX_KINDS = ('flat', 'ivf', 'hnsw')
+# how vectors are stored in the index: 4, 2 or 1 bytes per dimension, or pq_m bytes per vector
+CODECS = ('float32', 'float16', 'int8', 'pq')
+# product quantization needs one training point per centroid (8 bits per sub-vector)
+PQ_MIN_TRAINING = 256
+
+
+@dataclass
+class IndexSpec:
+    """
+    Which faiss index Docs builds. All kinds use L2 distance, like the flat index they replace.
+    Searches restricted to some documents (Docs unique_ids) go through an ivf / hnsw index with an IDSelector when
+    they cover more than exact_rows rows. Fewer rows are scanned exactly, which is cheaper than probing the index and
+    can't miss rows in clusters or graph regions the search didn't visit.
+
+    flat: exact search.
+    ivf:  IndexIVFFlat with nlist clusters, nprobe clusters searched per query. Trained on a sample of at most
+          train_size vectors, Docs waits for training_size of them.
+    hnsw: IndexHNSWFlat with m neighbours per node, ef_construction / ef_search candidate list sizes.
+
+    codec compresses the stored vectors of any kind: float16, int8 (scalar quantization, trained per dimension
+    ranges) or pq (pq_m sub-vectors of 8 bits each, dim must be divisible by pq_m). With rescore > 0 Docs fetches
+    rescore times as many candidates and re-scores them with full precision vectors, when it has a source for them.
+    """
+    kind: str = 'flat'
+    nlist: int = 1024
+    nprobe: int = 16
+    m: int = 32
+    ef_construction: int = 40
+    ef_search: int = 64
+    train_size: int = 100000
+    codec: str = 'float32'
+    pq_m: int = 64
+    rescore: int = 0
+    exact_rows: int = 1000
+
+    def __post_init__(self):
+        if self.kind not in INDEX_KINDS:
+            raise ValueError(f'Unknown index kind {self.kind}, expected one of {INDEX_KINDS}')
+        if self.codec not in CODECS:
+            raise ValueError(f'Unknown codec {self.codec}, expected one of {CODECS}')
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        From a string as used in env vars: the kind followed by optional fields,
+        e.g. 'flat', 'ivf,nlist=1024,nprobe=16', 'hnsw,m=32,ef_search=128', 'flat,codec=pq,pq_m=96,rescore=4'
+        """
+        kind, *fields = [part.strip() for part in spec.split(',') if part.strip()]
+        kwargs = {}
+        for field in fields:
+            name, _, value = field.partition('=')
+            if name not in cls.__dataclass_fields__ or name == 'kind':
+                raise ValueError(f'Unknown index field {name} in {spec}')
+            kwargs[name] = cls.__dataclass_fields__[name].type(value)
+        return cls(kind=kind.lower(), **kwargs)
+
+    @property
+    def compressed(self):
+        return self.codec != 'float32'
+
+    @property
+    def training_size(self):
+        """vectors needed to train the index as specified, fewer get fewer IVF clusters or int8 instead of pq"""
+        needed = 0
+        if self.kind == 'ivf':
+            needed = 39 * self.nlist
+        if self.codec == 'pq':
+            needed = max(needed, PQ_MIN_TRAINING)
+        # at most train_size vectors are sampled, so more never help
+        return min(needed, self.train_size)
+
+    def bytes_per_vector(self, dim):
+        """memory of one stored vector (without the IVF lists / HNSW graph around it)"""
+        return {'float32': 4 * dim, 'float16': 2 * dim, 'int8': dim, 'pq': self.pq_m}[self.codec]
+
+    def factory_string(self):
+        """faiss.index_factory description, e.g. 'IVF1024,SQ8'"""
+        # np: no polysemous training, which only serves hamming pre-filtering and takes minutes
+        codec = {'float32': 'Flat', 'float16': 'SQfp16', 'int8': 'SQ8', 'pq': f'PQ{self.pq_m}np'}[self.codec]
+        if self.kind == 'ivf':
+            return f'IVF{self.nlist},{codec}'
+        if self.kind == 'hnsw':
+            return f'HNSW{self.m},{codec}'
+        return codec
+
+    def name(self, dim):
+        """identifies the trained index, e.g. IVF1024_SQ8_d768"""
+        return f"{self.factory_string().replace(',', '_')}_d{dim}"
+
+
+def apply_search_params(index, spec):
+    """set the query time parameters of the spec (they can be changed without rebuilding the index)"""
+    import faiss
+
+    if spec.kind == 'ivf':
+        faiss.extract_index_ivf(index).nprobe = spec.nprobe
+    elif spec.kind == 'hnsw':
+        index.hnsw.efSearch = spec.ef_search
+    return index
+
+
+def restricted_search_params(spec, rows):
+    """
+    query time parameters of an ivf / hnsw index of the spec that only return the given rows
+
+    :return: the parameters, the IDSelector they point to (keep a reference to it while searching)
+    """
+    import faiss
+
+    selector = faiss.IDSelectorBatch(np.asarray(rows, dtype=np.int64))
+    if spec.kind == 'ivf':
+        return faiss.SearchParametersIVF(sel=selector, nprobe=spec.nprobe), selector
+    if spec.kind == 'hnsw':
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=spec.ef_search), selector
+    raise ValueError(f'{spec.kind} indexes are searched exactly, not through search parameters')
+
+
+def sample_rows(vectors, size, seed=0):
+    """random sample of at most size rows, in row order"""
+    if len(vectors) <= size:
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+    rows = np.sort(np.random.default_rng(seed).choice(len(vectors), size, replace=False))
+    return np.ascontiguousarray(vectors[rows], dtype=np.float32)
+
+
+def trained_index_file(spec, dim, trained_path):
+    """where build_index keeps the trained index of the spec"""
+    return os.path.join(trained_path, spec.name(dim) + '.faiss')
+
+
+def build_index(spec, vectors, trained_path=None):
+    """
+    Empty index of the spec for vectors of this dim, trained on a sample of vectors if the kind or codec needs it.
+
+    :param spec: IndexSpec
+    :param vectors: (n, dim) vectors the index will hold (or a representative sample of them)
+    :param trained_path: directory to keep trained indexes in. A trained index of the same name is loaded from
+        there instead of training again, a newly trained one is written there.
+    :return: faiss index, the spec it was built as (fewer IVF clusters or int8 instead of pq when there are too
+        few vectors to train the spec on)
+    """
+    import faiss
+
+    dim = vectors.shape[1]
+    if spec.codec == 'pq' and dim % spec.pq_m:
+        raise ValueError(f'pq_m={spec.pq_m} does not divide the embedding dim {dim}')
+
+    path = None
+    if trained_path is not None:
+        path = trained_index_file(spec, dim, trained_path)
+        if os.path.exists(path):
+            index = faiss.read_index(path)
+            if index.ntotal == 0:
+                return apply_search_params(index, spec), spec
+            print(f'Ignoring trained index {path}, it is not empty')
+
+    sample = sample_rows(vectors, spec.train_size)
+    # only an index trained as specified is kept for reuse
+    persist = path is not None
+    if spec.kind == 'ivf':
+        # faiss wants ~39 training points per cluster, fewer clusters beat badly trained ones on a small corpus
+        nlist = max(1, min(spec.nlist, len(sample) // 39))
+        if nlist < spec.nlist:
+            print(f'Only {len(sample)} vectors to train on, using nlist={nlist} instead of {spec.nlist}')
+            spec = replace(spec, nlist=nlist)
+            persist = False
+    if spec.codec == 'pq' and len(sample) < PQ_MIN_TRAINING:
+        print(f'Only {len(sample)} vectors to train on, storing int8 instead of pq')
+        spec = replace(spec, codec='int8')
+        persist = False
+
+    index = faiss.index_factory(dim, spec.factory_string(), faiss.METRIC_L2)
+    if spec.kind == 'hnsw':
+        index.hnsw.efConstruction = spec.ef_construction
+    if index.is_trained:
+        return apply_search_params(index, spec), spec
+
+    start = time.perf_counter()
+    index.train(sample)
+    if spec.kind == 'ivf':
+        # rows are reconstructed for marginal relevance
+        faiss.extract_index_ivf(index).make_direct_map()
+    print(f'Trained {spec.name(dim)} on {len(sample)} vectors in {time.perf_counter() - start:.1f}s')
+
+    if persist:
+        os.makedirs(trained_path, exist_ok=True)
+        faiss.write_index(index, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    return apply_search_params(index, spec), spec
+
+
+def index_bytes(index):
+    """size of the serialized index, close to the memory it takes (vectors / codes, centroids, graph)"""
+    import faiss
+
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def rescore(query, rows, vectors, k):
+    """
+    :param query: (dim,) or (1, dim)
+    :param rows: candidate rows of an approximate search
+    :param vectors: full precision vectors of the rows
+    :return: the k rows nearest to query by exact L2 distance, their vectors
+    """
+    distances = ((np.asarray(vectors, dtype=np.float32) - np.asarray(query, dtype=np.float32).reshape(1, -1)) ** 2)
+    nearest = np.argsort(distances.sum(axis=1), kind='stable')[:k]
+    return np.asarray(rows)[nearest], np.asarray(vectors)[nearest]
+
+
+def compare_to_flat(spec, vectors, queries, k=25):
+    """
+    Recall, latency and memory of the spec's index against exact search. With spec.rescore the index returns
+    rescore * k candidates that are re-scored with the full precision vectors, as Docs does.
+
+    :param vectors: (n, dim) indexed vectors
+    :param queries: (q, dim) query vectors
+    :param k: neighbours retrieved per query
+    :return: dict(spec, k, recall=fraction of the exact top k found, build_seconds, flat_ms / index_ms=per query
+        latency, speedup, flat_bytes / index_bytes=index size, memory_saved=fraction of flat_bytes saved)
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+
+    start = time.perf_counter()
+    index, _ = build_index(spec, vectors)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - start
+
+    def timed_search(searched, fetch_k=k, rescored=False):
+        # one query at a time, as the server searches (batches would hide the per query cost in BLAS)
+        start = time.perf_counter()
+        results = []
+        for query in queries:
+            rows = searched.search(query[None], fetch_k)[1][0]
+            if rescored:
+                rows = rows[rows != -1]
+                rows, _ = rescore(query, rows, vectors[rows], k)
+                rows = np.pad(rows, (0, k - len(rows)), constant_values=-1)
+            results.append(rows)
+        return np.array(results), 1000 * (time.perf_counter() - start) / len(queries)
+
+    exact, flat_ms = timed_search(flat)
+    approximate, index_ms = timed_search(index, k * max(1, spec.rescore), rescored=spec.rescore > 0)
+    flat_bytes, compressed_bytes = index_bytes(flat), index_bytes(index)
+
+    found = sum(len(np.intersect1d(e[e != -1], a[a != -1])) for e, a in zip(exact, approximate))
+    return dict(spec=asdict(spec),
+                k=k,
+                recall=round(found / (exact != -1).sum(), 4),
+                build_seconds=round(build_seconds, 3),
+                flat_ms=round(flat_ms, 4),
+                index_ms=round(index_ms, 4),
+                speedup=round(flat_ms / index_ms, 2) if index_ms else None,
+                flat_bytes=flat_bytes,
+                index_bytes=compressed_bytes,
+                memory_saved=round(1 - compressed_bytes / flat_bytes, 4))
+
+
+def _clustered_vectors(n, dim, clusters=200, seed=0):
+    """unit vectors around random centres, closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(clusters, size=n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python -m question_answer_pipeline.qa_utils.indexes [path/to/vectors.f32 dim]
+    if len(sys.argv) == 3:
+        dim = int(sys.argv[2])
+        corpus = np.fromfile(sys.argv[1], dtype=np.float32).reshape(-1, dim)
+        rng = np.random.default_rng(1)
+        # held out chunks as queries
+        held_out = rng.choice(len(corpus), min(200, len(corpus) // 10), replace=False)
+        queries = corpus[held_out]
+        corpus = np.delete(corpus, held_out, axis=0)
+    else:
+        data = _clustered_vectors(50200, 768)
+        corpus, queries = data[:50000], data[50000:]
+
+    print(f'{len(corpus)} vectors, {len(queries)} queries')
+    for spec_string in ('ivf,nlist=1024,nprobe=8', 'ivf,nlist=1024,nprobe=32', 'hnsw,m=32,ef_search=64',
+                        'hnsw,m=32,ef_search=128', 'flat,codec=float16', 'flat,codec=int8',
+                        'flat,codec=pq,pq_m=96', 'flat,codec=pq,pq_m=96,rescore=4',
+                        'ivf,nlist=1024,nprobe=32,codec=int8', 'ivf,nlist=1024,nprobe=32,codec=pq,pq_m=96,rescore=4'):
+        result = compare_to_flat(IndexSpec.parse(spec_string), corpus, queries)
+        print(f"{spec_string:52s} recall@{result['k']} {result['recall']:.3f}  "
+              f"{result['index_ms']:.3f} ms/query vs flat {result['flat_ms']:.3f} ({result['speedup']}x)  "
+              f"{result['index_bytes'] / 2 ** 20:.1f} MB vs flat {result['flat_bytes'] / 2 ** 20:.1f} MB "
+              f"({-100 * result['memory_saved']:+.0f}%)  build {result['build_seconds']:.1f}s")
@@ -0,0 +1,93 @@
+import re
+import numpy as np
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself yourselves
+""".split())
+
+
+def tokenize(text):
+    """lower case alphanumeric terms without stopwords"""
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+class BM25Index:
+    """
+    BM25 over a fixed set of texts. Term weights are precomputed into a sparse (texts x vocabulary) matrix, so
+    scoring a query is a sum over the query's columns.
+    """
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        from scipy import sparse
+
+        self.vocabulary = {}
+        indices = []
+        indptr = [0]
+        for text in texts:
+            for token in tokenize(text):
+                indices.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+            indptr.append(len(indices))
+
+        shape = (len(texts), len(self.vocabulary))
+        tf = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=shape)
+        tf.sum_duplicates()
+
+        lengths = np.diff(indptr)
+        df = np.bincount(tf.indices, minlength=shape[1])
+        idf = np.log(1 + (shape[0] - df + 0.5) / (df + 0.5))
+        avg_length = lengths.mean() if len(texts) else 0
+        norm = k1 * (1 - b + b * lengths / (avg_length or 1))
+        rows = np.repeat(np.arange(shape[0]), np.diff(tf.indptr))
+        weights = idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + norm[rows])
+        self.weights = sparse.csr_matrix((weights, tf.indices, tf.indptr), shape=shape)
+
+    def score(self, query):
+        """:return: np.ndarray with the BM25 score of query per text"""
+        columns = [self.vocabulary[t] for t in dict.fromkeys(tokenize(query)) if t in self.vocabulary]
+        if not columns:
+            return np.zeros(self.weights.shape[0])
+        return np.asarray(self.weights[:, columns].sum(axis=1)).ravel()
+
+
+def bm25_scores(query, texts, k1=1.5, b=0.75):
+    """
+    BM25 score of query against each text. Document frequencies come from texts themselves, which is what we want
+    when re-scoring a handful of retrieved chunks.
+
+    :return: np.ndarray of shape (len(texts),)
+    """
+    return BM25Index(texts, k1=k1, b=b).score(query)
+
+
+def lexical_prefilter(docs, question, threshold, min_keep=0):
+    """
+    Drop retrieved chunks that share (almost) no terms with the question before they are sent for an LLM summary.
+
+    :param docs: langchain Documents from the vector search
+    :param question: user question
+    :param threshold: fraction of the best BM25 score a chunk needs to be kept (0 only drops chunks without any
+        question term)
+    :param min_keep: always keep at least this many chunks (the best scoring ones)
+    :return: kept docs in their original order, number of docs dropped
+    """
+    if not docs:
+        return docs, 0
+
+    scores = bm25_scores(question, [doc.page_content for doc in docs])
+    if scores.max() <= 0:
+        # nothing to go on (e.g. question is all stopwords), don't drop anything
+        return docs, 0
+
+    keep = (scores > 0) & (scores >= threshold * scores.max())
+    if keep.sum() < min_keep:
+        keep[np.argsort(-scores, kind='stable')[:min_keep]] = True
+
+    kept = [doc for doc, k in zip(docs, keep) if k]
+    return kept, len(docs) - len(kept)
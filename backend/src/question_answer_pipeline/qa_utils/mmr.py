@@ -0,0 +1,81 @@
+import numpy as np
+
+
+def normalize_rows(vectors):
+    """unit length rows (zero rows are left as they are), float32"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(query_embedding, embeddings, lambda_mult=0.5, k=4, normalized=False):
+    """
+    Maximal marginal relevance with cosine similarities, selects the same indices as
+    langchain.vectorstores.utils.maximal_marginal_relevance.
+
+    Similarity to the query is one matmul. Redundancy is kept as a running max similarity to the selected
+    embeddings, updated with one matrix-vector product per step, so every step is O(n * dim) in numpy instead of
+    recomputing all similarities to the selected set in a Python loop.
+
+    :param query_embedding: (dim,) or (1, dim)
+    :param embeddings: (n, dim) candidates
+    :param lambda_mult: 1 only ranks by similarity to the query, 0 by diversity
+    :param k: number of indices returned
+    :param normalized: query and embeddings already have unit length
+    :return: indices into embeddings in the order they were selected
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    k = min(k, len(embeddings))
+    if k <= 0:
+        return []
+
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    if not normalized:
+        embeddings = normalize_rows(embeddings)
+        query = normalize_rows(query)
+
+    similarity_to_query = embeddings @ query
+    max_similarity_to_selected = np.full(len(embeddings), -np.inf, dtype=np.float32)
+    selected = np.zeros(len(embeddings), dtype=bool)
+
+    idx = int(np.argmax(similarity_to_query))
+    idxs = [idx]
+    while len(idxs) < k:
+        selected[idx] = True
+        np.maximum(max_similarity_to_selected, embeddings @ embeddings[idx], out=max_similarity_to_selected)
+        scores = lambda_mult * similarity_to_query - (1 - lambda_mult) * max_similarity_to_selected
+        scores[selected] = -np.inf
+        idx = int(np.argmax(scores))
+        idxs.append(idx)
+    return idxs
+
+
+def _benchmark(dim=768, repeats=5):
+    """compare with langchain's implementation on fetch_k = 5 * k candidates, as Docs.vector_search uses it"""
+    import time
+    from langchain.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+
+    rng = np.random.default_rng(0)
+    for k in (25, 100):
+        fetch_k = 5 * k
+        query = rng.standard_normal(dim).astype(np.float32)
+        embeddings = rng.standard_normal((fetch_k, dim)).astype(np.float32) + query  # correlated with the query
+        candidates = list(embeddings)  # what faiss reconstruct() hands langchain
+
+        timings = {}
+        for name, mmr in (('langchain', lambda: langchain_mmr(query, candidates, k=k)),
+                          ('numpy', lambda: maximal_marginal_relevance(query, embeddings, k=k))):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                result = mmr()
+            timings[name] = (time.perf_counter() - start) / repeats
+            timings[name + '_result'] = result
+
+        same = timings['langchain_result'] == timings['numpy_result']
+        print(f"k={k} fetch_k={fetch_k}: langchain {timings['langchain'] * 1000:.1f} ms, "
+              f"numpy {timings['numpy'] * 1000:.2f} ms ({timings['langchain'] / timings['numpy']:.0f}x), "
+              f"same selection: {same}")
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -3,51 +3,81 @@ from langchain.text_splitter import TokenTextSplitter
 TextSplitter = TokenTextSplitter
 
 
-def parse_pdf(path, citation, key, chunk_chars=2000, overlap=50, peak=False):
-    import pypdf
-    unique_id = path.split('/')[-1][:-4]
-    print(f'PDF reading file with unique_id: {unique_id}')
+def chunk_pages(pages, unique_id, citation, key, chunk_chars=2000, overlap=50):
+    """
+    Yield (chunk, metadata) pairs from an iterable of page texts.
 
-    pdfFileObj = open(path, "rb")
-    pdfReader = pypdf.PdfReader(pdfFileObj)
-    splits = []
-    split = ""
-    pages = []
-    metadatas = []
-    for i, page in enumerate(pdfReader.pages):
-        split += page.extract_text()
-        pages.append(str(i + 1))
+    Text that has not been fully consumed is kept in a buffer that is trimmed once per page; within a page,
+    chunks are sliced out at increasing offsets instead of re-slicing the remainder after every chunk.
+    Produces the same chunks and page ranges as the original parse_pdf loop.
+    """
+    buffer = ""
+    offset = 0  # start of the next chunk in buffer
+    first_page = None
+    page_no = None
+    for i, text in enumerate(pages):
+        page_no = str(i + 1)
+        if first_page is None:
+            first_page = page_no
+        # drop the consumed prefix once per page
+        buffer = buffer[offset:] + text
+        offset = 0
         # split could be so long it needs to be split
         # into multiple chunks. Or it could be so short
         # that it needs to be combined with the next chunk.
-        while len(split) > chunk_chars:
-            splits.append(split[:chunk_chars])
+        while len(buffer) - offset > chunk_chars:
             # pretty formatting of pages (e.g. 1-3, 4, 5-7)
-            pg = "-".join([pages[0], pages[-1]])
-            metadatas.append(
-                dict(
-                    unique_id=unique_id,
-                    citation=citation,
-                    dockey=key,
-                    key=f"{key} pages {pg}",
-                )
-            )
-            split = split[chunk_chars - overlap:]
-            pages = [str(i + 1)]
-            if peak:
-                return splits[0], None
-    if len(split) > overlap:
-        splits.append(split[:chunk_chars])
-        pg = "-".join([pages[0], pages[-1]])
-        metadatas.append(
-            dict(
+            pg = "-".join([first_page, page_no])
+            yield buffer[offset:offset + chunk_chars], dict(
                 unique_id=unique_id,
                 citation=citation,
                 dockey=key,
                 key=f"{key} pages {pg}",
             )
+            offset += chunk_chars - overlap
+            first_page = page_no
+    if len(buffer) - offset > overlap:
+        pg = "-".join([first_page, page_no])
+        yield buffer[offset:offset + chunk_chars], dict(
+            unique_id=unique_id,
+            citation=citation,
+            dockey=key,
+            key=f"{key} pages {pg}",
         )
-    pdfFileObj.close()
+
+
+def iter_pdf_pages(path):
+    """Yield the extracted text of each page of a pdf"""
+    import pypdf
+    with open(path, "rb") as pdfFileObj:
+        pdfReader = pypdf.PdfReader(pdfFileObj)
+        for page in pdfReader.pages:
+            yield page.extract_text()
+
+
+def iter_parse_pdf(path, citation, key, chunk_chars=2000, overlap=50):
+    """
+    Generator version of parse_pdf. Pages are extracted one at a time and chunks are yielded as soon as they
+    are complete, so callers that consume lazily never hold the whole document in memory.
+
+    :return: generator of (chunk, metadata)
+    """
+    unique_id = path.split('/')[-1][:-4]
+    print(f'PDF reading file with unique_id: {unique_id}')
+    yield from chunk_pages(iter_pdf_pages(path), unique_id, citation, key, chunk_chars=chunk_chars, overlap=overlap)
+
+
+def parse_pdf(path, citation, key, chunk_chars=2000, overlap=50, peak=False):
+    chunks = iter_parse_pdf(path, citation, key, chunk_chars=chunk_chars, overlap=overlap)
+    if peak:
+        for split, _ in chunks:
+            chunks.close()
+            return split, None
+    splits = []
+    metadatas = []
+    for split, metadata in chunks:
+        splits.append(split)
+        metadatas.append(metadata)
     return splits, metadatas
 
 
@@ -0,0 +1,186 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+from openai.error import RateLimitError
+from langchain.chat_models import ChatOpenAI
+from .qaprompts import summary_prompt, make_chain
+
+# max summary calls in flight per process. The limit adapts between SUMMARY_MIN_CONCURRENCY and this value.
+SUMMARY_MAX_CONCURRENCY = int(os.getenv('SUMMARY_MAX_CONCURRENCY', 16))
+SUMMARY_MIN_CONCURRENCY = int(os.getenv('SUMMARY_MIN_CONCURRENCY', 1))
+# attempts per chunk when the api answers with a rate limit error
+SUMMARY_MAX_ATTEMPTS = int(os.getenv('SUMMARY_MAX_ATTEMPTS', 5))
+
+
+class AdaptiveLimiter:
+    """
+    Semaphore with a limit that follows the rate limits of the api (AIMD): the limit is halved whenever a call is
+    rate limited and raised by one after `increase_after` successful calls in a row.
+
+    The limit is shared by every event loop using the limiter, slots are counted per loop: an asyncio.Condition
+    belongs to the loop it is first used on, and a process may run several loops one after the other (scripts
+    calling asyncio.run, tests).
+    """
+
+    def __init__(self, limit, min_limit=1, max_limit=None, increase_after=10):
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.increase_after = increase_after
+        self._successes = 0
+        self._conditions = weakref.WeakKeyDictionary()  # event loop -> asyncio.Condition
+        self._in_flight = weakref.WeakKeyDictionary()  # event loop -> calls in flight
+
+    @property
+    def in_flight(self):
+        return sum(self._in_flight.values())
+
+    def _get_condition(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._conditions:
+            self._conditions[loop] = asyncio.Condition()
+            self._in_flight[loop] = 0
+        return loop, self._conditions[loop]
+
+    async def acquire(self):
+        loop, condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self._in_flight[loop] < self.limit)
+            self._in_flight[loop] += 1
+
+    async def release(self):
+        loop, condition = self._get_condition()
+        async with condition:
+            self._in_flight[loop] -= 1
+            condition.notify_all()
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.increase_after and self.limit < self.max_limit:
+            self.limit += 1
+            self._successes = 0
+
+    def on_rate_limit(self):
+        self._successes = 0
+        self.limit = max(self.min_limit, self.limit // 2)
+
+
+class SummaryExecutor:
+    """
+    Summarizes chunks for a question with one shared LLM client and chain. Calls across all requests go through
+    an AdaptiveLimiter, and time spent waiting for a slot is reported separately from time spent in the api call.
+    """
+
+    def __init__(self, llm=None, max_concurrency=SUMMARY_MAX_CONCURRENCY, min_concurrency=SUMMARY_MIN_CONCURRENCY,
+                 max_attempts=SUMMARY_MAX_ATTEMPTS):
+        if llm is None:
+            # retries are handled here so rate limits can feed back into the concurrency limit
+            llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo", max_retries=1)
+        self.llm = llm
+        self.chain = make_chain(prompt=summary_prompt, llm=llm)
+        self.limiter = AdaptiveLimiter(max_concurrency, min_limit=min_concurrency, max_limit=max_concurrency)
+        self.max_attempts = max_attempts
+        self.rate_limited = 0
+
+    async def summarize(self, doc, question):
+        """
+        :return: summary, dict(queue_wait=seconds waiting for a slot, call_time=seconds in api calls, attempts=n)
+        """
+        queue_wait = 0.0
+        call_time = 0.0
+        attempt = 1
+        while True:
+            queued = time.perf_counter()
+            await self.limiter.acquire()
+            started = time.perf_counter()
+            queue_wait += started - queued
+            try:
+                summary = await self.chain.arun(
+                    question=question,
+                    context_str=doc.page_content,
+                    citation=doc.metadata["citation"],
+                )
+                self.limiter.on_success()
+                return summary, dict(queue_wait=queue_wait, call_time=call_time + time.perf_counter() - started,
+                                     attempts=attempt)
+            except RateLimitError:
+                self.rate_limited += 1
+                self.limiter.on_rate_limit()
+                if attempt == self.max_attempts:
+                    raise
+            finally:
+                await self.limiter.release()
+
+            call_time += time.perf_counter() - started
+            # back off (with jitter) before queueing again, outside of the limiter
+            await asyncio.sleep(2 ** (attempt - 1) * (0.5 + random.random()))
+            attempt += 1
+
+    async def summarize_all(self, docs, question):
+        """
+        :return: summaries (same order as docs), dict with totals/max of queue wait and call time
+        """
+        results = await asyncio.gather(*[self.summarize(doc, question) for doc in docs])
+        summaries = [summary for summary, _ in results]
+        timings = [timing for _, timing in results]
+        return summaries, summarize_timings(timings, self)
+
+    async def summarize_until(self, docs, question, accept):
+        """
+        Summarize docs concurrently and pass each summary to accept(index, summary) in completion order. Once
+        accept returns True the calls still outstanding are cancelled.
+
+        :return: summaries (same order as docs, None for cancelled calls), dict with timing statistics
+        """
+        tasks = [asyncio.ensure_future(self.summarize(doc, question)) for doc in docs]
+        positions = {task: i for i, task in enumerate(tasks)}
+        summaries = [None] * len(docs)
+        timings = []
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                stop = False
+                for task in sorted(done, key=positions.get):
+                    i = positions[task]
+                    summaries[i], timing = task.result()
+                    timings.append(timing)
+                    if accept(i, summaries[i]):
+                        stop = True
+                        break
+                if stop:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        stats = summarize_timings(timings, self)
+        stats['cancelled'] = len(pending)
+        return summaries, stats
+
+
+def summarize_timings(timings, executor):
+    queue_waits = [t['queue_wait'] for t in timings] or [0.0]
+    call_times = [t['call_time'] for t in timings] or [0.0]
+    return dict(calls=len(timings),
+                queue_wait_total=round(sum(queue_waits), 3),
+                queue_wait_max=round(max(queue_waits), 3),
+                call_time_total=round(sum(call_times), 3),
+                call_time_max=round(max(call_times), 3),
+                retries=sum(t['attempts'] - 1 for t in timings),
+                concurrency_limit=executor.limiter.limit,
+                rate_limited_total=executor.rate_limited)
+
+
+_EXECUTOR = None
+
+
+def get_summary_executor():
+    """process wide executor, so the concurrency limit is shared by all requests"""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = SummaryExecutor()
+    return _EXECUTOR
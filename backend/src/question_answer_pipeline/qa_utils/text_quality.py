@@ -0,0 +1,121 @@
+import re
+import string
+from dataclasses import dataclass
+import numpy as np
+
+from .lexical import STOPWORDS
+
+# code points < 129 get their own histogram bin, everything above shares bin 129
+_BINS = 130
+_PRINTABLE = np.frombuffer(string.printable.encode(), dtype=np.uint8)
+_LETTERS_AND_SPACE = np.frombuffer((string.ascii_letters + string.whitespace).encode(), dtype=np.uint8)
+
+_HTML_RE = re.compile(r"<body|<html|<div")
+# besides years, the markers that make up most of a bibliography
+_REFERENCE_MARKERS = ("et al.", "arXiv", "Proceedings", "doi.org", "doi:")
+_WORD_RE = re.compile(r"[a-z]+")
+# author initials as written in reference lists ("P. Lewis", "Lewis, P."), rare in prose
+_INITIAL_RE = re.compile(r"\b[A-Z]\.")
+
+
+@dataclass
+class TextQuality:
+    length: int
+    entropy: float  # bits, over string.printable characters (as maybe_is_text)
+    non_ascii_ratio: float  # characters above code point 128 (as maybe_is_code)
+    alpha_ratio: float  # ascii letters and whitespace
+    reference_density: float  # bibliography markers per 100 characters
+    html: bool
+
+
+def _count_years(code_points):
+    """number of runs of exactly four digits starting with 19 or 20"""
+    digits = ((code_points >= 48) & (code_points <= 57)).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], digits, [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    starts = starts[ends - starts == 4]
+    first, second = code_points[starts], code_points[starts + 1]
+    return int((((first == 49) & (second == 57)) | ((first == 50) & (second == 48))).sum())
+
+
+def text_quality(s):
+    """
+    Character level quality measures of s. Entropy and the character ratios come from one histogram of its code
+    points, the reference markers and html tags are separate scans of s.
+    """
+    code_points = np.frombuffer(s.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    n = len(code_points)
+    if n == 0:
+        return TextQuality(0, 0.0, 0.0, 0.0, 0.0, False)
+
+    counts = np.bincount(np.minimum(code_points, _BINS - 1), minlength=_BINS)
+    p = counts[_PRINTABLE] / n
+    p = p[p > 0]
+
+    return TextQuality(length=n,
+                       entropy=float(-(p * np.log2(p)).sum()),
+                       non_ascii_ratio=counts[_BINS - 1] / n,
+                       alpha_ratio=counts[_LETTERS_AND_SPACE].sum() / n,
+                       reference_density=100 * (_count_years(code_points)
+                                                + sum(s.count(marker) for marker in _REFERENCE_MARKERS)) / n,
+                       html=_HTML_RE.search(s) is not None)
+
+
+def prose_signals(s):
+    """
+    :return: stopword_ratio (function words among the words of s, high in any readable sentence, including
+        prose around equations), initials_density (author initials per 100 characters)
+    """
+    words = _WORD_RE.findall(s.lower())
+    stopword_ratio = sum(word in STOPWORDS for word in words) / len(words) if words else 0.0
+    return stopword_ratio, 100 * len(_INITIAL_RE.findall(s)) / len(s) if s else 0.0
+
+
+def junk_reason(s, min_entropy=2.5, max_non_ascii=0.1, min_alpha=0.5, max_reference_density=1.0,
+                min_stopword_ratio=0.1, min_initials_density=1.0, max_reference_stopword_ratio=0.25):
+    """
+    Why a chunk is not worth embedding, None if it looks like regular text:
+    'empty',
+    'garbled' (failed extraction: mostly symbols, digits or (cid:n) codes instead of letters),
+    'non_ascii' (letters, but mostly outside ascii: a wrong font encoding or another language),
+    'low_entropy' (a few letters repeated over and over),
+    'references' (bibliography).
+
+    Every reason but 'empty' needs more than one signal, so dense but real text is kept: extraction failures
+    also have (almost) no function words, which math-heavy paragraphs still have, and a bibliography also has
+    author initials and few function words, which a related work paragraph full of (Author et al., 2020)
+    citations doesn't.
+    """
+    quality = text_quality(s)
+    if quality.length == 0:
+        return 'empty'
+    stopword_ratio, initials_density = prose_signals(s)
+    if stopword_ratio < min_stopword_ratio:
+        # entropy is over the printable characters, so it is low for garbled and non ascii text as well: check
+        # those first to report why the chunk was dropped
+        if quality.alpha_ratio < min_alpha:
+            return 'garbled'
+        if quality.non_ascii_ratio > max_non_ascii:
+            return 'non_ascii'
+        if quality.entropy <= min_entropy:
+            return 'low_entropy'
+    if (quality.reference_density > max_reference_density and initials_density > min_initials_density
+            and stopword_ratio < max_reference_stopword_ratio):
+        return 'references'
+    return None
+
+
+def drop_junk_chunks(splits, metadatas):
+    """
+    :return: splits and metadatas without junk chunks, dict(reason=number of chunks dropped)
+    """
+    kept_splits, kept_metadatas, dropped = [], [], {}
+    for split, metadata in zip(splits, metadatas):
+        reason = junk_reason(split)
+        if reason is None:
+            kept_splits.append(split)
+            kept_metadatas.append(metadata)
+        else:
+            dropped[reason] = dropped.get(reason, 0) + 1
+    return kept_splits, kept_metadatas, dropped
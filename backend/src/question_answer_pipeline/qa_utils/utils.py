@@ -1,32 +1,16 @@
-import math
-import string
 from tqdm import tqdm
+from .text_quality import text_quality
 
 
 
 def maybe_is_text(s, thresh=2.5):
-    if len(s) == 0:
-        return False
-    # Calculate the entropy of the string
-    entropy = 0
-    for c in string.printable:
-        p = s.count(c) / len(s)
-        if p > 0:
-            entropy += -p * math.log2(p)
-
-    # Check if the entropy is within a reasonable range for text
-    if entropy > thresh:
-        return True
-    return False
+    # entropy of the printable characters, a reasonable range for text is above thresh
+    return text_quality(s).entropy > thresh
 
 
 def maybe_is_code(s):
-    if len(s) == 0:
-        return False
-    # Check if the string contains a lot of non-ascii characters
-    if len([c for c in s if ord(c) > 128]) / len(s) > 0.1:
-        return True
-    return False
+    # a lot of non-ascii characters
+    return text_quality(s).non_ascii_ratio > 0.1
 
 
 def strings_similarity(s1, s2):
@@ -47,38 +31,34 @@ def maybe_is_truncated(s):
 
 
 def maybe_is_html(s):
-    if len(s) == 0:
-        return False
     # check for html tags
-    if "<body" in s or "<html" in s or "<div" in s:
-        return True
+    return text_quality(s).html
 
 
-from .readers import parse_pdf
+from .readers import iter_parse_pdf
 import tiktoken
 
 
 def get_input_tokens(list_of_filenames, model='text-embedding-ada-002'):
+    """
+    :return: total tokens of the files that could be parsed, dict(filename=tokens or None if parsing failed)
+    """
     encoding = tiktoken.encoding_for_model(model)
-    total_tokens = 0
 
     docs_processed = {}
 
     for doc in tqdm(list_of_filenames):
+        tokens = 0
         try:
-            texts, _ = parse_pdf(doc, 'None', 'None', chunk_chars=3000)
-            num_tokens = 0
-            for text in texts:
-                encoded_text = encoding.encode(text)
-                num_tokens += len(encoded_text)
+            # a running sum over the chunks as they are parsed, the document is never held whole
+            for text, _ in iter_parse_pdf(doc, 'None', 'None', chunk_chars=3000):
+                # encode_ordinary: text may contain special token strings
+                tokens += len(encoding.encode_ordinary(text))
+        except Exception as e:
+            print(f'Could not parse {doc}: {type(e).__name__}: {e}')
+            tokens = None
+        docs_processed[doc] = tokens
 
-            docs_processed[doc] = num_tokens
-        except:
-            docs_processed[doc] = False
-
-    total_tokens = sum(docs_processed.values())
+    total_tokens = sum(tokens for tokens in docs_processed.values() if tokens is not None)
 
     return total_tokens, docs_processed
-
-
-
@@ -0,0 +1,182 @@
+import os
+import time
+import uuid
+import asyncio
+import weakref
+import httpx
+
+# max pdfs downloaded at the same time (also the size of the connection pool)
+PDF_DOWNLOAD_CONCURRENCY = int(os.getenv('PDF_DOWNLOAD_CONCURRENCY', 8))
+# attempts per file, partial downloads are resumed with a Range request
+PDF_DOWNLOAD_RETRIES = int(os.getenv('PDF_DOWNLOAD_RETRIES', 3))
+PDF_DOWNLOAD_TIMEOUT = float(os.getenv('PDF_DOWNLOAD_TIMEOUT', 60))
+
+USER_AGENT = 'ai-research-assistant/0.1 (literature review pdf fetcher)'
+
+# one client (and connection pool) per event loop, shared by every request on that loop. Closed by close_client
+# (run_downloads does that for the short lived loops of the sync wrappers, the server on shutdown)
+_CLIENTS = weakref.WeakKeyDictionary()
+# downloads in flight per event loop, path -> task, so concurrent requests for a paper share one download
+_IN_FLIGHT = weakref.WeakKeyDictionary()
+# download slots per event loop, concurrency -> asyncio.Semaphore, so concurrent requests share one limit
+_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+class NotAPdfError(ValueError):
+    """the server answered with something else than a pdf (html error or captcha page), not worth retrying"""
+
+
+def get_client(concurrency=PDF_DOWNLOAD_CONCURRENCY):
+    loop = asyncio.get_running_loop()
+    client = _CLIENTS.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(follow_redirects=True,
+                                   timeout=PDF_DOWNLOAD_TIMEOUT,
+                                   headers={'User-Agent': USER_AGENT},
+                                   limits=httpx.Limits(max_connections=concurrency,
+                                                       max_keepalive_connections=concurrency))
+        _CLIENTS[loop] = client
+    return client
+
+
+def get_semaphore(concurrency=PDF_DOWNLOAD_CONCURRENCY):
+    """download slots of the running loop, shared by every download_pdfs call and fallback download on it"""
+    semaphores = _SEMAPHORES.setdefault(asyncio.get_running_loop(), {})
+    if concurrency not in semaphores:
+        semaphores[concurrency] = asyncio.Semaphore(concurrency)
+    return semaphores[concurrency]
+
+
+async def close_client():
+    """close the shared client of the running loop, call it before the loop ends"""
+    client = _CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def run_downloads(coroutine):
+    """asyncio.run for sync callers, closing the loop's shared client before the loop ends"""
+    async def run():
+        try:
+            return await coroutine
+        finally:
+            await close_client()
+
+    return asyncio.run(run())
+
+
+def _should_retry(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return not isinstance(error, NotAPdfError)
+
+
+async def _fetch(client, url, partial_path):
+    """Stream url into partial_path, continuing from whatever is already in partial_path"""
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    while True:
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        async with client.stream('GET', url, headers=headers) as response:
+            if response.status_code == 416 and offset:
+                # what we have doesn't match the server's file any more, start over without a Range
+                os.remove(partial_path)
+                offset = 0
+                continue
+            response.raise_for_status()
+            if response.status_code != 206:
+                # server ignored the Range header and sent the whole file
+                offset = 0
+            with open(partial_path, 'ab' if offset else 'wb') as f:
+                async for chunk in response.aiter_bytes():
+                    f.write(chunk)
+        break
+
+    with open(partial_path, 'rb') as f:
+        if f.read(5) != b'%PDF-':
+            os.remove(partial_path)
+            raise NotAPdfError(f'{url} did not return a pdf')
+
+
+async def download_pdf(client, semaphore, url, path, retries=PDF_DOWNLOAD_RETRIES):
+    """
+    Download url to path. Concurrent calls for the same path on one loop share a single download.
+
+    :return: dict(seconds, bytes, attempts, skipped, error)
+    """
+    if os.path.exists(path):
+        return dict(seconds=0.0, bytes=os.path.getsize(path), attempts=0, skipped=True, error=None)
+
+    in_flight = _IN_FLIGHT.setdefault(asyncio.get_running_loop(), {})
+    task = in_flight.get(path)
+    if task is None:
+        task = asyncio.ensure_future(_download_pdf(client, semaphore, url, path, retries))
+        in_flight[path] = task
+        task.add_done_callback(lambda _: in_flight.pop(path, None))
+    # shielded, a cancelled request doesn't cancel the download other requests wait for
+    return dict(await asyncio.shield(task))
+
+
+async def _download_pdf(client, semaphore, url, path, retries):
+    """
+    Data is written to a temp file of this download (resumed across its attempts) and renamed once complete, so
+    path only ever holds a whole file, even if another process downloads the same paper.
+    """
+    partial_path = f'{path}.{uuid.uuid4().hex[:8]}.part'
+    start = time.perf_counter()
+    error = None
+    attempt = 0
+    for attempt in range(1, retries + 1):
+        try:
+            async with semaphore:
+                await _fetch(client, url, partial_path)
+            os.replace(partial_path, path)
+            error = None
+            break
+        except (httpx.HTTPError, OSError, ValueError) as e:
+            error = f'{type(e).__name__}: {e}'
+            print(f'Download of {url} failed (attempt {attempt}/{retries}): {error}')
+            if not _should_retry(e):
+                break
+            if attempt < retries:
+                await asyncio.sleep(2 ** (attempt - 1))
+
+    if error is not None and os.path.exists(partial_path):
+        os.remove(partial_path)
+    return dict(seconds=time.perf_counter() - start,
+                bytes=os.path.getsize(path) if error is None else None,
+                attempts=attempt,
+                skipped=False,
+                error=error)
+
+
+async def download_pdfs(jobs, dest_dir, concurrency=PDF_DOWNLOAD_CONCURRENCY, retries=PDF_DOWNLOAD_RETRIES,
+                        client=None):
+    """
+    Download pdfs concurrently over a shared connection pool.
+
+    :param jobs: dict(filename=url)
+    :param dest_dir: directory the files are written to
+    :param concurrency: max downloads in flight on the running loop, across all calls
+    :param retries: attempts per file
+    :param client: httpx.AsyncClient, defaults to the shared client for the running loop
+    :return: dict(filename=dict(seconds, bytes, attempts, skipped, error))
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    client = client or get_client(concurrency)
+    semaphore = get_semaphore(concurrency)
+
+    filenames = list(jobs)
+    results = await asyncio.gather(*[download_pdf(client, semaphore, jobs[f], os.path.join(dest_dir, f), retries)
+                                     for f in filenames])
+    report = dict(zip(filenames, results))
+
+    for filename, result in report.items():
+        if result['skipped']:
+            continue
+        if result['error'] is None:
+            print(f"Downloaded {filename} in {result['seconds']:.2f}s ({result['bytes']} bytes)")
+        else:
+            print(f"FAILED to download {filename} after {result['seconds']:.2f}s: {result['error']}")
+
+    return report
@@ -1,6 +1,10 @@
 import modal
 from modal import Image, SharedVolume, Stub
 import os
+import time
+import threading
+import functools
+import traceback
 from tqdm import tqdm
 
 MODAL_DEPLOYMENT = 'PubFind'
@@ -15,6 +19,12 @@ pdfs_cache = '/root/volume'
 MODEL_FOLDER = 'instructorXL'
 LOCAL_MODEL_FOLDER = './question_answer_pipeline/test/embedding_models'
 
+MODEL_NAME = 'hkunlp/instructor-xl'
+DOCUMENT_INSTRUCTION = 'Represent the scientific paragraph for retrieval; Input: '
+QUESTION_INSTRUCTION = 'Represent the scientific query for retrieving supporting documents; Input: '
+# number of texts per model.encode / tokenizer call
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', 32))
+
 
 def download_models():
     from InstructorEmbedding import INSTRUCTOR
@@ -71,21 +81,136 @@ def peruse_volume(start_path='./'):
             print(f'{file_indent}{file}')
 
 
-def embed_questions(queries, use_modal='false'):
+# process wide model registry: model_root -> (model, tokenizer). Inside modal containers this keeps the model
+# resident between calls, on the server it is warmed at start up (see warm_up_models)
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+_WARM_UP_STATUS = dict(started=None, finished=None, error=None)
+
+
+def get_model(model_root=LOCAL_MODEL_FOLDER):
     """
-    Wrapper that will embed questions remotely or locally
-    use_modal: Str (comes from env variable)
+    INSTRUCTOR model and tokenizer for model_root, loaded once per process.
+
+    :return: model, tokenizer
     """
+    with _MODELS_LOCK:
+        if model_root not in _MODELS:
+            from InstructorEmbedding import INSTRUCTOR
+            from transformers import AutoTokenizer
+            import torch.cuda
 
+            print(f'Loading model at: {model_root}')
+            print(f"GPU access is {'available' if torch.cuda.is_available() else 'not available'}")
+            model = INSTRUCTOR(MODEL_NAME, cache_folder=model_root)
+            tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME,
+                                                      cache_dir=model_root)  # initialize the INSTRUCTOR tokenizer
+            _MODELS[model_root] = (model, tokenizer)
+        return _MODELS[model_root]
+
+
+@functools.lru_cache(maxsize=None)
+def get_modal_function(name):
+    """modal.Function.lookup is a network round trip, look each deployed function up once"""
+    return modal.Function.lookup(MODAL_DEPLOYMENT, name)
+
+
+def warm_up_models(use_modal='false'):
+    """
+    Load everything the embedding entry points need so the first request doesn't pay for it.
+    Locally that is the INSTRUCTOR model, with modal it is the function handles.
+    """
+    _WARM_UP_STATUS.update(started=time.time(), finished=None, error=None)
+    try:
+        if use_modal.lower() == 'true':
+            get_modal_function('get_question_embedding')
+            get_modal_function('embed_file_splits')
+        else:
+            get_model(LOCAL_MODEL_FOLDER)
+    except Exception as e:
+        _WARM_UP_STATUS['error'] = f'{type(e).__name__}: {e}'
+        print(f'Embedding warm up failed: {_WARM_UP_STATUS["error"]}')
+        raise
+    finally:
+        _WARM_UP_STATUS['finished'] = time.time()
+
+
+def on_warm_up_done(future):
+    """
+    Done callback for a warm_up_models future run in the background, so a failure is logged with its traceback
+    and shows up in embedding_status instead of being dropped with the future.
+    """
+    if future.cancelled():
+        _WARM_UP_STATUS['error'] = _WARM_UP_STATUS['error'] or 'warm up cancelled'
+        return
+    error = future.exception()
+    if error is not None:
+        _WARM_UP_STATUS['error'] = _WARM_UP_STATUS['error'] or f'{type(error).__name__}: {error}'
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
+def embedding_status(use_modal='false'):
+    """:return: dict(ready=bool, ...) describing whether the embedding model (or modal handles) are resident"""
     if use_modal.lower() == 'true':
+        ready = get_modal_function.cache_info().currsize >= 2
+    else:
+        ready = LOCAL_MODEL_FOLDER in _MODELS
+
+    started, finished = _WARM_UP_STATUS['started'], _WARM_UP_STATUS['finished']
+    if ready:
+        state = 'ready'
+    elif _WARM_UP_STATUS['error'] is not None:
+        # not retried, the server needs a restart (or the first request loads the model)
+        state = 'failed'
+    elif started is not None:
+        state = 'loading'
+    else:
+        state = 'not started'
+    return dict(ready=ready,
+                state=state,
+                use_modal=use_modal.lower() == 'true',
+                warm_up_started=started is not None,
+                load_seconds=round(finished - started, 2) if started and finished else None,
+                error=_WARM_UP_STATUS['error'])
+
+
+def _question_cache():
+    # only the server uses the cache, the modal containers import this file as a top level module
+    try:
+        from .embedding_cache import get_question_cache
+    except ImportError:
+        from embedding_cache import get_question_cache
+    return get_question_cache()
+
+
+def embed_questions(queries, use_modal='false'):
+    """
+    Wrapper that will embed questions remotely or locally. Questions seen before (after normalizing case and
+    whitespace) are served from the question embedding cache.
+    use_modal: Str (comes from env variable)
+    """
+    cache = _question_cache()
+    cached = [cache.get(question, QUESTION_INSTRUCTION, MODEL_NAME) for question in queries]
+    to_embed = list(dict.fromkeys(q for q, c in zip(queries, cached) if c is None))
+
+    if not to_embed:
+        print('Question embeddings cached')
+        new_embeddings = []
+    elif use_modal.lower() == 'true':
         print('Using MODAL')
         model_root = MODEL_FOLDER
-        f = modal.Function.lookup(MODAL_DEPLOYMENT, "get_question_embedding")
-        question_embeddings = f.call(queries, model_root)
+        f = get_modal_function("get_question_embedding")
+        new_embeddings = f.call(to_embed, model_root)
     else:
         print('Using Local Machine')
         model_root = LOCAL_MODEL_FOLDER
-        question_embeddings = get_question_embedding(queries, model_root)
+        new_embeddings = get_question_embedding(to_embed, model_root)
+
+    new_embeddings = dict(zip(to_embed, new_embeddings))
+    for question, embedding in new_embeddings.items():
+        cache.put(question, QUESTION_INSTRUCTION, MODEL_NAME, embedding)
+
+    question_embeddings = [c[0] if c is not None else new_embeddings[q] for q, c in zip(queries, cached)]
 
     return question_embeddings
 
@@ -94,32 +219,67 @@ def embed_questions(queries, use_modal='false'):
                image=PubFind_image,
                shared_volumes={CACHE_PATH: volume}
                )
-def get_question_embedding(queries, model_root):
-    from InstructorEmbedding import INSTRUCTOR
-    import torch.cuda
-    print(f"GPU access is {'available' if torch.cuda.is_available() else 'Not Available'}")
-    model = INSTRUCTOR('hkunlp/instructor-xl', cache_folder=model_root)
+def get_question_embedding(queries, model_root, batch_size=EMBED_BATCH_SIZE):
+    model, _ = get_model(model_root)
     print('Have model')
 
-    question_embeddings = []
-
-    for question in queries:
-        question = 'Represent the scientific query for retrieving supporting documents; Input: ' + question
-        embeds = model.encode(question)
-        question_embeddings.append(embeds)
+    # all questions in one batched encode, returned as a list with one embedding per question
+    question_embeddings = list(model.encode([QUESTION_INSTRUCTION + question for question in queries],
+                                            batch_size=batch_size))
 
     print('Have embeddings')
     return question_embeddings
 
 
+def _chunk_cache():
+    try:
+        from .embedding_cache import get_chunk_cache
+    except ImportError:
+        from embedding_cache import get_chunk_cache
+    return get_chunk_cache()
+
+
 def embed_document(doc_splits, use_modal='false', map_splits=False):
     """
+    Embed the splits of each document. Splits are looked up in the content addressed chunk cache first
+    (keyed by model, instruction and text) so only unseen chunks reach the model.
 
     :param map_splits:
     :param doc_splits:
     :param use_modal:
-    :return:
+    :return: list with dict(file_embeddings=..., num_tokens=...) per document
     """
+    cache = _chunk_cache()
+    cached = [cache.get_many(splits, DOCUMENT_INSTRUCTION, MODEL_NAME) for splits in doc_splits]
+    missing = [[split for split, c in zip(splits, doc_cached) if c is None]
+               for splits, doc_cached in zip(doc_splits, cached)]
+    print(f'Chunk embedding cache: {sum(map(len, missing))} of {sum(map(len, doc_splits))} splits to encode')
+
+    # documents without any unseen chunk don't need a model call at all
+    to_embed = [splits for splits in missing if splits]
+    new_embeddings = iter(_embed_document(to_embed, use_modal=use_modal, map_splits=map_splits) if to_embed else [])
+
+    doc_embeddings = []
+    for splits, doc_cached in zip(missing, cached):
+        if splits:
+            embedded = next(new_embeddings)
+            cache.put_many(splits, DOCUMENT_INSTRUCTION, MODEL_NAME, embedded['file_embeddings'],
+                           embedded['num_tokens'])
+            embedded = zip(embedded['file_embeddings'], embedded['num_tokens'])
+        else:
+            embedded = iter([])
+
+        file_embeddings, num_tokens = [], []
+        for c in doc_cached:
+            embeds, tokens = c if c is not None else next(embedded)
+            file_embeddings.append(embeds)
+            num_tokens.append(tokens)
+        doc_embeddings.append({'file_embeddings': file_embeddings, 'num_tokens': num_tokens})
+
+    return doc_embeddings
+
+
+def _embed_document(doc_splits, use_modal='false', map_splits=False):
     doc_embeddings = []
 
     if use_modal.lower() == 'true':
@@ -128,7 +288,7 @@ def embed_document(doc_splits, use_modal='false', map_splits=False):
         print('MODAL ENTRYPOINT: Using MODAL')
         print('Mapping per document')
 
-        f = modal.Function.lookup(MODAL_DEPLOYMENT, "embed_file_splits")
+        f = get_modal_function("embed_file_splits")
         # f = embed_file_splits
         iterable_ = [(splits, map_splits) for splits in doc_splits]
 
@@ -137,20 +297,17 @@ def embed_document(doc_splits, use_modal='false', map_splits=False):
             doc_embeddings.append({'file_embeddings': file_embeddings, 'num_tokens': num_tokens})
     else:
         print('Using Local Machine')
-        # instantiate model only once when running on local machine
-        from InstructorEmbedding import INSTRUCTOR
-        from transformers import AutoTokenizer
-        import torch.cuda
-        model_root = LOCAL_MODEL_FOLDER
-        print(f"GPU access is {'available' if torch.cuda.is_available() else 'Not Available'}")
-        model = INSTRUCTOR('hkunlp/instructor-xl', cache_folder=model_root)
-        tokenizer = AutoTokenizer.from_pretrained('hkunlp/instructor-xl',
-                                                  cache_dir=model_root)  # initialize the INSTRUCTOR tokenizer
-        # process items
-        for splits in tqdm(doc_splits):
-            file_embeddings, num_tokens = embed_file_splits(splits, use_modal=False, map_splits=False, model=model,
-                                                            tokenizer=tokenizer)
-            doc_embeddings.append({'file_embeddings': file_embeddings, 'num_tokens': num_tokens})
+        # model is loaded once per process (and warmed at server start up)
+        model, tokenizer = get_model(LOCAL_MODEL_FOLDER)
+        # encode the splits of every document as one batched stream, then regroup per document
+        all_splits = [split for splits in doc_splits for split in splits]
+        all_embeddings, all_tokens = embed_file_splits(all_splits, use_modal=False, map_splits=False, model=model,
+                                                       tokenizer=tokenizer)
+        start = 0
+        for splits in doc_splits:
+            end = start + len(splits)
+            doc_embeddings.append({'file_embeddings': all_embeddings[start:end], 'num_tokens': all_tokens[start:end]})
+            start = end
 
     return doc_embeddings
 
@@ -160,7 +317,8 @@ def embed_document(doc_splits, use_modal='false', map_splits=False):
     image=PubFind_image,
     shared_volumes={CACHE_PATH: volume}
 )
-def embed_file_splits(splits, map_splits=False, use_modal=True,  model=None, tokenizer=None):
+def embed_file_splits(splits, map_splits=False, use_modal=True,  model=None, tokenizer=None,
+                      batch_size=EMBED_BATCH_SIZE):
     """
     Wrapper that will embed questions remotely or locally
     use_modal: Str (comes from env variable)
@@ -177,24 +335,46 @@ def embed_file_splits(splits, map_splits=False, use_modal=True,  model=None, tok
             num_tokens.append(tokens)
             file_embeddings.append(embeds)
     else:
-        print('Iterating through splits')
+        print('Encoding splits in batches')
         if model is None:
             # if we're loading a container for each model
             model_root = MODEL_FOLDER if use_modal else LOCAL_MODEL_FOLDER
             print(f'Using model at: {model_root}')
-            from InstructorEmbedding import INSTRUCTOR
-            from transformers import AutoTokenizer
-            import torch.cuda
+            model, tokenizer = get_model(model_root)
 
-            print(f"GPU access is {'available' if torch.cuda.is_available() else 'not available'}")
-            model = INSTRUCTOR('hkunlp/instructor-xl', cache_folder=model_root)
-            tokenizer = AutoTokenizer.from_pretrained('hkunlp/instructor-xl',
-                                                      cache_dir=model_root)  # initialize the INSTRUCTOR tokenizer
+        file_embeddings, num_tokens = encode_splits(splits, model, tokenizer, batch_size=batch_size)
 
-        for split in tqdm(splits, mininterval=2):
-            embeds, tokens = get_file_chunks_embeds(split, model=model, tokenizer=tokenizer)
-            num_tokens.append(tokens)
-            file_embeddings.append(embeds)
+    return file_embeddings, num_tokens
+
+
+def encode_splits(splits, model, tokenizer=None, batch_size=EMBED_BATCH_SIZE):
+    """
+    Batched encoding of document splits. Each batch is tokenized once (for the token counts) and encoded once.
+
+    :param splits: list of text chunks
+    :param model: INSTRUCTOR model
+    :param tokenizer: defaults to the model's own tokenizer
+    :param batch_size:
+    :return: file_embeddings (list with one embedding per split), num_tokens (list with one count per split)
+    """
+    if tokenizer is None:
+        tokenizer = model.tokenizer
+    model_max_seq_length = model.max_seq_length
+
+    file_embeddings = []
+    num_tokens = []
+    for start in tqdm(range(0, len(splits), batch_size), mininterval=2):
+        batch = [DOCUMENT_INSTRUCTION + split for split in splits[start:start + batch_size]]
+
+        tokens = [len(input_ids) for input_ids in tokenizer(batch)['input_ids']]
+        embeds = model.encode(batch, batch_size=len(batch))
+
+        truncated = sum(n > model_max_seq_length for n in tokens)
+        if truncated:
+            print(f'TRUNCATING {truncated} SPLITS')
+
+        num_tokens.extend(tokens)
+        file_embeddings.extend(embeds)
 
     return file_embeddings, num_tokens
 
@@ -205,29 +385,12 @@ def embed_file_splits(splits, map_splits=False, use_modal=True,  model=None, tok
                )
 def get_file_chunks_embeds(split, model=None, tokenizer=None):
     if model is None:
-        # if we're loading a container for EVERY split
-        model_root = MODEL_FOLDER
-        from InstructorEmbedding import INSTRUCTOR
-        from transformers import AutoTokenizer
-        import torch.cuda
-
-        print(f"GPU access is {'available' if torch.cuda.is_available() else 'not available'}")
-        model = INSTRUCTOR('hkunlp/instructor-xl', cache_folder=model_root)
-        tokenizer = AutoTokenizer.from_pretrained('hkunlp/instructor-xl',
-                                                  cache_dir=model_root)  # initialize the INSTRUCTOR tokenizer
-    # encode each chunk
-    model_max_seq_length = model.max_seq_length
-    split = 'Represent the scientific paragraph for retrieval; Input: ' + split
-
-    embeds = model.encode(split)
-    tokenized_text = tokenizer(split)['input_ids']
-    num_tokens = len(tokenized_text)
-
-    if num_tokens > model_max_seq_length:
-        print(f'TRUNCATING SPLIT')
-        # collect embeddings for all documents
+        # if we're loading a container for EVERY split, the model stays resident for later calls
+        model, tokenizer = get_model(MODEL_FOLDER)
+    # encode a single chunk (used when mapping splits over modal containers)
+    file_embeddings, num_tokens = encode_splits([split], model, tokenizer, batch_size=1)
 
-    return embeds, num_tokens
+    return file_embeddings[0], num_tokens[0]
 
 
 # TODO: This doesnt add them correctly
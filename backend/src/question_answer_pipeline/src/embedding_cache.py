@@ -0,0 +1,169 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+ROOT_DIRECTORY = os.getenv('ROOT_DIRECTORY', '/test')
+CACHE_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'cache')
+
+# question embeddings: in memory entries, and sqlite file for the on disk tier ('' disables it)
+QUESTION_CACHE_SIZE = int(os.getenv('QUESTION_CACHE_SIZE', 1024))
+QUESTION_CACHE_PATH = os.getenv('QUESTION_CACHE_PATH', os.path.join(CACHE_DIRECTORY, 'question_embeddings.db'))
+
+# chunk embeddings (content addressed): in memory entries, sqlite file ('' disables it) and max rows kept on disk
+CHUNK_CACHE_SIZE = int(os.getenv('CHUNK_CACHE_SIZE', 20000))
+CHUNK_CACHE_PATH = os.getenv('CHUNK_CACHE_PATH', os.path.join(CACHE_DIRECTORY, 'chunk_embeddings.db'))
+CHUNK_CACHE_DISK_ENTRIES = int(os.getenv('CHUNK_CACHE_DISK_ENTRIES', 200000))
+
+
+def normalize_question(text):
+    """case and whitespace insensitive, so trivially rephrased repeats share an entry"""
+    return ' '.join(text.lower().split())
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU of embeddings keyed by a hash of (model id, instruction, text), optionally backed by a sqlite
+    file so entries survive restarts. Values are (embedding, num_tokens).
+    """
+
+    def __init__(self, maxsize=1024, path=None, normalize=None, max_disk_entries=None):
+        """
+        :param maxsize: number of entries kept in memory
+        :param path: sqlite file for the on disk tier, None for memory only
+        :param normalize: function applied to the text before hashing
+        :param max_disk_entries: least recently used rows beyond this are deleted from the on disk tier
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self.normalize = normalize
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_saved = 0  # tokens that did not have to go through the model
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                             '(key TEXT PRIMARY KEY, vector BLOB, num_tokens INTEGER, last_used REAL)')
+            self._db.commit()
+
+    def make_key(self, text, instruction, model_id):
+        if self.normalize is not None:
+            text = self.normalize(text)
+        return hashlib.sha256('\x00'.join([model_id, instruction, text]).encode()).hexdigest()
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, text, instruction, model_id):
+        """:return: (embedding, num_tokens) or None"""
+        return self.get_many([text], instruction, model_id)[0]
+
+    def get_many(self, texts, instruction, model_id):
+        """:return: list with (embedding, num_tokens) or None per text"""
+        values = []
+        with self._lock:
+            for text in texts:
+                values.append(self._lookup(self.make_key(text, instruction, model_id)))
+            if self._db is not None:
+                self._db.commit()
+        return values
+
+    def _lookup(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.tokens_saved += self._entries[key][1]
+            return self._entries[key]
+
+        if self._db is not None:
+            row = self._db.execute('SELECT vector, num_tokens FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._db.execute('UPDATE embeddings SET last_used = ? WHERE key = ?', (time.time(), key))
+                value = (np.frombuffer(row[0], dtype=np.float32), row[1])
+                self._remember(key, value)
+                self.disk_hits += 1
+                self.tokens_saved += value[1]
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, text, instruction, model_id, embedding, num_tokens=0):
+        self.put_many([text], instruction, model_id, [embedding], [num_tokens])
+
+    def put_many(self, texts, instruction, model_id, embeddings, num_tokens):
+        """Insert several entries in one transaction"""
+        rows = []
+        with self._lock:
+            for text, embedding, tokens in zip(texts, embeddings, num_tokens):
+                key = self.make_key(text, instruction, model_id)
+                value = (np.asarray(embedding, dtype=np.float32), int(tokens))
+                self._remember(key, value)
+                rows.append((key, value[0].tobytes(), value[1], time.time()))
+
+            if self._db is not None and rows:
+                self._db.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+                self._evict_disk()
+                self._db.commit()
+
+    def _evict_disk(self):
+        if self.max_disk_entries is None:
+            return
+        count = self._db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        if count > self.max_disk_entries:
+            self._db.execute('DELETE FROM embeddings WHERE key IN '
+                             '(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)',
+                             (count - self.max_disk_entries,))
+            self.evictions += count - self.max_disk_entries
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return dict(hits=self.hits,
+                    disk_hits=self.disk_hits,
+                    misses=self.misses,
+                    hit_rate=round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+                    tokens_saved=self.tokens_saved,
+                    size=len(self._entries),
+                    maxsize=self.maxsize,
+                    on_disk=self._db is not None,
+                    disk_evictions=self.evictions)
+
+
+_QUESTION_CACHE = None
+
+
+def get_question_cache():
+    """process wide cache used by embedding.embed_questions"""
+    global _QUESTION_CACHE
+    if _QUESTION_CACHE is None:
+        _QUESTION_CACHE = EmbeddingCache(maxsize=QUESTION_CACHE_SIZE,
+                                         path=QUESTION_CACHE_PATH or None,
+                                         normalize=normalize_question)
+    return _QUESTION_CACHE
+
+
+_CHUNK_CACHE = None
+
+
+def get_chunk_cache():
+    """process wide content addressed cache used by embedding.embed_document"""
+    global _CHUNK_CACHE
+    if _CHUNK_CACHE is None:
+        _CHUNK_CACHE = EmbeddingCache(maxsize=CHUNK_CACHE_SIZE,
+                                      path=CHUNK_CACHE_PATH or None,
+                                      max_disk_entries=CHUNK_CACHE_DISK_ENTRIES)
+    return _CHUNK_CACHE
@@ -0,0 +1,197 @@
+import os
+import json
+import pickle
+import threading
+import numpy as np
+
+# dtype of the vectors of new stores: float32, or float16 for half the disk and page cache. Existing stores keep theirs
+STORE_DTYPE = os.getenv('EMBEDDING_STORE_DTYPE', 'float32')
+
+
+class EmbeddingStore:
+    """
+    Append-only store for chunk embeddings, keyed by arXiv id.
+
+    Files in `directory`:
+        vectors.f32   float32 matrix of every embedding (vectors.f16 for a float16 store). Rows are appended per
+                      paper and read through np.memmap.
+        chunks.jsonl  one line per paper with texts, metadatas and num_tokens.
+        table.jsonl   one line per paper: unique_id, first row and number of rows in the vectors file, byte range in
+                      chunks.jsonl. This is the only file read at start up.
+
+    A paper is only visible once its table line is written (vectors and chunks are written first), so a crash
+    mid-write leaves trailing bytes that are truncated on the next open. There must be a single writer per
+    directory.
+
+    Vectors are stored as float32 or float16, not int8 / pq: they are the full precision source the compressed
+    Docs index re-scores with (IndexSpec.rescore). float16 keeps the distances to ~3 significant digits.
+    """
+
+    VECTORS_FILES = {'float32': 'vectors.f32', 'float16': 'vectors.f16'}
+    CHUNKS_FILE = 'chunks.jsonl'
+    TABLE_FILE = 'table.jsonl'
+
+    def __init__(self, directory, dtype='float32'):
+        if dtype not in self.VECTORS_FILES:
+            raise ValueError(f'Unknown embedding store dtype {dtype}, expected one of {tuple(self.VECTORS_FILES)}')
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for existing, vectors_file in self.VECTORS_FILES.items():
+            if existing != dtype and os.path.exists(os.path.join(directory, vectors_file)):
+                print(f'{directory} holds {existing} vectors, keeping them instead of {dtype}')
+                dtype = existing
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = os.path.join(directory, self.VECTORS_FILES[dtype])
+        self.chunks_path = os.path.join(directory, self.CHUNKS_FILE)
+        self.table_path = os.path.join(directory, self.TABLE_FILE)
+
+        self.table = {}  # unique_id -> dict(row, rows, pos, size)
+        self.dim = None
+        self.num_rows = 0
+        self._chunks_size = 0
+        self._memmap = None
+        self._lock = threading.Lock()
+        self._load_table()
+
+    def __contains__(self, unique_id):
+        return unique_id in self.table
+
+    def __len__(self):
+        return len(self.table)
+
+    def ids(self):
+        return set(self.table)
+
+    def _load_table(self):
+        table_size = 0  # bytes of complete table lines
+        if os.path.exists(self.table_path):
+            with open(self.table_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('missing newline')
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partially written last line
+                        break
+                    table_size += len(line)
+                    self.table[entry['unique_id']] = entry
+                    self.dim = entry['dim']
+                    self.num_rows = max(self.num_rows, entry['row'] + entry['rows'])
+                    self._chunks_size = max(self._chunks_size, entry['pos'] + entry['size'])
+
+        # drop anything written after the last complete table entry. The table itself too, otherwise the next
+        # entry is appended to the fragment and every entry after it fails to load
+        for path, size in [(self.table_path, table_size),
+                           (self.vectors_path, self.num_rows * (self.dim or 0) * self.dtype.itemsize),
+                           (self.chunks_path, self._chunks_size)]:
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                print(f'Truncating incomplete write in {path}')
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _vectors(self):
+        if self.num_rows == 0:
+            return np.empty((0, self.dim or 0), dtype=self.dtype)
+        if self._memmap is None or self._memmap.shape[0] < self.num_rows:
+            self._memmap = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(self.num_rows, self.dim))
+        return self._memmap
+
+    def add(self, unique_id, texts, embeddings, metadatas, num_tokens):
+        """
+        Append one paper.
+
+        :param unique_id: arXiv id
+        :param texts: list of text chunks
+        :param embeddings: one embedding per chunk (list of arrays or 2d array)
+        :param metadatas: one metadata dict per chunk
+        :param num_tokens: one token count per chunk
+        """
+        if len(texts) == 0:
+            # e.g. every chunk was junk. Not recorded, so the paper is not taken for embedded
+            print(f'No chunks for {unique_id}, not adding it to the embedding store at {self.directory}')
+            return
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+
+        with self._lock:
+            if unique_id in self.table:
+                raise ValueError(f'{unique_id} is already in the embedding store at {self.directory}')
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f'Expected embeddings of dim {self.dim}, got {embeddings.shape[1]}')
+
+            payload = json.dumps(dict(texts=list(texts),
+                                      metadatas=list(metadatas),
+                                      num_tokens=[int(n) for n in num_tokens])).encode() + b'\n'
+
+            with open(self.vectors_path, 'ab') as f:
+                f.write(embeddings.astype(self.dtype, copy=False).tobytes())
+            with open(self.chunks_path, 'ab') as f:
+                f.write(payload)
+
+            entry = dict(unique_id=unique_id, row=self.num_rows, rows=len(texts), dim=self.dim,
+                         pos=self._chunks_size, size=len(payload))
+            with open(self.table_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+            self.table[unique_id] = entry
+            self.num_rows += len(texts)
+            self._chunks_size += len(payload)
+
+    def get_embeddings(self, unique_id):
+        """:return: (rows, dim) read only view into the memmap, in the store's dtype"""
+        entry = self.table[unique_id]
+        return self._vectors()[entry['row']:entry['row'] + entry['rows']]
+
+    def get(self, unique_id):
+        """
+        :return: [texts, embeddings, metadatas, num_tokens], same layout as the per-paper pickles.
+            embeddings is a read only (rows, dim) view into the memmap, in the store's dtype.
+        """
+        entry = self.table[unique_id]
+        with open(self.chunks_path, 'rb') as f:
+            f.seek(entry['pos'])
+            payload = json.loads(f.read(entry['size']))
+
+        # copy metadata so callers (e.g. Docs renaming dockeys) can't touch each other's records
+        metadatas = [dict(m) for m in payload['metadatas']]
+        return [payload['texts'], self.get_embeddings(unique_id), metadatas, payload['num_tokens']]
+
+    def import_pickles(self, directory=None):
+        """
+        Import per-paper [splits, file_embeddings, metadata, num_tokens] pickles (the previous format).
+        Pickles are left on disk. Papers already in the store are skipped.
+
+        :return: number of papers imported
+        """
+        directory = directory or self.directory
+        imported = 0
+        for f in sorted(os.listdir(directory)):
+            if f[-4:] != '.pkl' or f[:-4] in self.table:
+                continue
+            with open(os.path.join(directory, f), 'rb') as fb:
+                texts, file_embeddings, metadatas, num_tokens = pickle.load(fb)
+            if isinstance(texts, str):
+                # abstract pickles stored the summary as a bare string
+                texts = [texts]
+            self.add(f[:-4], texts, file_embeddings, metadatas, num_tokens)
+            imported += 1
+
+        if imported:
+            print(f'Imported {imported} embedding pickles into {self.directory}')
+        return imported
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_embedding_store(directory):
+    """Process wide store for directory. Existing .pkl embeddings in the directory are imported on first use."""
+    with _STORES_LOCK:
+        if directory not in _STORES:
+            store = EmbeddingStore(directory, dtype=STORE_DTYPE)
+            store.import_pickles()
+            _STORES[directory] = store
+        return _STORES[directory]
@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from .text_cache import get_text_cache
+from ..qa_utils.text_quality import drop_junk_chunks
+
+# number of processes used to parse pdfs. 1 parses in the calling process.
+PDF_PARSE_WORKERS = int(os.getenv('PDF_PARSE_WORKERS', os.cpu_count() or 1))
+# drop reference lists and garbled chunks before they are embedded. Opt-in: dropped chunks never reach the
+# embedding store, so a wrongly dropped chunk is lost until the paper is embedded again
+DROP_JUNK_CHUNKS = os.getenv('DROP_JUNK_CHUNKS', 'false').lower() == 'true'
+
+# the pool is kept for the lifetime of the server so worker start-up is only paid once.
+# spawn (not fork) because the parent may hold torch / tokenizer threads.
+_POOL = None
+_POOL_SIZE = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool(max_workers):
+    """the shared pool, replaced by one of the new size when max_workers changes"""
+    global _POOL, _POOL_SIZE
+    with _POOL_LOCK:
+        if _POOL is not None and _POOL_SIZE != max_workers:
+            # jobs already submitted to the old pool still finish
+            _POOL.shutdown(wait=False)
+            _POOL = None
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            _POOL_SIZE = max_workers
+        return _POOL
+
+
+def _reset_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+
+def _parse_pdf_job(f_path, citation, key, chunk_chars, overlap):
+    """
+    Runs inside a worker. Python exceptions are returned instead of raised so one malformed pdf
+    doesn't fail the rest of the batch.
+
+    :return: splits, metadatas, elapsed seconds, error message (None on success)
+    """
+    start = time.perf_counter()
+    try:
+        splits, metadatas = get_text_cache().parse_pdf(f_path, citation, key, chunk_chars=chunk_chars,
+                                                      overlap=overlap)
+        error = None
+    except Exception as e:
+        splits, metadatas, error = None, None, f'{type(e).__name__}: {e}'
+    return splits, metadatas, time.perf_counter() - start, error
+
+
+def _run_isolated(job, chunk_chars, overlap):
+    """Re-run a job whose worker died in a single use pool so a hard crash only takes out that pdf."""
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        try:
+            return pool.submit(_parse_pdf_job, *job, chunk_chars, overlap).result()
+        except BrokenProcessPool:
+            return None, None, time.perf_counter() - start, 'worker process crashed'
+
+
+def parse_pdf_files(jobs, chunk_chars=1100, overlap=100, max_workers=None, drop_junk=DROP_JUNK_CHUNKS):
+    """
+    Parse pdfs in parallel across processes.
+
+    :param jobs: list of (f_path, citation, key)
+    :param chunk_chars: passed to PaperTextCache.parse_pdf
+    :param overlap: passed to PaperTextCache.parse_pdf
+    :param max_workers: defaults to PDF_PARSE_WORKERS
+    :param drop_junk: drop chunks that look like reference lists or failed extraction (see text_quality)
+    :return:
+        doc_splits: list of splits per job (None if the pdf could not be parsed)
+        doc_metadatas: list of metadatas per job (None if the pdf could not be parsed)
+        report: dict(f_path=dict(seconds=parse time, error=error message or None, dropped=dict(reason=count)))
+    """
+    max_workers = max_workers or PDF_PARSE_WORKERS
+    results = [None] * len(jobs)
+
+    if max_workers <= 1 or len(jobs) <= 1:
+        for i, job in enumerate(jobs):
+            results[i] = _parse_pdf_job(*job, chunk_chars, overlap)
+    else:
+        crashed = []
+        pool = _get_pool(max_workers)
+        futures = {pool.submit(_parse_pdf_job, *job, chunk_chars, overlap): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                crashed.append(i)
+
+        if crashed:
+            # a worker died (e.g. segfault in the pdf backend) and took the pool down with it
+            print(f'PDF worker pool crashed, retrying {len(crashed)} files in isolation')
+            _reset_pool()
+            for i in crashed:
+                results[i] = _run_isolated(jobs[i], chunk_chars, overlap)
+
+    doc_splits, doc_metadatas, report = [], [], {}
+    for (f_path, _, _), (splits, metadatas, seconds, error) in zip(jobs, results):
+        dropped = {}
+        if error is None and drop_junk:
+            splits, metadatas, dropped = drop_junk_chunks(splits, metadatas)
+            if not splits:
+                splits, metadatas, error = None, None, f'no usable text (dropped {dropped})'
+        doc_splits.append(splits)
+        doc_metadatas.append(metadatas)
+        report[f_path] = dict(seconds=seconds, error=error, dropped=dropped)
+        if error is None:
+            print(f'Parsed {os.path.split(f_path)[1]} in {seconds:.2f}s ({len(splits)} splits, dropped {dropped})')
+        else:
+            print(f'FAILED to parse {os.path.split(f_path)[1]} after {seconds:.2f}s: {error}')
+
+    return doc_splits, doc_metadatas, report
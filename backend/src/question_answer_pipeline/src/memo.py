@@ -0,0 +1,116 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+ROOT_DIRECTORY = os.getenv('ROOT_DIRECTORY', '/test')
+CACHE_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'cache')
+
+# sqlite files of the /search stage memos ('' keeps them in memory only)
+MEMO_DIRECTORY = os.getenv('MEMO_DIRECTORY', os.path.join(CACHE_DIRECTORY, 'memo'))
+# entries kept per stage, least recently used ones beyond this are deleted
+MEMO_MAX_ENTRIES = int(os.getenv('MEMO_MAX_ENTRIES', 2000))
+# seconds an entry stays valid per stage. arXiv results go stale as new papers come out.
+MEMO_TTLS = {
+    'refiner': float(os.getenv('REFINER_MEMO_TTL', 7 * 24 * 3600)),
+    'arxiv': float(os.getenv('ARXIV_MEMO_TTL', 24 * 3600)),
+    'rerank': float(os.getenv('RERANK_MEMO_TTL', 7 * 24 * 3600)),
+}
+
+
+class StageMemo:
+    """
+    Disk backed memo of a pipeline stage: JSON values keyed by a hash of the stage's inputs. Entries older
+    than `ttl` seconds are treated as missing and the table is bounded to `max_entries` rows.
+    """
+
+    def __init__(self, name, path=None, ttl=None, max_entries=2000):
+        """
+        :param name: stage name, used in stats
+        :param path: sqlite file, None for memory only
+        :param ttl: seconds an entry is valid, None for no expiry
+        :param max_entries: least recently used rows beyond this are deleted
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS memo '
+                         '(key TEXT PRIMARY KEY, value TEXT, created REAL, last_used REAL)')
+        self._db.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """:return: stored value or None if missing / expired"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM memo WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM memo WHERE key = ?', (key,))
+                self._db.commit()
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE memo SET last_used = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)', (key, json.dumps(value), now, now))
+            if self.ttl is not None:
+                self._db.execute('DELETE FROM memo WHERE created < ?', (now - self.ttl,))
+            count = self._db.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute('DELETE FROM memo WHERE key IN '
+                                 '(SELECT key FROM memo ORDER BY last_used ASC LIMIT ?)',
+                                 (count - self.max_entries,))
+                self.evictions += count - self.max_entries
+            self._db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = self._db.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=round(self.hits / lookups, 4) if lookups else None,
+                    expired=self.expired,
+                    evictions=self.evictions,
+                    size=size,
+                    max_entries=self.max_entries,
+                    ttl=self.ttl)
+
+
+_MEMOS = {}
+_MEMOS_LOCK = threading.Lock()
+
+
+def get_stage_memo(name):
+    """process wide memo for one of the /search stages in MEMO_TTLS"""
+    with _MEMOS_LOCK:
+        if name not in _MEMOS:
+            path = os.path.join(MEMO_DIRECTORY, f'{name}.db') if MEMO_DIRECTORY else None
+            _MEMOS[name] = StageMemo(name, path=path, ttl=MEMO_TTLS[name], max_entries=MEMO_MAX_ENTRIES)
+        return _MEMOS[name]
+
+
+def memo_stats():
+    return {name: get_stage_memo(name).stats() for name in MEMO_TTLS}
@@ -0,0 +1,88 @@
+import os
+import numpy as np
+
+from ..qa_utils.lexical import BM25Index
+from .embedding import embed_questions
+from .embedding_store import get_embedding_store
+from .utils import embed_abstracts, ABSTRACTS_EMB_DIR
+
+# number of BM25 candidates re-scored with abstract embeddings, and the weight of the dense score
+RERANK_DENSE_CANDIDATES = int(os.getenv('RERANK_DENSE_CANDIDATES', 30))
+RERANK_DENSE_WEIGHT = float(os.getenv('RERANK_DENSE_WEIGHT', 0.5))
+# two stage pipeline: min question / abstract similarity for a paper to be downloaded, and max papers downloaded
+ABSTRACT_SIMILARITY_CUTOFF = float(os.getenv('ABSTRACT_SIMILARITY_CUTOFF', 0.8))
+ABSTRACT_TOP_N = int(os.getenv('ABSTRACT_TOP_N', 5))
+
+
+def dense_scores(question, unique_ids):
+    """cosine similarity between the question and the stored abstract embedding of each paper (0 if missing)"""
+    store = get_embedding_store(ABSTRACTS_EMB_DIR)
+    question_embedding = np.asarray(embed_questions([question], use_modal=os.environ['MODAL'])[0], dtype=np.float32)
+    question_embedding /= np.linalg.norm(question_embedding) + 1e-10
+
+    scores = np.zeros(len(unique_ids))
+    for i, unique_id in enumerate(unique_ids):
+        if unique_id in store:
+            embedding = np.asarray(store.get_embeddings(unique_id)[0], dtype=np.float32)
+            scores[i] = embedding @ question_embedding / (np.linalg.norm(embedding) + 1e-10)
+    return scores
+
+
+def local_rerank(question, top_k, parsed_arxiv_results, dense=False, dense_candidates=RERANK_DENSE_CANDIDATES,
+                 dense_weight=RERANK_DENSE_WEIGHT):
+    """
+    Drop-in replacement for cohere_rerank that runs locally: BM25 over title + abstract, optionally re-scoring
+    the best BM25 candidates with the cosine similarity of their abstract embeddings.
+
+    :param question: user question
+    :param top_k: number of results returned
+    :param parsed_arxiv_results: dict(url=dict(title, summary, ...))
+    :param dense: re-score with abstract embeddings (embeds abstracts not in ABSTRACTS_EMB_DIR yet)
+    :param dense_candidates: number of BM25 candidates re-scored when dense is set
+    :param dense_weight: weight of the cosine similarity, BM25 scores are scaled to [0, 1] before mixing
+    :return: dict(url=content) of the top_k results in ranked order
+    """
+    urls = list(parsed_arxiv_results)
+    if not urls:
+        return {}
+
+    texts = [parsed_arxiv_results[url]["title"] + '  ---  ' + parsed_arxiv_results[url]["summary"] for url in urls]
+    scores = BM25Index(texts).score(question)
+    # stable, ties (e.g. no term overlap at all) keep arXiv's relevance order
+    order = np.argsort(-scores, kind='stable')
+
+    if dense:
+        candidates = order[:max(dense_candidates, top_k)]
+        embed_abstracts({urls[i]: parsed_arxiv_results[urls[i]] for i in candidates})
+        lexical = scores[candidates] / (scores.max() or 1)
+        semantic = dense_scores(question, [urls[i].split('/')[-1] for i in candidates])
+        mixed = (1 - dense_weight) * lexical + dense_weight * semantic
+        order = candidates[np.argsort(-mixed, kind='stable')]
+
+    return {urls[i]: parsed_arxiv_results[urls[i]] for i in order[:top_k]}
+
+
+def select_by_abstract(question, candidates, cutoff=ABSTRACT_SIMILARITY_CUTOFF, top_n=ABSTRACT_TOP_N, min_papers=1):
+    """
+    First stage of the two stage pipeline: keep the candidates whose abstract embedding is similar enough to the
+    question, so only those are downloaded and embedded in full.
+
+    :param question: user question
+    :param candidates: dict(url=content), e.g. every arXiv result of the search
+    :param cutoff: min cosine similarity between question and abstract
+    :param top_n: max papers kept
+    :param min_papers: papers kept even if they are below the cutoff (the most similar ones)
+    :return: selected dict(url=content) ordered by similarity, dict(url=similarity) of all candidates
+    """
+    urls = list(candidates)
+    if not urls:
+        return {}, {}
+
+    embed_abstracts(candidates)
+    scores = dense_scores(question, [url.split('/')[-1] for url in urls])
+    order = np.argsort(-scores, kind='stable')
+    keep = [i for i in order if scores[i] >= cutoff][:top_n]
+    if len(keep) < min_papers:
+        keep = list(order[:min_papers])
+
+    return {urls[i]: candidates[urls[i]] for i in keep}, {url: round(float(s), 4) for url, s in zip(urls, scores)}
@@ -0,0 +1,142 @@
+import os
+import io
+import gzip
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from ..qa_utils import readers
+
+ROOT_DIRECTORY = os.getenv('ROOT_DIRECTORY', '/test')
+CACHE_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'cache')
+
+# papers whose extracted text is kept in memory, and directory of the compressed on disk copies ('' disables it)
+TEXT_CACHE_SIZE = int(os.getenv('TEXT_CACHE_SIZE', 32))
+TEXT_CACHE_DIRECTORY = os.getenv('TEXT_CACHE_DIRECTORY', os.path.join(CACHE_DIRECTORY, 'paper_text'))
+
+
+def file_digest(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class PaperTextCache:
+    """
+    Extracted page texts of pdfs. The last `maxsize` papers are kept in memory by arXiv id (checked against the
+    file's size and mtime), and every extraction is written to `directory` under the sha256 of the pdf, so the
+    text survives restarts and is shared between processes.
+
+    Both keep the pages gzipped, one json string per line, and pages are decoded one at a time: a reader holds
+    the compressed paper and the page it is on, never the whole text.
+    """
+
+    def __init__(self, maxsize=32, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._entries = OrderedDict()  # unique_id -> (size, mtime, gzipped pages)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _disk_path(self, digest):
+        return os.path.join(self.directory, digest + '.jsonl.gz')
+
+    @staticmethod
+    def _decode(data):
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _remember(self, unique_id, stat, data):
+        with self._lock:
+            self._entries[unique_id] = (stat.st_size, stat.st_mtime_ns, data)
+            self._entries.move_to_end(unique_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def iter_pages(self, path):
+        """Yield the page texts of the pdf at path, extracting them (once) if they aren't cached"""
+        unique_id = os.path.split(path)[1][:-4]
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(unique_id)
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                self._entries.move_to_end(unique_id)
+                self.hits += 1
+                data = entry[2]
+            else:
+                data = None
+        if data is not None:
+            yield from self._decode(data)
+            return
+
+        disk_path = self._disk_path(file_digest(path)) if self.directory else None
+        if disk_path is not None and os.path.exists(disk_path):
+            with open(disk_path, 'rb') as f:
+                data = f.read()
+            with self._lock:
+                self.disk_hits += 1
+            self._remember(unique_id, stat, data)
+            yield from self._decode(data)
+            return
+
+        with self._lock:
+            self.misses += 1
+        # compressed as they are extracted and yielded. A reader that stops early (e.g. after the first chunk)
+        # leaves the paper uncached
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+            for page in readers.iter_pdf_pages(path):
+                f.write(json.dumps(page).encode() + b'\n')
+                yield page
+        data = buffer.getvalue()
+        self._remember(unique_id, stat, data)
+        if disk_path is not None:
+            # write to a private temporary file first, other processes may be extracting the same pdf
+            tmp_path = f'{disk_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, disk_path)
+
+    def iter_parse_pdf(self, path, citation, key, chunk_chars=2000, overlap=50):
+        """Same as readers.iter_parse_pdf, from the cached page texts"""
+        unique_id = os.path.split(path)[1][:-4]
+        yield from readers.chunk_pages(self.iter_pages(path), unique_id, citation, key,
+                                       chunk_chars=chunk_chars, overlap=overlap)
+
+    def parse_pdf(self, path, citation, key, chunk_chars=2000, overlap=50):
+        """Same as readers.parse_pdf, from the cached page texts"""
+        splits = []
+        metadatas = []
+        for split, metadata in self.iter_parse_pdf(path, citation, key, chunk_chars=chunk_chars, overlap=overlap):
+            splits.append(split)
+            metadatas.append(metadata)
+        return splits, metadatas
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return dict(hits=self.hits,
+                    disk_hits=self.disk_hits,
+                    misses=self.misses,
+                    hit_rate=round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+                    size=len(self._entries),
+                    maxsize=self.maxsize,
+                    on_disk=bool(self.directory))
+
+
+_TEXT_CACHE = None
+
+
+def get_text_cache():
+    """process wide cache used by /chat, pdf ingestion and get_citations"""
+    global _TEXT_CACHE
+    if _TEXT_CACHE is None:
+        _TEXT_CACHE = PaperTextCache(maxsize=TEXT_CACHE_SIZE, directory=TEXT_CACHE_DIRECTORY or None)
+    return _TEXT_CACHE
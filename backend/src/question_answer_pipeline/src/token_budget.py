@@ -0,0 +1,179 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from ..qa_utils.qaprompts import summary_prompt, qa_prompt
+from .ingest import parse_pdf_files
+from .embedding_store import get_embedding_store
+from .utils import FILE_DIRECTORY, PDF_EMB_DIR
+
+# estimated tokens a /search request may use (embedding + summarization + qa), 0 disables the planner
+TOKEN_BUDGET = int(os.getenv('TOKEN_BUDGET', 0))
+# chunk token counts kept in memory, and threads used to tokenize
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv('TOKEN_COUNT_CACHE_SIZE', 100000))
+TOKENIZE_THREADS = int(os.getenv('TOKENIZE_THREADS', 8))
+# rough lengths of the generated summaries / answer
+SUMMARY_OUTPUT_TOKENS = 100
+QA_OUTPUT_TOKENS = 200
+# $ per 1k tokens. Chunks are embedded with the local INSTRUCTOR model, so embedding tokens are free
+TOKEN_PRICES = {'embedding': 0.0, 'summarization': 0.002, 'qa': 0.002}
+
+
+class TokenCounter:
+    """
+    tiktoken counts of texts, cached by a hash of the text. Texts not seen before are tokenized in one batch
+    across threads (tiktoken releases the GIL).
+    """
+
+    def __init__(self, encoding_name='cl100k_base', maxsize=100000, num_threads=8, encoding=None):
+        if encoding is None:
+            import tiktoken
+            encoding = tiktoken.get_encoding(encoding_name)
+        self.encoding = encoding
+        self.maxsize = maxsize
+        self.num_threads = num_threads
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).digest()
+
+    def count_many(self, texts):
+        """:return: list with the number of tokens of each text"""
+        keys = [self._key(text) for text in texts]
+        counts = [None] * len(texts)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._counts:
+                    self._counts.move_to_end(key)
+                    counts[i] = self._counts[key]
+            self.hits += sum(c is not None for c in counts)
+
+        missing = {keys[i]: texts[i] for i, c in enumerate(counts) if c is None}
+        if missing:
+            # encode_ordinary: chunks may contain special token text like <|endoftext|>
+            encoded = self.encoding.encode_ordinary_batch(list(missing.values()), num_threads=self.num_threads)
+            new_counts = dict(zip(missing, map(len, encoded)))
+            with self._lock:
+                self.misses += len(missing)
+                for key, count in new_counts.items():
+                    self._counts[key] = count
+                    self._counts.move_to_end(key)
+                while len(self._counts) > self.maxsize:
+                    self._counts.popitem(last=False)
+            counts = [new_counts[key] if c is None else c for key, c in zip(keys, counts)]
+        return counts
+
+    def count(self, text):
+        return self.count_many([text])[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=round(self.hits / lookups, 4) if lookups else None,
+                    size=len(self._counts),
+                    maxsize=self.maxsize)
+
+
+_COUNTER = None
+
+
+def get_token_counter():
+    global _COUNTER
+    if _COUNTER is None:
+        _COUNTER = TokenCounter(maxsize=TOKEN_COUNT_CACHE_SIZE, num_threads=TOKENIZE_THREADS)
+    return _COUNTER
+
+
+def paper_chunks(relevant_documents, chunk_chars=1100, overlap=100):
+    """
+    Chunks of each paper, as they are (or will be) stored: from the embedding store when the paper is embedded
+    already, parsed from the downloaded pdf otherwise.
+
+    :return: dict(url=(chunks or None if the pdf can't be parsed, True if the paper still has to be embedded))
+    """
+    store = get_embedding_store(PDF_EMB_DIR)
+    chunks = {}
+    jobs = []
+    for url, entry in relevant_documents.items():
+        unique_id = url.split('/')[-1]
+        if unique_id in store:
+            chunks[url] = (store.get(unique_id)[0], False)
+        else:
+            jobs.append((url, (os.path.join(FILE_DIRECTORY, unique_id + '.pdf'), entry['citation'], entry['key'])))
+
+    # parsed text is cached, so embedding these papers later doesn't parse them again
+    doc_splits, _, _ = parse_pdf_files([job for _, job in jobs], chunk_chars=chunk_chars, overlap=overlap)
+    for (url, _), splits in zip(jobs, doc_splits):
+        chunks[url] = (splits, True)
+    return chunks
+
+
+def estimate_tokens(question_tokens, papers, k=25, max_sources=10, counter=None):
+    """
+    Token estimate of answering a question from a set of papers.
+
+    :param question_tokens: tokens of the question
+    :param papers: list of dict(chunks=number of chunks, tokens=tokens of all chunks, new=needs embedding)
+    :param k: chunks retrieved and summarized
+    :param max_sources: summaries used for the answer
+    :return: dict(embedding, summarization, qa, total, usd)
+    """
+    counter = counter or get_token_counter()
+    n_chunks = sum(p['chunks'] for p in papers)
+    chunk_tokens = sum(p['tokens'] for p in papers)
+    summarized = min(k, n_chunks)
+    avg_chunk_tokens = chunk_tokens / n_chunks if n_chunks else 0
+
+    estimate = dict(
+        embedding=sum(p['tokens'] for p in papers if p['new']),
+        summarization=round(summarized * (counter.count(summary_prompt.template) + question_tokens
+                                          + avg_chunk_tokens + SUMMARY_OUTPUT_TOKENS)),
+        qa=(counter.count(qa_prompt.template) + question_tokens
+            + min(max_sources, summarized) * SUMMARY_OUTPUT_TOKENS + QA_OUTPUT_TOKENS) if summarized else 0,
+    )
+    estimate['total'] = sum(estimate.values())
+    estimate['usd'] = round(sum(estimate[stage] * price / 1000 for stage, price in TOKEN_PRICES.items()), 5)
+    return estimate
+
+
+def plan_token_budget(question, relevant_documents, budget=TOKEN_BUDGET, k=25, max_sources=10):
+    """
+    Drop the lowest ranked papers until the estimated tokens of the request fit in budget (the best paper is
+    always kept).
+
+    :param relevant_documents: dict(url=arxiv entry) in rank order, pdfs downloaded
+    :return: kept dict(url=arxiv entry), plan dict(budget, papers, estimate, dropped)
+    """
+    counter = get_token_counter()
+    question_tokens = counter.count(question)
+
+    parsed = paper_chunks(relevant_documents)
+    # all chunks in one batch so they are tokenized across threads. unparsable pdfs (None) are skipped when
+    # embedding anyway and count as empty
+    counts = counter.count_many([chunk for chunks, _ in parsed.values() for chunk in chunks or []])
+    papers = {}
+    start = 0
+    for url, (chunks, new) in parsed.items():
+        n = len(chunks or [])
+        papers[url] = dict(chunks=n, tokens=sum(counts[start:start + n]), new=new and n > 0)
+        start += n
+
+    kept = []
+    for url in relevant_documents:
+        estimate = estimate_tokens(question_tokens, [papers[u] for u in kept + [url]], k, max_sources, counter)
+        if kept and estimate['total'] > budget:
+            break
+        kept.append(url)
+    estimate = estimate_tokens(question_tokens, [papers[u] for u in kept], k, max_sources, counter)
+
+    plan = dict(budget=budget,
+                papers=papers,
+                estimate=estimate,
+                dropped=[url for url in relevant_documents if url not in kept])
+    return {url: relevant_documents[url] for url in kept}, plan
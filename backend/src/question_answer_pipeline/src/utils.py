@@ -4,9 +4,16 @@ from InstructorEmbedding import INSTRUCTOR
 import json
 from tqdm import tqdm
 import re
-from ..qa_utils import readers, Docs
-import pickle
+import threading
+import asyncio
+import numpy as np
+from ..qa_utils import Docs
+from ..qa_utils.indexes import IndexSpec
 from .embedding import embed_questions, embed_document
+from .ingest import parse_pdf_files
+from .embedding_store import get_embedding_store
+from .downloader import download_pdfs, get_semaphore, run_downloads
+from .text_cache import get_text_cache
 from langchain.chains import LLMChain
 from langchain.prompts.chat import HumanMessagePromptTemplate, ChatPromptTemplate, SystemMessage
 from langchain.chat_models import ChatOpenAI
@@ -25,28 +32,54 @@ ABSTRACTS_EMB_DIR = os.path.join(ROOT_DIRECTORY, 'abstract_embeddings')
 # save docs file related directory (might not be needed for this application)
 DOCS_FILE = os.path.join(ROOT_DIRECTORY, 'pdf_docs')
 
-
-async def qa_pdf(question, k, parsed_arxiv_results, question_embeddings=None):
+# chunks scoring below this fraction of the best BM25 score are not summarized. Unset disables the pre-filter
+LEXICAL_PREFILTER_THRESHOLD = float(os.environ['LEXICAL_PREFILTER_THRESHOLD']) \
+    if os.getenv('LEXICAL_PREFILTER_THRESHOLD') else None
+# stop summarizing once enough relevant chunks came back, instead of waiting for the slowest call
+SUMMARY_EARLY_EXIT = os.getenv('SUMMARY_EARLY_EXIT', 'false').lower() == 'true'
+# tokens of paper text sent with each /chat question in retrieval mode
+CHAT_TOKEN_BUDGET = int(os.getenv('CHAT_TOKEN_BUDGET', 3000))
+# faiss index of the pdf corpus, e.g. 'flat', 'ivf,nlist=1024,nprobe=16', 'hnsw,m=32,ef_search=64' (see IndexSpec).
+# codec=float16/int8/pq compresses the in-memory index, rescore=n re-scores n * fetch_k candidates with the float32
+# vectors of the embedding store. trained indexes are kept in INDEX_DIRECTORY, until the corpus has enough vectors to
+# train one on (39 * nlist for ivf, 256 for pq) it is searched as a flat index.
+# The server restricts pdf corpus searches to the request's papers: up to exact_rows of their chunks (default 1000)
+# are scanned exactly with the embedding store vectors, more are searched in the ivf / hnsw index restricted to them
+# (exact_rows=0 tries the index first for every search).
+PDF_INDEX_SPEC = IndexSpec.parse(os.getenv('PDF_INDEX', 'flat'))
+
+
+async def qa_pdf(question, k, parsed_arxiv_results, question_embeddings=None, on_evidence=None, early_exit=None,
+                 keep_rank_order=True):
     """
     qa on pdf documents
     :param question_embeddings: embedded question
+    :param on_evidence: called with (doc, summary) for each relevant chunk summary as soon as it is available
+    :param early_exit: cancel outstanding chunk summaries once enough relevant ones are collected,
+        None for SUMMARY_EARLY_EXIT
+    :param keep_rank_order: with early_exit, order the evidence by search rank instead of completion
     :param k:
     :param parsed_arxiv_results:
     :param question:
     :return: nearest neighbor information: answer.contexts = dict(url= (key, citation, llm_summary, chunked_text))
     """
-    # create a docstore that stays updated with the filesystem
-    # it is rebuilt if pdfs are deleted and items are added when new files are detected
-    docs = from_pdfs_docstore(parsed_arxiv_results)
+    # process wide docstore, new pdfs are embedded and added to it.
+    # the search is restricted to the papers of this request
+    # parsing and embedding are blocking, run them in a thread so the event loop keeps serving other requests
+    docs = await asyncio.to_thread(from_pdfs_docstore, parsed_arxiv_results)
+    unique_ids = set(d.split('/')[-1] for d in parsed_arxiv_results.keys())
 
     queries = [question]
 
     if question_embeddings is None:
         print('embedding questions')
-        question_embeddings = embed_questions(queries, use_modal=os.environ['MODAL'])
+        question_embeddings = await asyncio.to_thread(embed_questions, queries, use_modal=os.environ['MODAL'])
 
     print('getting answers')
-    answers = await make_query(docs, queries, question_embeddings, k=k, vector_search_only=False)
+    answers = await make_query(docs, queries, question_embeddings, k=k, vector_search_only=False,
+                               unique_ids=unique_ids, prefilter_threshold=LEXICAL_PREFILTER_THRESHOLD,
+                               early_exit=SUMMARY_EARLY_EXIT if early_exit is None else early_exit,
+                               keep_rank_order=keep_rank_order, on_evidence=on_evidence)
 
     for answer in answers:
         print('-' * 20)
@@ -66,12 +99,12 @@ async def qa_abstracts(question, k, parsed_arxiv_results=None):
         nearest neighbors as dict(url=(key, citation, LLM summary related to question, original_text))
         question_embedding: embedded question
     """
-    docs = from_arxiv_docstore(parsed_arxiv_results)
+    docs = await asyncio.to_thread(from_arxiv_docstore, parsed_arxiv_results)
 
     queries = [question]
 
     print('embedding question')
-    question_embeddings = embed_questions(queries, use_modal=os.environ['MODAL'])
+    question_embeddings = await asyncio.to_thread(embed_questions, queries, use_modal=os.environ['MODAL'])
 
     print('getting answers')
     answers = await make_query(docs, queries, question_embeddings, k=k, vector_search_only=True)
@@ -130,22 +163,32 @@ def parse_arxiv_json(arxiv_results):
         key = f"{authors_list[0]}, {year}"
 
         summary = arxiv_res['summary']
-        download_handle = arxiv_res['download_handle']
+        download_handle = arxiv_res.get('download_handle')
+        pdf_url = arxiv_res.get('pdf_url')
 
         url_parsed_json[url] = {'summary': summary, 'citation': citation, 'key': key, "title": title,
                                 "authors": authors, "journal": source, 'download_handle': download_handle,
-                                'unique_id': unique_id}
+                                'pdf_url': pdf_url, 'unique_id': unique_id}
     return url_parsed_json
 
 
+# embedding runs in worker threads; serialize it so concurrent requests don't embed (and store) the same paper twice
+_EMBED_LOCK = threading.Lock()
+
+
 def embed_abstracts(parsed_arxiv_results):
     """
 
     :param parsed_arxiv_results: dictionary keys: entry_ids, values: dict that describes document
     :return:
     """
-    os.makedirs(ABSTRACTS_EMB_DIR, exist_ok=True)
-    existing_embeddings = set([i[:-4] for i in os.listdir(ABSTRACTS_EMB_DIR)])
+    with _EMBED_LOCK:
+        _embed_abstracts(parsed_arxiv_results)
+
+
+def _embed_abstracts(parsed_arxiv_results):
+    store = get_embedding_store(ABSTRACTS_EMB_DIR)
+    existing_embeddings = store.ids()
 
     arxiv_entries = set([i.split('/')[-1] for i in parsed_arxiv_results.keys()])
     new_embeddings = arxiv_entries - existing_embeddings
@@ -180,15 +223,8 @@ def embed_abstracts(parsed_arxiv_results):
         file_embeddings, num_tokens = [doc_embeddings[0]['file_embeddings'][i]], [doc_embeddings[0]['num_tokens'][i]]
 
         # save text chunks, file embeddings, metadatas, and num_tokens for each
-        save_dict = [splits, file_embeddings, metadata, num_tokens]
-
-        path = os.path.join(ABSTRACTS_EMB_DIR, entry_id.split('/')[-1] + '.pkl')
-        print(f'Saving abstract embeddings to path: {path}')
-
-        # save embeddings
-        with open(path, 'wb') as fp:
-            print(path)
-            pickle.dump(save_dict, fp)
+        print(f'Saving abstract embeddings to store: {ABSTRACTS_EMB_DIR}')
+        store.add(entry_id.split('/')[-1], [splits], file_embeddings, metadata, num_tokens)
 
 
 def embed_pdf_files(parsed_arxiv_results):
@@ -197,9 +233,14 @@ def embed_pdf_files(parsed_arxiv_results):
     :param parsed_arxiv_results:
     :return:
     """
-    # directory to save embeddings
-    os.makedirs(PDF_EMB_DIR, exist_ok=True)
-    existing_embeddings = set([i[:-4] for i in os.listdir(PDF_EMB_DIR)])
+    with _EMBED_LOCK:
+        _embed_pdf_files(parsed_arxiv_results)
+
+
+def _embed_pdf_files(parsed_arxiv_results):
+    # store to save embeddings
+    store = get_embedding_store(PDF_EMB_DIR)
+    existing_embeddings = store.ids()
 
     arxiv_entries = set([i.split('/')[-1] for i in parsed_arxiv_results.keys()])
     new_embeddings = arxiv_entries - existing_embeddings
@@ -207,24 +248,27 @@ def embed_pdf_files(parsed_arxiv_results):
 
     to_process = {k: v for k, v in parsed_arxiv_results.items() if k.split('/')[-1] in new_embeddings}
 
-    parse_pdf = readers.parse_pdf
-    doc_splits = []
-    doc_metadatas = []
-    for entry_id, doc_info in tqdm(to_process.items()):
+    jobs = []
+    for entry_id, doc_info in to_process.items():
         # get file path for file f
         f = entry_id.split('/')[-1] + '.pdf'
         f_path = os.path.join(FILE_DIRECTORY, f)
 
-        print(f'Reading and Embedding: {f} at {f_path}')
-
-        citation = doc_info['citation']
-        key = doc_info['key']
+        print(f'Reading: {f} at {f_path}')
 
         # get texts (splits) and metadata (citation, key, key_with_page)
+        jobs.append((f_path, doc_info['citation'], doc_info['key']))
+
+    # pdf text extraction is cpu bound, parse all new files across processes before embedding
+    start = datetime.now()
+    parsed_splits, parsed_metadatas, _ = parse_pdf_files(jobs, chunk_chars=1100, overlap=100)
+    print(f'Parsed {len(jobs)} pdfs in {(datetime.now() - start).total_seconds():.3}s')
 
-        splits, metadatas = parse_pdf(f_path, key=key, citation=citation, chunk_chars=1100, overlap=100)
-        doc_splits.append(splits)
-        doc_metadatas.append(metadatas)
+    # files that failed to parse are skipped, they will be retried on the next request
+    parsed = [splits is not None for splits in parsed_splits]
+    to_process = {k: v for (k, v), ok in zip(to_process.items(), parsed) if ok}
+    doc_splits = [splits for splits in parsed_splits if splits is not None]
+    doc_metadatas = [metadatas for metadatas in parsed_metadatas if metadatas is not None]
 
     if doc_splits:
         doc_embeddings = embed_document(doc_splits, use_modal=os.environ['MODAL'])
@@ -236,47 +280,51 @@ def embed_pdf_files(parsed_arxiv_results):
         file_embeddings, num_tokens = doc_embeddings[i]['file_embeddings'], doc_embeddings[i]['num_tokens']
 
         # save text chunks, file embeddings, metadatas, and num_tokens for each
-        save_dict = [doc_splits[i], file_embeddings, doc_metadatas[i], num_tokens]
-
-        path = os.path.join(PDF_EMB_DIR, entry_id.split('/')[-1] + '.pkl')
+        print(f'Saving pdf embeddings to store: {PDF_EMB_DIR}')
+        store.add(entry_id.split('/')[-1], doc_splits[i], file_embeddings, doc_metadatas[i], num_tokens)
 
-        print(f'Saving pdf embeddings to path: {path}')
-        # save embeddings
-        with open(path, 'wb') as fp:
-            pickle.dump(save_dict, fp)
 
-
-def create_docs(relevant_documents, dir):
+def create_docs(relevant_documents, store):
     """
 
     :param relevant_documents: unique id for documents from search
+    :param store: EmbeddingStore holding the documents
     :return:
     """
     print('Building DOCS')
     docs = Docs()
+    add_to_docs(docs, relevant_documents, store)
 
-    for no_files, f in enumerate(relevant_documents):
-        file_path = os.path.join(dir, f)
+    return docs
 
-        with open(file_path, 'rb') as fb:
-            processed_file = pickle.load(fb)
 
-        filename = f[:-4]
+def add_to_docs(docs, relevant_documents, store):
+    """
+    Add documents from the store that are not already in docs
 
-        # parse processed file
-        summary = processed_file[0]
-        file_embeddings = processed_file[1]
-        metadata = processed_file[2]  # dict(citation=citation, dockey= key, key=f"{key} pages {pg}",)
+    :param docs: Docs class
+    :param relevant_documents: unique id for documents
+    :param store: EmbeddingStore holding the documents
+    :return: number of documents added
+    """
+    to_add = []
+    for filename in relevant_documents:
+        if filename in docs.docs:
+            continue
+        if filename not in store:
+            # e.g. the pdf failed to download or parse
+            print(f'No embeddings for {filename}, skipping')
+            continue
 
-        # add to doc class
-        docs.add_from_embeddings(path=filename,
-                                 texts=summary,
-                                 text_embeddings=file_embeddings,
-                                 metadatas=metadata)
+        # texts, (chunks, dim) view of the stored vectors, metadata dict(citation=citation, dockey= key, key=f"{key} pages {pg}",)
+        texts, file_embeddings, metadata, _ = store.get(filename)
+        to_add.append((filename, texts, file_embeddings, metadata))
 
-        print(f'added {no_files + 1} files to docs')
+    # one bulk add to the index instead of one per document
+    docs.add_many_from_embeddings(to_add)
+    print(f'added {len(to_add)} files to docs')
 
-    return docs
+    return len(to_add)
 
 
 def from_arxiv_docstore(parsed_arxiv_results):
@@ -290,32 +338,62 @@ def from_arxiv_docstore(parsed_arxiv_results):
     embed_abstracts(parsed_arxiv_results)
 
     # create docs class for vector search
-    # embedding filenames for relevant documents
-    rel_docs = [d.split('/')[-1] + '.pkl' for d in parsed_arxiv_results.keys()]
-    docs = create_docs(rel_docs, dir=ABSTRACTS_EMB_DIR)
+    # arxiv ids for relevant documents
+    rel_docs = [d.split('/')[-1] for d in parsed_arxiv_results.keys()]
+    docs = create_docs(rel_docs, store=get_embedding_store(ABSTRACTS_EMB_DIR))
 
     return docs
 
 
+_PDF_CORPUS = None
+_PDF_CORPUS_LOCK = threading.Lock()
+
+
+def get_pdf_corpus():
+    """
+    Process wide Docs holding every embedded pdf. Built once from the embedding store and then updated
+    incrementally, requests search it restricted to their own papers (Docs.query(unique_ids=...)).
+    """
+    global _PDF_CORPUS
+    with _PDF_CORPUS_LOCK:
+        if _PDF_CORPUS is None:
+            store = get_embedding_store(PDF_EMB_DIR)
+            print(f'Loading {len(store)} papers into the pdf corpus')
+            corpus = Docs(name='pdf_corpus', index_spec=PDF_INDEX_SPEC, trained_index_path=INDEX_DIRECTORY,
+                          full_vectors=store.get_embeddings)
+            add_to_docs(corpus, sorted(store.ids()), store)
+            # published loaded, so pdf_corpus_stats never sees (or waits on) a corpus being filled
+            _PDF_CORPUS = corpus
+        return _PDF_CORPUS
+
+
+def pdf_corpus_stats():
+    """index stats of the pdf corpus, None until it is loaded. Doesn't wait for a load or an add in progress"""
+    corpus = _PDF_CORPUS
+    return corpus.index_stats() if corpus is not None else None
+
+
 def from_pdfs_docstore(parsed_arxiv_results):
     """
-    Build from local directory of pdfs. For reference from PubFind, might not be needed here.
+    Embed any new pdfs and add them to the process wide pdf corpus.
 
     :param parsed_arxiv_results: parsed json response from arxiv search
-    :return: docs class
+    :return: docs class (shared between requests, search it with unique_ids)
     """
 
     embed_pdf_files(parsed_arxiv_results)
 
-    # create docs class for vector search
-    # embedding filenames for relevant documents
-    rel_docs = [d.split('/')[-1] + '.pkl' for d in parsed_arxiv_results.keys()]
-    docs = create_docs(rel_docs, dir=PDF_EMB_DIR)
+    docs = get_pdf_corpus()
+    # arxiv ids for relevant documents
+    rel_docs = [d.split('/')[-1] for d in parsed_arxiv_results.keys()]
+    with _PDF_CORPUS_LOCK:
+        add_to_docs(docs, rel_docs, store=get_embedding_store(PDF_EMB_DIR))
 
     return docs
 
 
-async def make_query(docs, queries, question_embeddings, k=5, vector_search_only=False):
+async def make_query(docs, queries, question_embeddings, k=5, vector_search_only=False, unique_ids=None,
+                     prefilter_threshold=None, early_exit=False, keep_rank_order=True, on_evidence=None):
     """
 
     :param docs:
@@ -323,6 +401,11 @@ async def make_query(docs, queries, question_embeddings, k=5, vector_search_only
     :param question_embeddings:
     :param k:
     :param vector_search_only:
+    :param unique_ids: restrict the vector search to these documents
+    :param prefilter_threshold: lexical pre-filter threshold for chunks before summarization, None disables it
+    :param early_exit: cancel outstanding chunk summaries once enough relevant ones are collected
+    :param keep_rank_order: with early_exit, order the evidence by search rank instead of completion
+    :param on_evidence: called with (doc, summary) for each relevant chunk summary as it completes
     :return: Answer.contexts: Contains results from nearest neighbors search:
                                 dict(url=(key, citation, summary, chunked_text))
     """
@@ -333,7 +416,12 @@ async def make_query(docs, queries, question_embeddings, k=5, vector_search_only
                                         embedding=embedding,
                                         length_prompt=length_prompt,
                                         k=k,
-                                        vector_search_only=vector_search_only)
+                                        vector_search_only=vector_search_only,
+                                        unique_ids=unique_ids,
+                                        prefilter_threshold=prefilter_threshold,
+                                        early_exit=early_exit,
+                                        keep_rank_order=keep_rank_order,
+                                        on_evidence=on_evidence)
                                         )
 
     return answers
@@ -342,15 +430,96 @@ async def make_query(docs, queries, question_embeddings, k=5, vector_search_only
 def download_pdfs_from_arxiv(relevant_arxiv_results):
     """
     :param: relevant_arxiv_results: arxiv results object from nearest_neighbor search
-    :return:
+    :return: download report, dict(filename=dict(seconds, bytes, attempts, skipped, error))
     """
-    os.makedirs(FILE_DIRECTORY, exist_ok=True)
-    for result in relevant_arxiv_results:
-        filename = result['entry_id'].split('/')[-1] + '.pdf'
-        filepath = os.path.join(FILE_DIRECTORY, filename)
-        if not os.path.exists(filepath):
+    entries = [(result['entry_id'].split('/')[-1] + '.pdf', result) for result in relevant_arxiv_results]
+    return run_downloads(_download_entries(entries))
+
+
+async def _download_entries(entries):
+    """
+    Download (filename, arxiv result) pairs into FILE_DIRECTORY concurrently. Results without a pdf_url, or whose
+    pdf_url download failed, fall back to the arxiv download_handle (in a thread so the event loop isn't blocked),
+    under the same download slots as the direct downloads.
+    """
+    jobs = {}
+    handles = {}
+    for filename, result in entries:
+        if os.path.exists(os.path.join(FILE_DIRECTORY, filename)):
+            continue
+        if result.get('pdf_url'):
+            jobs[filename] = result['pdf_url']
+        if result.get('download_handle') is not None:
+            handles[filename] = result['download_handle']
+
+    async def fallback(filename):
+        async with get_semaphore():
             print(f"downloading: {filename}")
-            result['download_handle'](FILE_DIRECTORY, filename=filename)
+            start = datetime.now()
+            try:
+                await asyncio.to_thread(handles[filename], dirpath=FILE_DIRECTORY, filename=filename)
+                error = None
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                print(f"FAILED to download {filename} with the arxiv client: {error}")
+            return dict(seconds=(datetime.now() - start).total_seconds(), attempts=1, skipped=False, error=error,
+                        bytes=os.path.getsize(os.path.join(FILE_DIRECTORY, filename)) if error is None else None)
+
+    async def download(filename):
+        # one download_pdfs call per paper: the client and download slots are shared by the loop anyway, and a
+        # failed paper moves on to its fallback without waiting for the others
+        if filename in jobs:
+            result = (await download_pdfs({filename: jobs[filename]}, FILE_DIRECTORY))[filename]
+            if result['error'] is None or filename not in handles:
+                return result
+        return await fallback(filename)
+
+    filenames = list(jobs) + [filename for filename in handles if filename not in jobs]
+    start = datetime.now()
+    report = dict(zip(filenames, await asyncio.gather(*[download(filename) for filename in filenames])))
+    print(f'Downloaded {len(report)} pdfs in {(datetime.now() - start).total_seconds():.3}s')
+
+    return report
+
+
+def select_chat_context(question, unique_id, token_budget=CHAT_TOKEN_BUDGET):
+    """
+    Most relevant chunks of an embedded paper for a question, under a token budget and in reading order.
+
+    :param question: user question
+    :param unique_id: arxiv id of the paper
+    :param token_budget: max tokens of the selected chunks, counted with the tiktoken encoding of the token planner
+        (not the INSTRUCTOR counts stored with the embeddings, which include the instruction)
+    :return: context text, number of tokens. (None, 0) if the paper has no stored chunk embeddings
+    """
+    from .token_budget import get_token_counter  # token_budget imports this module
+
+    store = get_embedding_store(PDF_EMB_DIR)
+    if unique_id not in store:
+        return None, 0
+
+    texts, embeddings, metadatas, _ = store.get(unique_id)
+    # the chunks as they are sent
+    chunks = [f"[{metadata['key']}] {text}" for text, metadata in zip(texts, metadatas)]
+    num_tokens = get_token_counter().count_many(chunks)
+    question_embedding = np.asarray(embed_questions([question], use_modal=os.environ['MODAL'])[0], dtype=np.float32)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scores = embeddings @ question_embedding / (np.linalg.norm(embeddings, axis=1)
+                                                * np.linalg.norm(question_embedding) + 1e-10)
+
+    selected = []
+    used = 0
+    for i in np.argsort(-scores):
+        if used + num_tokens[i] > token_budget:
+            continue  # a shorter chunk further down may still fit
+        selected.append(i)
+        used += num_tokens[i]
+
+    if not selected:
+        return None, 0
+    selected.sort()
+    context = '\n\n'.join(chunks[i] for i in selected)
+    return context, used
 
 
 def get_anthropic_response(question, splits):
@@ -426,10 +595,12 @@ def get_citations(list_of_filenames):
     chat_prompt = ChatPromptTemplate.from_messages([system_message, citation_prompt])
     cite_chain = LLMChain(prompt=chat_prompt, llm=llm)
 
-    # peak first chunk
+    # peak first chunk, only the pages it needs are extracted
     filename_citation = {}
     for path in list_of_filenames:
-        texts, _ = readers.parse_pdf(path, "", "", chunk_chars=5000, peak=True)
+        chunks = get_text_cache().iter_parse_pdf(path, "", "", chunk_chars=5000)
+        texts, _ = next(chunks, ("", None))
+        chunks.close()
         citation = cite_chain.run(text=texts)
 
         if len(citation) < 3 or "Unknown" in citation or "insufficient" in citation:
@@ -450,7 +621,7 @@ def compare_object_with_dir(docs):
     """
     # check if there are files missing from docs
     files_in_docs = set(docs.docs)
-    embeddings_in_directory = set([f[:-4] for f in os.listdir(PDF_EMB_DIR) if f[-3:] == 'pkl'])
+    embeddings_in_directory = get_embedding_store(PDF_EMB_DIR).ids()
 
     return embeddings_in_directory.difference(files_in_docs)
 
@@ -476,50 +647,20 @@ def grab_key(citation):
     return f"{author}{year}"
 
 
-def files_for_search(file_directory, delete_remove=True):
+def download_relevant_documents(relevant_documents):
     """
-
-    :param file_directory:
-    :param delete_remove:
-    :return:
-        files_not_embedded: str (filename)
-        files_removed: bool
+    :param: relevant_arxiv_results: arxiv results object from nearest_neighbor search
+    :return: download report, dict(filename=dict(seconds, bytes, attempts, skipped, error))
     """
-    # create embeddings directory if needed
-    emb_dir = PDF_EMB_DIR
-    if not os.path.exists(emb_dir):
-        os.makedirs(emb_dir)
-
-    files = [f[:-4] for f in os.listdir(file_directory)
-             if f[-3:] == 'pdf']
-
-    embedded_files = [f[:-4] for f in os.listdir(emb_dir) if f[-3:] == 'pkl']
+    return run_downloads(download_relevant_documents_async(relevant_documents))
 
-    files_not_embedded = [f + '.pdf' for f in files if f not in embedded_files]
 
-    # check if pdfs were removed. If so then we have to remove the embedding file as well
-    files_embedded_but_no_longer_present = [f + '.pkl' for f in embedded_files if f not in files]
-
-    files_removed = False
-    if delete_remove and files_embedded_but_no_longer_present:
-        files_removed = True
-        print('Deleting')
-        print(files_embedded_but_no_longer_present)
-        for f in files_embedded_but_no_longer_present:
-            remove_path = os.path.join(PDF_EMB_DIR, f)
-            os.remove(remove_path)
-
-    return files_not_embedded, files_removed
-
-def download_relevant_documents(relevant_documents):
+async def download_relevant_documents_async(relevant_documents):
     """
+    Concurrent version of download_relevant_documents for use inside the event loop.
+
     :param: relevant_arxiv_results: arxiv results object from nearest_neighbor search
-    :return:
+    :return: download report, dict(filename=dict(seconds, bytes, attempts, skipped, error))
     """
-    # os.makedirs(FILE_DIRECTORY, exist_ok=True)
-    for rlv in relevant_documents.values():
-        filename = rlv['unique_id'] + '.pdf'
-        pdf_dir = os.path.join(os.getenv("ROOT_DIRECTORY"), "pdfs")
-        filepath = os.path.join(pdf_dir, filename)
-        if not os.path.exists(filepath):
-            rlv['download_handle'](dirpath=pdf_dir, filename=filename)
\ No newline at end of file
+    entries = [(rlv['unique_id'] + '.pdf', rlv) for rlv in relevant_documents.values()]
+    return await _download_entries(entries)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
 from .schemas import SearchItem, Chat
 from fastapi.middleware.cors import CORSMiddleware
 import arxiv
@@ -7,11 +8,28 @@ from tqdm import tqdm
 import openai
 import os
 load_dotenv()
-import datetime
-from question_answer_pipeline.src.utils import qa_abstracts, qa_pdf, parse_arxiv_json, download_relevant_documents, get_anthropic_response
-from question_answer_pipeline.qa_utils.readers import parse_pdf
+import json
+import time
+import asyncio
+import traceback
+from question_answer_pipeline.src.embedding import warm_up_models, embedding_status, on_warm_up_done
+from question_answer_pipeline.src.embedding_cache import get_question_cache, get_chunk_cache, normalize_question
+from question_answer_pipeline.src.memo import get_stage_memo, memo_stats
+from question_answer_pipeline.src.utils import qa_abstracts, qa_pdf, parse_arxiv_json, download_relevant_documents_async, get_anthropic_response, select_chat_context, CHAT_TOKEN_BUDGET, pdf_corpus_stats
+from question_answer_pipeline.src.text_cache import get_text_cache
+from question_answer_pipeline.src.downloader import close_client
+from question_answer_pipeline.src.token_budget import plan_token_budget, get_token_counter, TOKEN_BUDGET
+from question_answer_pipeline.src.rerank import local_rerank, select_by_abstract, ABSTRACT_SIMILARITY_CUTOFF, ABSTRACT_TOP_N
 app = FastAPI()
 
+# 'cohere' (remote), 'bm25' or 'bm25_dense' (local, BM25 re-scored with abstract embeddings)
+RERANKER = os.getenv('RERANKER', 'cohere')
+# arXiv results considered by the reranker
+ARXIV_MAX_RESULTS = int(os.getenv('ARXIV_MAX_RESULTS', 100))
+# 'full' downloads and embeds every reranked paper, 'two_stage' first filters all arXiv results on abstract
+# similarity and only reranks (and downloads) the papers that pass
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'full')
+
 origins = [
    "http://192.168.211.:8000",
    "http://127.0.0.1:8000",
@@ -41,7 +59,8 @@ def parse_search_results(results):
             'summary': result.summary,
             'title': result.title,
             "authors": [{'name': author.name} for author in result.authors],
-            'download_handle': result.download_pdf
+            'download_handle': result.download_pdf,
+            'pdf_url': result.pdf_url
         })
         # filename = result.entry_id.split('/')[-1]+'.pdf'
         # filepath = os.path.join(pdf_dir, filename)
@@ -64,7 +83,13 @@ def get_references(parsed_arxiv_results, contexts):
             outputs.append(output)
     return outputs
 
-def search_term_refiner(search_question) -> list:
+async def search_term_refiner(search_question) -> list:
+    memo = get_stage_memo('refiner')
+    memo_key = memo.make_key(normalize_question(search_question))
+    output_queries = memo.get(memo_key)
+    if output_queries is not None:
+        return output_queries
+
     openai.api_key  = os.getenv('OPENAI_API_KEY')
     system = "You are a Google search master and you will receive a question and try to come up with a better search terms queries based on the question.\
         The possible search keywords will be displayed in a list. The list will need to follow the exact format as the following and only return the list:\
@@ -78,20 +103,52 @@ def search_term_refiner(search_question) -> list:
             "content": "Questions: {}, \n Answer:".format(search_question)}
     )
 
-    completion = openai.ChatCompletion.create(
+    completion = (await openai.ChatCompletion.acreate(
             model="gpt-3.5-turbo",
             messages=message,
             temperature=0,
-            ).choices[0].message["content"]
+            )).choices[0].message["content"]
     output_queries = []
     new_result = completion.split("'")
     for idx, res in enumerate(new_result):
         if idx % 2 == 1:
                 output_queries.append(res)
+    memo.put(memo_key, output_queries)
     return output_queries
 
 
+def fetch_arxiv_results(search_keyword, max_results=100):
+    """
+    Query arXiv and parse the results. Blocking (the results generator pages over HTTP), run it in a thread.
+
+    :return: parsed_arxiv_results, see parse_arxiv_json
+    """
+    memo = get_stage_memo('arxiv')
+    memo_key = memo.make_key(search_keyword, max_results)
+    search_results_list = memo.get(memo_key)
+    if search_results_list is None:
+        search_results = arxiv.Search(
+            query = search_keyword,
+            max_results = max_results,
+            sort_by = arxiv.SortCriterion.Relevance,
+            sort_order = arxiv.SortOrder.Descending
+        ).results()
+        search_results_list = parse_search_results(search_results)
+        # download handles can't be stored, memoized results are downloaded through their pdf_url
+        memo.put(memo_key, [{key: value for key, value in result.items() if key != 'download_handle'}
+                            for result in search_results_list])
+    if not search_results_list:
+        print('NO RESULTS')
+    return parse_arxiv_json(search_results_list)
+
+
 def cohere_rerank(question , top_k, parsed_arxiv_results):
+    memo = get_stage_memo('rerank')
+    memo_key = memo.make_key(normalize_question(question), sorted(parsed_arxiv_results), top_k)
+    ranked_urls = memo.get(memo_key)
+    if ranked_urls is not None:
+        return {url: parsed_arxiv_results[url] for url in ranked_urls}
+
     import cohere
     secret_api = os.getenv('COHERE_API_KEY')
     co = cohere.Client(secret_api)
@@ -106,88 +163,241 @@ def cohere_rerank(question , top_k, parsed_arxiv_results):
         url = mapping_url_arxiv[obj.index]
         content = parsed_arxiv_results[url]
         output_dic[url] = content
+    memo.put(memo_key, list(output_dic))
     return output_dic
 
 
+def rerank(question, top_k, parsed_arxiv_results):
+    """top_k of parsed_arxiv_results for question with the configured RERANKER"""
+    if RERANKER == 'cohere':
+        return cohere_rerank(question, top_k, parsed_arxiv_results)
+    return local_rerank(question, top_k, parsed_arxiv_results, dense=RERANKER == 'bm25_dense')
+
+
+@app.on_event("startup")
+async def load_embedding_model():
+    # load the embedding model in the background so the server can answer /ready while it loads. The future is
+    # kept so a failure is logged and reported by /ready rather than lost
+    app.state.warm_up = asyncio.get_running_loop().run_in_executor(None, warm_up_models, os.getenv('MODAL', 'false'))
+    app.state.warm_up.add_done_callback(on_warm_up_done)
+
+
+@app.on_event("shutdown")
+async def close_download_client():
+    await close_client()
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
+
+@app.get("/ready")
+async def ready():
+    status = embedding_status(os.getenv('MODAL', 'false'))
+    return JSONResponse(content=status, status_code=200 if status['ready'] else 503)
+
+
+@app.get("/stats")
+async def stats():
+    return {"question_embedding_cache": get_question_cache().stats(),
+            "chunk_embedding_cache": get_chunk_cache().stats(),
+            "paper_text_cache": get_text_cache().stats(),
+            "search_stage_memo": memo_stats(),
+            "pdf_index": pdf_corpus_stats(),
+            "token_counts": get_token_counter().stats() if TOKEN_BUDGET else None}
+
 @app.post("/chat/")
 async def ask_question(chat: Chat):
     # relevant_documents = {chat.url: chat.parsed_arxiv_results[chat.url]}
     # relevant_pdfs, relevant_answers = await qa_pdf(question=chat.question, k=20, parsed_arxiv_results=relevant_documents)
     # return {"answer": relevant_answers[0].answer}
 
-    f_path = os.path.join(os.getenv('ROOT_DIRECTORY'), 'pdfs', os.path.split(chat.url)[1] + '.pdf')
-    splits, _ = parse_pdf(f_path,
-                          key='',
-                          citation='',
-                          chunk_chars=1100,
-                          overlap=0)
-    splits = ' '.join(splits)
+    unique_id = os.path.split(chat.url)[1]
+    f_path = os.path.join(os.getenv('ROOT_DIRECTORY'), 'pdfs', unique_id + '.pdf')
 
-    answer = get_anthropic_response(chat.question, splits)
+    def read_paper():
+        # page texts are cached per paper, follow-up questions don't parse the pdf again
+        return ' '.join(split for split, _ in get_text_cache().iter_parse_pdf(f_path,
+                                                                               key='',
+                                                                               citation='',
+                                                                               chunk_chars=1100,
+                                                                               overlap=0))
 
-    return {"answer": answer}
+    # embedding, pdf parsing and the anthropic call are blocking, keep them off the event loop
+    mode, splits, context_tokens = chat.mode, None, None
+    if mode == 'retrieval':
+        splits, context_tokens = await asyncio.to_thread(select_chat_context, chat.question, unique_id,
+                                                         chat.token_budget or CHAT_TOKEN_BUDGET)
+    if splits is None:
+        # paper has no stored chunk embeddings (or whole paper mode was asked for)
+        mode, context_tokens = 'paper', None
+        splits = await asyncio.to_thread(read_paper)
 
+    answer = await asyncio.to_thread(get_anthropic_response, chat.question, splits)
 
-@app.post("/search/")
-async def search_paper(message: SearchItem):
-    refined_search_keywords = search_term_refiner(message.search_term)
+    return {"answer": answer, "mode": mode, "context_tokens": context_tokens}
+
+
+def public_results(parsed_arxiv_results):
+    """parsed arxiv results without the (not serializable) download handles"""
+    return {url: {key: value for key, value in result.items() if key != 'download_handle'}
+            for url, result in parsed_arxiv_results.items()}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def run_search(search_term, emit=None, early_exit=None, keep_rank_order=True):
+    """
+    The /search pipeline. emit(stage, payload) is called as soon as each stage has a result, payloads carry the
+    seconds the stage took. Relevant evidence summaries are emitted one by one as 'evidence' while they land.
+    early_exit and keep_rank_order are passed to qa_pdf.
+
+    :return: response dict of /search
+    """
+    emit = emit or (lambda stage, payload: None)
+    timings = {}
+    stage_start = time.perf_counter()
+
+    def finished(stage, payload):
+        nonlocal stage_start
+        now = time.perf_counter()
+        timings[stage] = round(now - stage_start, 3)
+        stage_start = now
+        emit(stage, dict(payload, seconds=timings[stage]))
+
+    refined_search_keywords = await search_term_refiner(search_term)
     search_keyword = ' AND '.join(refined_search_keywords)
     print("search keyword: " + search_keyword)
-    search_results = arxiv.Search(
-        query = search_keyword,
-        max_results = 100,
-        sort_by = arxiv.SortCriterion.Relevance,
-        sort_order = arxiv.SortOrder.Descending
-    ).results()
-    if not search_results:
-        print(search_results)
-        print('NO RESULTS')
-    search_results_list = parse_search_results(search_results)
-    parsed_arxiv_results = parse_arxiv_json(search_results_list)
+    finished('keywords', {'keywords': refined_search_keywords, 'query': search_keyword})
 
+    parsed_arxiv_results = await asyncio.to_thread(fetch_arxiv_results, search_keyword, ARXIV_MAX_RESULTS)
     for key in parsed_arxiv_results:
         print(f'Raw results: {key}')
         print(parsed_arxiv_results[key]['summary'])
+    finished('arxiv_results', {'arxiv_results': public_results(parsed_arxiv_results)})
+
+    candidates, pdf_selection = parsed_arxiv_results, None
+    if PIPELINE_MODE == 'two_stage':
+        # only papers whose abstract is close to the question are downloaded and embedded in full. Every arXiv
+        # result is scored, so papers the reranker would have cut can still be picked
+        candidates, abstract_scores = await asyncio.to_thread(select_by_abstract, search_term, parsed_arxiv_results)
+        pdf_selection = {'candidates': len(abstract_scores),
+                         'selected': len(candidates),
+                         'cutoff': ABSTRACT_SIMILARITY_CUTOFF,
+                         'top_n': ABSTRACT_TOP_N,
+                         'scores': abstract_scores}
+        print(f"Two stage: {len(candidates)}/{len(abstract_scores)} papers above "
+              f"{ABSTRACT_SIMILARITY_CUTOFF} go to pdf retrieval")
+        finished('abstract_filter', pdf_selection)
 
-    start = datetime.datetime.now()
-    print(start.strftime("%H:%M:%S"))
-    nearest_neighbors = cohere_rerank(question = message.search_term, top_k = 10, parsed_arxiv_results=parsed_arxiv_results)
-    end = datetime.datetime.now()
-    print(end.strftime("%H:%M:%S"), f'elapsed (s): {(end - start).total_seconds():.3}')
+    nearest_neighbors = await asyncio.to_thread(rerank, question=search_term, top_k=10,
+                                                parsed_arxiv_results=candidates)
+    finished('reranked', {'urls': list(nearest_neighbors)})
     print('-' * 50)
 
+    response = {"question": search_term,
+                "answer": "I cannot answer this question due to insufficient information.",
+                "context": "",
+                "contexts": {},
+                "references": [],
+                "skipped_llm_calls": 0,
+                "pdf_selection": pdf_selection,
+                "token_plan": None,
+                "arxiv_results": parsed_arxiv_results}
+
     if not nearest_neighbors:
         print('Cannot answer your question.')
     else:
         print(f'Nearest Neighbors: {list(nearest_neighbors.keys())}')
         print('Getting Answer from PDFs')
         relevant_documents = {url: parsed_arxiv_results[url] for url in nearest_neighbors}
-        download_relevant_documents(relevant_documents)
+        report = await download_relevant_documents_async(relevant_documents)
         print(f'{list(relevant_documents.keys())}')
+        finished('downloaded', {'failed': [f for f, r in report.items() if r['error'] is not None]})
+
+        if TOKEN_BUDGET:
+            # drop the lowest ranked papers if the request would go over its token budget
+            relevant_documents, response['token_plan'] = await asyncio.to_thread(plan_token_budget, search_term,
+                                                                                 relevant_documents)
+            print(f"Token plan: {response['token_plan']['estimate']}, dropped {response['token_plan']['dropped']}")
+            finished('token_plan', response['token_plan'])
+
+        def on_evidence(doc, summary):
+            emit('evidence', {'unique_id': doc.metadata['unique_id'],
+                              'key': doc.metadata['key'],
+                              'citation': doc.metadata['citation'],
+                              'summary': summary,
+                              'text': doc.page_content,
+                              'seconds': round(time.perf_counter() - stage_start, 3)})
 
         # relevant_pdfs = dict(url= (key, citation, llm_summary, text_chunk_from_pdf))
         print('-' * 50)
-        start = datetime.datetime.now()
-        print(start.strftime("%H:%M:%S"))
-        relevant_pdfs, relevant_answers = await qa_pdf(question=message.search_term, k=25, parsed_arxiv_results=relevant_documents)
-        end = datetime.datetime.now()
-        print(end.strftime("%H:%M:%S"), f'elapsed (s): {(end - start).total_seconds():.3}')
+        relevant_pdfs, relevant_answers = await qa_pdf(question=search_term, k=25,
+                                                       parsed_arxiv_results=relevant_documents,
+                                                       on_evidence=on_evidence,
+                                                       early_exit=early_exit,
+                                                       keep_rank_order=keep_rank_order)
         print('-' * 50)
 
+        output_obj = relevant_answers
+        response.update({"question": output_obj[0].question,
+                         "answer": output_obj[0].answer,
+                         "context": output_obj[0].context,
+                         "contexts": output_obj[0].contexts,
+                         "references": get_references(parsed_arxiv_results, output_obj[0].contexts),
+                         "skipped_llm_calls": output_obj[0].skipped_summaries})
+
+    finished('answer', {key: response[key] for key in ('question', 'answer', 'context', 'contexts', 'references',
+                                                      'skipped_llm_calls', 'pdf_selection', 'token_plan')})
+    response['timings'] = timings
+    print(f'Search timings (s): {timings}')
+    return response
+
+
+@app.post("/search/")
+async def search_paper(message: SearchItem):
+    return await run_search(message.search_term, early_exit=message.early_exit,
+                            keep_rank_order=message.keep_rank_order)
+
 
+@app.post("/search/stream")
+async def search_paper_stream(message: SearchItem):
+    """
+    /search as server-sent events: keywords, arxiv_results, abstract_filter (two stage mode only), reranked,
+    downloaded, token_plan (with TOKEN_BUDGET set), evidence (one per relevant summary), answer and finally done
+    with the per stage timings, or error.
+    """
+    queue = asyncio.Queue()
 
-    output_obj = relevant_answers
-    clean_ref = get_references(parsed_arxiv_results, output_obj[0].contexts)
+    def emit(stage, payload):
+        queue.put_nowait(sse_event(stage, payload))
 
-    return {"question": output_obj[0].question,
-            "answer": output_obj[0].answer,
-            "context": output_obj[0].context,
-            "contexts": output_obj[0].contexts,
-            "references": clean_ref,
-            "arxiv_results": parsed_arxiv_results}
+    async def run():
+        try:
+            response = await run_search(message.search_term, emit, early_exit=message.early_exit,
+                                        keep_rank_order=message.keep_rank_order)
+            emit('done', {'timings': response['timings']})
+        except Exception as e:
+            # reported to the client and logged here, nothing awaits this task to see a raised exception
+            emit('error', {'message': f'{type(e).__name__}: {e}'})
+            traceback.print_exc()
+        finally:
+            queue.put_nowait(None)
 
+    async def events():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            # client disconnected or we are done, don't leave the pipeline running
+            task.cancel()
 
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,9 +1,17 @@
+from typing import Optional
 from pydantic import BaseModel
 
 class SearchItem(BaseModel):
     search_term: str
+    # stop summarizing once enough relevant chunks came back (None: the server's SUMMARY_EARLY_EXIT), and with it
+    # whether the evidence keeps the search rank order (True) or the order the summaries completed in
+    early_exit: Optional[bool] = None
+    keep_rank_order: bool = True
 
 class Chat(BaseModel):
     question: str
     url: str
     parsed_arxiv_results: dict
+    # 'retrieval' sends the most relevant chunks of the paper, 'paper' the whole text
+    mode: str = 'retrieval'
+    token_budget: Optional[int] = None
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# tests import the packages the way the server does, from backend/src
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,200 @@
+import numpy as np
+import pytest
+
+from question_answer_pipeline.qa_utils.docs import Answer, Docs
+from question_answer_pipeline.qa_utils.indexes import IndexSpec
+
+DIM = 32
+
+
+@pytest.fixture(autouse=True)
+def openai_key(monkeypatch):
+    # Docs builds its (unused) chat models on init
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+
+
+def random_vectors(n, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def add_papers(docs, vectors, chunks_per_paper=10, first=0):
+    """one document per chunks_per_paper vectors, unique_ids paper{first}, paper{first + 1}, ..."""
+    documents = []
+    for i, start in enumerate(range(0, len(vectors), chunks_per_paper), first):
+        texts = [f'paper{i} chunk{j}' for j in range(len(vectors[start:start + chunks_per_paper]))]
+        metadatas = [dict(dockey=f'paper{i}', citation=f'paper{i}', unique_id=f'paper{i}') for _ in texts]
+        documents.append((f'paper{i}', texts, vectors[start:start + chunks_per_paper], metadatas))
+    docs.add_many_from_embeddings(documents)
+
+
+def question(vector):
+    return Answer(question='q', question_embedding=list(vector), from_embed=True)
+
+
+@pytest.mark.parametrize('marginal_relevance', [True, False])
+def test_unfiltered_search_uses_the_question_embedding(marginal_relevance):
+    docs = Docs(name='test')
+    vectors = random_vectors(100)
+    add_papers(docs, vectors)
+
+    found = docs.vector_search(question(vectors[42]), 5, marginal_relevance=marginal_relevance)
+
+    assert len(found) == 5
+    assert found[0].page_content == 'paper4 chunk2'
+    if not marginal_relevance:
+        distances = ((vectors - vectors[42]) ** 2).sum(axis=1)
+        expected = [f'paper{row // 10} chunk{row % 10}' for row in np.argsort(distances)[:5]]
+        assert [doc.page_content for doc in found] == expected
+
+
+def test_unfiltered_search_rescores_a_compressed_index():
+    vectors = random_vectors(300)
+    docs = Docs(name='test', index_spec=IndexSpec(codec='int8', rescore=4),
+                full_vectors=lambda unique_id: vectors[int(unique_id[5:]) * 10:][:10])
+    add_papers(docs, vectors)
+
+    found = docs.vector_search(question(vectors[123]), 3, marginal_relevance=False)
+
+    distances = ((vectors - vectors[123]) ** 2).sum(axis=1)
+    assert [doc.page_content for doc in found] == [f'paper{row // 10} chunk{row % 10}'
+                                                    for row in np.argsort(distances)[:3]]
+
+
+def test_ivf_training_waits_for_enough_vectors(tmp_path):
+    import faiss
+
+    spec = IndexSpec(kind='ivf', nlist=4, nprobe=4)
+    vectors = random_vectors(4 * 39 + 44)
+    docs = Docs(name='test', index_spec=spec, trained_index_path=tmp_path)
+
+    add_papers(docs, vectors[:100])
+    assert isinstance(docs._faiss_index.index, faiss.IndexFlat)
+    assert not list(tmp_path.iterdir())
+
+    add_papers(docs, vectors[100:], first=10)
+    ivf = faiss.extract_index_ivf(docs._faiss_index.index)
+    assert (ivf.nlist, ivf.ntotal) == (4, len(vectors))
+    assert [path.name for path in tmp_path.iterdir()] == [spec.name(DIM) + '.faiss']
+    # rows kept their documents, every list is probed so the search is exact
+    found = docs.vector_search(question(vectors[57]), 1, marginal_relevance=False)
+    assert found[0].page_content == 'paper5 chunk7'
+
+    # the trained index is reused, however few vectors a later Docs starts with
+    docs = Docs(name='test', index_spec=spec, trained_index_path=tmp_path)
+    add_papers(docs, vectors[:10])
+    assert faiss.extract_index_ivf(docs._faiss_index.index).nlist == 4
+
+
+def test_index_stats_report_the_index_as_built():
+    vectors = random_vectors(300)
+    docs = Docs(name='test', index_spec=IndexSpec(kind='ivf', nlist=4, codec='pq', pq_m=8, train_size=200))
+    assert docs.index_stats()['vectors'] == 0
+
+    add_papers(docs, vectors[:100])
+    stats = docs.index_stats()
+    assert (stats['spec']['kind'], stats['spec']['codec'], stats['training_deferred']) == ('flat', 'float32', True)
+    assert stats['vector_bytes'] == 100 * 4 * DIM
+
+    # train_size=200 is below the 256 vectors pq trains on, so the index falls back to int8
+    add_papers(docs, vectors[100:], first=10)
+    stats = docs.index_stats()
+    assert (stats['spec']['kind'], stats['spec']['codec'], stats['training_deferred']) == ('ivf', 'int8', False)
+    assert stats['requested_spec']['codec'] == 'pq'
+    assert (stats['vectors'], stats['vector_bytes']) == (300, 300 * DIM)
+
+
+def test_index_stats_dont_wait_for_writers():
+    import threading
+
+    docs = Docs(name='test')
+    add_papers(docs, random_vectors(20))
+    locked, release = threading.Event(), threading.Event()
+
+    def writer():
+        with docs._lock:
+            locked.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    locked.wait(5)
+    try:
+        assert docs.index_stats()['vectors'] == 20
+    finally:
+        release.set()
+        thread.join()
+
+
+@pytest.mark.parametrize('spec', ['ivf,nlist=4,nprobe=4,exact_rows=0', 'hnsw,m=16,ef_search=64,exact_rows=0'])
+def test_restricted_search_goes_through_the_index(spec, monkeypatch):
+    from question_answer_pipeline.qa_utils import docs as docs_module
+
+    searched = []
+    restricted_search_params = docs_module.restricted_search_params
+    monkeypatch.setattr(docs_module, 'restricted_search_params',
+                        lambda spec, rows: searched.append(len(rows)) or restricted_search_params(spec, rows))
+    vectors = random_vectors(400)
+    docs = Docs(name='test', index_spec=IndexSpec.parse(spec))
+    add_papers(docs, vectors)
+    unique_ids = {f'paper{i}' for i in range(0, 40, 2)}
+
+    found = docs.vector_search(question(vectors[251]), 5, marginal_relevance=False, unique_ids=unique_ids)
+
+    assert searched == [200]
+    rows = np.array([row for row in range(400) if row // 10 % 2 == 0])
+    distances = ((vectors[rows] - vectors[251]) ** 2).sum(axis=1)
+    expected = [f'paper{row // 10} chunk{row % 10}' for row in rows[np.argsort(distances)[:5]]]
+    assert found[0].page_content == expected[0]
+    assert len(set(doc.page_content for doc in found) & set(expected)) >= 4
+
+
+def test_small_restricted_searches_scan_exactly(monkeypatch):
+    from question_answer_pipeline.qa_utils import docs as docs_module
+
+    monkeypatch.setattr(docs_module, 'restricted_search_params', None)
+    vectors = random_vectors(400)
+    docs = Docs(name='test', index_spec=IndexSpec.parse('ivf,nlist=4,nprobe=1'))
+    add_papers(docs, vectors)
+
+    found = docs.vector_search(question(vectors[37]), 3, marginal_relevance=False, unique_ids={'paper3', 'paper20'})
+
+    rows = np.r_[30:40, 200:210]
+    distances = ((vectors[rows] - vectors[37]) ** 2).sum(axis=1)
+    assert [doc.page_content for doc in found] == [f'paper{row // 10} chunk{row % 10}'
+                                                    for row in rows[np.argsort(distances)[:3]]]
+
+
+def test_rescoring_reads_each_paper_once():
+    vectors = random_vectors(300)
+    reads = []
+
+    def full_vectors(unique_id):
+        reads.append(unique_id)
+        return vectors[int(unique_id[5:]) * 10:][:10]
+
+    docs = Docs(name='test', index_spec=IndexSpec(codec='int8', rescore=4), full_vectors=full_vectors)
+    add_papers(docs, vectors)
+
+    found = docs.vector_search(question(vectors[123]), 5)
+
+    assert len(found) == 5
+    assert len(reads) == len(set(reads))
+
+
+@pytest.mark.parametrize('spec', ['flat', 'ivf,nlist=4,nprobe=2,codec=int8', 'hnsw,m=16'])
+def test_pickle_round_trip(spec, tmp_path):
+    import pickle
+
+    vectors = random_vectors(300)
+    docs = Docs(name='test', index_path=tmp_path, index_spec=IndexSpec.parse(spec))
+    add_papers(docs, vectors)
+    before = docs.vector_search(question(vectors[77]), 5, marginal_relevance=False)
+
+    loaded = pickle.loads(pickle.dumps(docs))
+
+    assert loaded.index_stats()['spec'] == docs.index_stats()['spec']
+    after = loaded.vector_search(question(vectors[77]), 5, marginal_relevance=False)
+    assert [doc.page_content for doc in after] == [doc.page_content for doc in before]
+    found = loaded.vector_search(question(vectors[77]), 5, unique_ids={'paper7', 'paper8'})
+    assert found[0].page_content == 'paper7 chunk7'
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from question_answer_pipeline.src import downloader
+
+PDF = b'%PDF-1.4\n' + bytes(range(256)) * 64
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    /pdf        honours Range
+    /norange    ignores Range, always 200 with the whole file
+    /flaky      first request is cut off half way, later ones honour Range
+    /changed    first request is cut off half way, later Range requests get 416
+    /html       not a pdf
+    """
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, headers=(), length=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        first = not any(path == self.path for path, _ in Handler.requests)
+        Handler.requests.append((self.path, range_header))
+
+        if self.path == '/html':
+            return self._send(200, b'<html><body>captcha</body></html>')
+        if self.path in ('/flaky', '/changed') and first:
+            # promise the whole file, send half and drop the connection
+            self._send(200, PDF[:len(PDF) // 2], length=len(PDF))
+            self.close_connection = True
+            return
+        if self.path == '/changed' and range_header:
+            return self._send(416, b'')
+        if range_header and self.path != '/norange':
+            offset = int(range_header.split('=')[1].rstrip('-'))
+            return self._send(206, PDF[offset:], [('Content-Range', f'bytes {offset}-{len(PDF) - 1}/{len(PDF)}')])
+        return self._send(200, PDF)
+
+
+@pytest.fixture()
+def server():
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def download(url, path, retries=3):
+    async def run():
+        client = downloader.get_client()
+        return await downloader.download_pdf(client, asyncio.Semaphore(4), url, path, retries)
+
+    return downloader.run_downloads(run())
+
+
+def test_download(server, tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    result = download(server + '/pdf', path)
+    assert result['error'] is None and result['attempts'] == 1
+    assert open(path, 'rb').read() == PDF
+    assert os.listdir(tmp_path) == ['a.pdf']
+
+
+def test_existing_file_is_skipped(server, tmp_path):
+    path = tmp_path / 'a.pdf'
+    path.write_bytes(PDF)
+    assert download(server + '/pdf', str(path))['skipped']
+    assert Handler.requests == []
+
+
+def test_resume_with_range(server, tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    result = download(server + '/flaky', path)
+    assert result['error'] is None and result['attempts'] == 2
+    assert Handler.requests == [('/flaky', None), ('/flaky', f'bytes={len(PDF) // 2}-')]
+    assert open(path, 'rb').read() == PDF
+
+
+def test_server_ignoring_range(server, tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    partial = path + '.resume.part'
+    # a resumed attempt against a server that answers 200 must overwrite, not append
+    with open(partial, 'wb') as f:
+        f.write(PDF[:100])
+
+    async def run():
+        await downloader._fetch(downloader.get_client(), server + '/norange', partial)
+
+    downloader.run_downloads(run())
+    assert Handler.requests == [('/norange', 'bytes=100-')]
+    assert open(partial, 'rb').read() == PDF
+
+
+def test_416_restarts_without_range(server, tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    result = download(server + '/changed', path)
+    assert result['error'] is None and result['attempts'] == 2
+    assert Handler.requests == [('/changed', None), ('/changed', f'bytes={len(PDF) // 2}-'), ('/changed', None)]
+    assert open(path, 'rb').read() == PDF
+
+
+def test_not_a_pdf_is_not_retried(server, tmp_path):
+    path = str(tmp_path / 'a.pdf')
+    result = download(server + '/html', path, retries=3)
+    assert 'did not return a pdf' in result['error']
+    assert result['attempts'] == 1
+    assert Handler.requests == [('/html', None)]
+    assert os.listdir(tmp_path) == []
+
+
+def test_concurrent_downloads_of_a_paper_are_shared(server, tmp_path):
+    path = str(tmp_path / 'a.pdf')
+
+    async def run():
+        client = downloader.get_client()
+        semaphore = asyncio.Semaphore(4)
+        return await asyncio.gather(*[downloader.download_pdf(client, semaphore, server + '/pdf', path)
+                                      for _ in range(3)])
+
+    results = downloader.run_downloads(run())
+    assert all(result['error'] is None for result in results)
+    assert len(Handler.requests) == 1
+    assert open(path, 'rb').read() == PDF
+
+
+def test_concurrent_requests_share_the_download_limit(server, tmp_path, monkeypatch):
+    counts = dict(in_flight=0, max_in_flight=0)
+    fetch = downloader._fetch
+
+    async def counting_fetch(client, url, partial_path):
+        counts['in_flight'] += 1
+        counts['max_in_flight'] = max(counts['max_in_flight'], counts['in_flight'])
+        try:
+            await asyncio.sleep(0.02)
+            await fetch(client, url, partial_path)
+        finally:
+            counts['in_flight'] -= 1
+
+    monkeypatch.setattr(downloader, '_fetch', counting_fetch)
+
+    async def run():
+        # two requests of three papers each, with a limit of two downloads on the loop
+        return await asyncio.gather(*[downloader.download_pdfs({f'{request}{i}.pdf': server + '/pdf' for i in range(3)},
+                                                               str(tmp_path), concurrency=2)
+                                      for request in 'ab'])
+
+    reports = downloader.run_downloads(run())
+    assert all(result['error'] is None for report in reports for result in report.values())
+    assert counts['max_in_flight'] == 2
+
+
+def test_client_is_closed_with_its_loop(server, tmp_path):
+    clients = []
+
+    async def run():
+        clients.append(downloader.get_client())
+
+    downloader.run_downloads(run())
+    assert clients[0].is_closed
+
+
+def test_fallbacks_run_concurrently_and_cover_failed_downloads(server, tmp_path, monkeypatch):
+    from question_answer_pipeline.src import utils
+    monkeypatch.setattr(utils, 'FILE_DIRECTORY', str(tmp_path))
+    barrier = threading.Barrier(2, timeout=5)
+
+    def download_handle(dirpath, filename):
+        # both fallbacks have to be running at once to get past the barrier
+        barrier.wait()
+        with open(os.path.join(dirpath, filename), 'wb') as f:
+            f.write(PDF)
+
+    entries = [('a.pdf', dict(pdf_url='', download_handle=download_handle)),
+               ('b.pdf', dict(pdf_url=server + '/html', download_handle=download_handle)),
+               ('c.pdf', dict(pdf_url=server + '/pdf', download_handle=download_handle))]
+
+    report = downloader.run_downloads(utils._download_entries(entries))
+    assert all(result['error'] is None for result in report.values())
+    assert sorted(os.listdir(tmp_path)) == ['a.pdf', 'b.pdf', 'c.pdf']
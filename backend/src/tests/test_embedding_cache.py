@@ -0,0 +1,92 @@
+import time
+
+import numpy as np
+
+from question_answer_pipeline.src import embedding as embedding_module
+from question_answer_pipeline.src.embedding_cache import EmbeddingCache, normalize_question
+
+MODEL = 'model'
+INSTRUCTION = 'Represent the query: '
+
+
+def vector(i):
+    return np.full(4, i, dtype=np.float32)
+
+
+def test_rephrased_question_is_a_hit():
+    cache = EmbeddingCache(maxsize=4, normalize=normalize_question)
+    cache.put('What is  RAG?', INSTRUCTION, MODEL, vector(1), 7)
+
+    embedding, num_tokens = cache.get('  what is rag? ', INSTRUCTION, MODEL)
+    np.testing.assert_array_equal(embedding, vector(1))
+    assert num_tokens == 7
+    # another instruction or model is another embedding
+    assert cache.get('what is rag?', 'Represent the paragraph: ', MODEL) is None
+    assert cache.get('what is rag?', INSTRUCTION, 'other model') is None
+    assert (cache.hits, cache.misses, cache.tokens_saved) == (1, 2, 7)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = EmbeddingCache(maxsize=2)
+    cache.put('a', INSTRUCTION, MODEL, vector(1))
+    cache.put('b', INSTRUCTION, MODEL, vector(2))
+    assert cache.get('a', INSTRUCTION, MODEL) is not None  # b is now the least recently used
+    cache.put('c', INSTRUCTION, MODEL, vector(3))
+
+    assert cache.get('b', INSTRUCTION, MODEL) is None
+    assert cache.get('a', INSTRUCTION, MODEL) is not None
+    assert cache.get('c', INSTRUCTION, MODEL) is not None
+    assert cache.stats()['size'] == 2
+
+
+def test_sqlite_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / 'cache' / 'embeddings.db')
+    EmbeddingCache(maxsize=2, path=path).put_many(['a', 'b'], INSTRUCTION, MODEL, [vector(1), vector(2)], [3, 4])
+
+    cache = EmbeddingCache(maxsize=2, path=path)
+    embedding, num_tokens = cache.get('b', INSTRUCTION, MODEL)
+    np.testing.assert_array_equal(embedding, vector(2))
+    assert num_tokens == 4
+    assert cache.get('c', INSTRUCTION, MODEL) is None
+    # loaded into memory on the first disk hit
+    cache.get('b', INSTRUCTION, MODEL)
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 1, 1)
+
+
+def test_disk_tier_drops_the_least_recently_used_rows(tmp_path):
+    cache = EmbeddingCache(maxsize=1, path=str(tmp_path / 'chunks.db'), max_disk_entries=2)
+    cache.put('a', INSTRUCTION, MODEL, vector(1))
+    time.sleep(0.01)
+    cache.put('b', INSTRUCTION, MODEL, vector(2))
+    time.sleep(0.01)
+    cache.get('a', INSTRUCTION, MODEL)  # from disk, b is now the least recently used row
+    time.sleep(0.01)
+    cache.put('c', INSTRUCTION, MODEL, vector(3))
+
+    reopened = EmbeddingCache(maxsize=4, path=str(tmp_path / 'chunks.db'))
+    assert reopened.get('b', INSTRUCTION, MODEL) is None
+    assert reopened.get('a', INSTRUCTION, MODEL) is not None
+    assert reopened.get('c', INSTRUCTION, MODEL) is not None
+    assert cache.evictions == 1
+
+
+def test_embed_document_only_encodes_unseen_chunks(monkeypatch):
+    cache = EmbeddingCache(maxsize=16)
+    encoded = []
+
+    def embed(doc_splits, use_modal='false', map_splits=False):
+        encoded.append(doc_splits)
+        return [dict(file_embeddings=[vector(len(split)) for split in splits],
+                     num_tokens=[len(split) for split in splits])
+                for splits in doc_splits]
+
+    monkeypatch.setattr(embedding_module, '_chunk_cache', lambda: cache)
+    monkeypatch.setattr(embedding_module, '_embed_document', embed)
+
+    embedding_module.embed_document([['a', 'bb'], ['ccc']])
+    # the same chunk in another paper (e.g. a new version) is served from the cache
+    result = embedding_module.embed_document([['bb'], ['ccc', 'dddd'], ['a']])
+
+    assert encoded == [[['a', 'bb'], ['ccc']], [['dddd']]]
+    assert [doc['num_tokens'] for doc in result] == [[2], [3, 4], [1]]
+    np.testing.assert_array_equal(result[1]['file_embeddings'][1], vector(4))
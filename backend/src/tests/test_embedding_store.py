@@ -0,0 +1,81 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from question_answer_pipeline.src.embedding_store import EmbeddingStore
+
+
+def paper(n, dim=8, seed=0):
+    embeddings = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    texts = [f'chunk {i}' for i in range(n)]
+    return texts, embeddings, [dict(key=f'k{i}') for i in range(n)], list(range(10, 10 + n))
+
+
+def test_float16_store_halves_the_vectors(tmp_path):
+    texts, embeddings, metadatas, num_tokens = paper(4)
+    store = EmbeddingStore(str(tmp_path), dtype='float16')
+    store.add('2101.00001', texts, embeddings, metadatas, num_tokens)
+
+    assert (tmp_path / 'vectors.f16').stat().st_size == embeddings.size * 2
+    stored = EmbeddingStore(str(tmp_path)).get_embeddings('2101.00001')
+    assert stored.dtype == np.float16
+    np.testing.assert_allclose(stored, embeddings, rtol=1e-3, atol=1e-3)
+
+
+def test_round_trip_through_a_reopened_store(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add('2101.00001', *paper(3, seed=1))
+    store.add('2101.00002', *paper(5, seed=2))
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert reopened.ids() == {'2101.00001', '2101.00002'}
+    texts, embeddings, metadatas, num_tokens = reopened.get('2101.00002')
+    expected = paper(5, seed=2)
+    assert (texts, metadatas, num_tokens) == (expected[0], expected[2], expected[3])
+    np.testing.assert_array_equal(embeddings, expected[1])
+
+
+def test_duplicate_and_empty_papers(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add('2101.00001', *paper(2))
+    with pytest.raises(ValueError):
+        store.add('2101.00001', *paper(2))
+    with pytest.raises(ValueError):
+        store.add('2101.00002', *paper(2, dim=4))
+
+    store.add('2101.00003', [], np.empty((0, 8)), [], [])
+    assert '2101.00003' not in store
+    assert len(store) == 1
+
+
+def test_incomplete_write_is_truncated(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add('2101.00001', *paper(2, seed=1))
+    # a crash after the vectors, chunks and half a table line of the second paper were written
+    store.add('2101.00002', *paper(3, seed=2))
+    table = (tmp_path / 'table.jsonl').read_bytes()
+    first_line_end = table.index(b'\n') + 1
+    (tmp_path / 'table.jsonl').write_bytes(table[:first_line_end + (len(table) - first_line_end) // 2])
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert reopened.ids() == {'2101.00001'}
+    assert (tmp_path / 'vectors.f32').stat().st_size == 2 * 8 * 4
+    # the next paper goes where the torn one was
+    reopened.add('2101.00003', *paper(1, seed=3))
+    assert EmbeddingStore(str(tmp_path)).get('2101.00003')[0] == ['chunk 0']
+    np.testing.assert_array_equal(EmbeddingStore(str(tmp_path)).get_embeddings('2101.00001'), paper(2, seed=1)[1])
+
+
+def test_import_pickles(tmp_path):
+    texts, embeddings, metadatas, num_tokens = paper(2)
+    with open(tmp_path / '2101.00001.pkl', 'wb') as f:
+        pickle.dump([texts, list(embeddings), metadatas, num_tokens], f)
+    with open(tmp_path / '2101.00002.pkl', 'wb') as f:
+        pickle.dump(['an abstract', embeddings[:1], [dict(key='k')], [5]], f)
+
+    store = EmbeddingStore(str(tmp_path))
+    assert store.import_pickles() == 2
+    assert store.import_pickles() == 0
+    assert store.get('2101.00002')[0] == ['an abstract']
+    np.testing.assert_array_equal(store.get_embeddings('2101.00001'), embeddings)
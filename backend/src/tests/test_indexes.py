@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from question_answer_pipeline.qa_utils.docs import Answer, Docs
+from question_answer_pipeline.qa_utils.indexes import IndexSpec, compare_to_flat, _clustered_vectors
+
+VECTORS = _clustered_vectors(2050, 32, clusters=20)
+CORPUS, QUERIES = VECTORS[:2000], VECTORS[2000:]
+
+
+@pytest.mark.parametrize('spec, min_recall', [
+    ('flat', 1.0),
+    ('flat,codec=float16', 0.95),
+    ('flat,codec=int8', 0.9),
+    ('flat,codec=pq,pq_m=8,rescore=4', 0.9),
+    ('ivf,nlist=16,nprobe=4', 0.95),
+    ('ivf,nlist=16,nprobe=4,codec=int8', 0.9),
+    ('ivf,nlist=16,nprobe=4,codec=pq,pq_m=8,rescore=4', 0.9),
+    ('hnsw,m=16,ef_search=64', 0.95),
+    ('hnsw,m=16,ef_search=64,codec=float16', 0.95),
+])
+def test_recall_against_flat(spec, min_recall):
+    result = compare_to_flat(IndexSpec.parse(spec), CORPUS, QUERIES, k=10)
+
+    assert result['recall'] >= min_recall
+    if IndexSpec.parse(spec).compressed and IndexSpec.parse(spec).kind == 'flat':
+        # at 32 dims the HNSW graph outweighs the vectors it compresses
+        assert result['memory_saved'] > 0
+
+
+@pytest.mark.parametrize('spec', ['ivf,nlist=16,nprobe=16', 'hnsw,m=16,ef_search=64',
+                                  'flat,codec=int8,rescore=4', 'ivf,nlist=16,nprobe=8,codec=pq,pq_m=16,rescore=8'])
+def test_docs_top1_matches_flat(spec, monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    docs = Docs(name='test', index_spec=IndexSpec.parse(spec),
+                full_vectors=lambda unique_id: CORPUS[int(unique_id) * 100:][:100])
+    docs.add_many_from_embeddings([
+        (str(i), [f'{i}:{j}' for j in range(100)], CORPUS[i * 100:(i + 1) * 100],
+         [dict(dockey=str(i), citation=str(i), unique_id=str(i)) for _ in range(100)])
+        for i in range(20)])
+
+    for query in QUERIES:
+        row = int(np.argmin(((CORPUS - query) ** 2).sum(axis=1)))
+        answer = Answer(question='q', question_embedding=list(query), from_embed=True)
+        found = docs.vector_search(answer, 1, marginal_relevance=False)
+        assert found[0].page_content == f'{row // 100}:{row % 100}'
@@ -0,0 +1,44 @@
+import numpy as np
+from langchain.docstore.document import Document
+
+from question_answer_pipeline.qa_utils.lexical import BM25Index, bm25_scores, lexical_prefilter, tokenize
+
+CORPUS = [
+    'Dense passage retrieval for open domain question answering.',
+    'The retrieval of passages: retrieval augmented generation with dense retrieval.',
+    'Protein folding with attention.',
+    'A survey of graph neural networks for molecules and proteins.',
+]
+
+
+def test_tokenize_drops_stopwords_and_single_characters():
+    assert tokenize('What is the role of a GPU in RAG-2?') == ['role', 'gpu', 'rag']
+
+
+def test_bm25_ranks_term_frequency_and_rare_terms_first():
+    scores = BM25Index(CORPUS).score('dense retrieval')
+    # three mentions of retrieval beat one, papers without any query term score 0
+    assert list(np.argsort(-scores))[:2] == [1, 0]
+    assert scores[2] == scores[3] == 0
+    # 'protein' only appears in one text, so it outweighs the common 'retrieval'
+    scores = bm25_scores('protein retrieval', CORPUS)
+    assert scores[2] > scores[0]
+
+
+def test_query_without_known_terms_scores_zero():
+    np.testing.assert_array_equal(bm25_scores('what is it?', CORPUS), np.zeros(len(CORPUS)))
+    np.testing.assert_array_equal(bm25_scores('quantum', CORPUS), np.zeros(len(CORPUS)))
+
+
+def test_lexical_prefilter_keeps_matching_chunks_in_order():
+    docs = [Document(page_content=text) for text in CORPUS]
+
+    kept, dropped = lexical_prefilter(docs, 'dense retrieval', threshold=0)
+    assert kept == docs[:2] and dropped == 2
+
+    # min_keep tops up with the best scoring chunks, still in their original order
+    kept, dropped = lexical_prefilter(docs, 'dense retrieval', threshold=0.99, min_keep=2)
+    assert kept == docs[:2] and dropped == 2
+
+    # nothing to go on, nothing dropped
+    assert lexical_prefilter(docs, 'what is it?', threshold=0.5) == (docs, 0)
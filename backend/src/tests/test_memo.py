@@ -0,0 +1,72 @@
+from question_answer_pipeline.src import memo as memo_module
+from question_answer_pipeline.src.memo import StageMemo
+from server import app as server
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_values_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'memo' / 'refiner.db')
+    memo = StageMemo('refiner', path=path)
+    key = memo.make_key('what is rag?')
+    assert memo.get(key) is None
+    memo.put(key, ['retrieval augmented generation', 'rag'])
+
+    reopened = StageMemo('refiner', path=path)
+    assert reopened.get(key) == ['retrieval augmented generation', 'rag']
+    assert reopened.get(memo.make_key('what is rag')) is None
+    assert (reopened.hits, reopened.misses) == (1, 1)
+
+
+def test_key_depends_on_every_input():
+    assert StageMemo.make_key('rag', 100) == StageMemo.make_key('rag', 100)
+    assert StageMemo.make_key('rag', 100) != StageMemo.make_key('rag', 50)
+    assert StageMemo.make_key({'a': 1, 'b': 2}) == StageMemo.make_key({'b': 2, 'a': 1})
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(memo_module, 'time', clock)
+    memo = StageMemo('arxiv', ttl=60)
+    memo.put('key', [1])
+
+    clock.now += 59
+    assert memo.get('key') == [1]
+    clock.now += 2
+    assert memo.get('key') is None
+    assert memo.stats()['expired'] == 1
+    assert memo.stats()['size'] == 0
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(memo_module, 'time', clock)
+    memo = StageMemo('rerank', max_entries=2)
+    for key in 'ab':
+        clock.now += 1
+        memo.put(key, key)
+    clock.now += 1
+    memo.get('a')  # b is now the least recently used
+    clock.now += 1
+    memo.put('c', 'c')
+
+    assert [memo.get(key) for key in 'abc'] == ['a', None, 'c']
+    assert memo.stats()['evictions'] == 1
+
+
+def test_memoized_rerank_keeps_its_order(monkeypatch):
+    memo = StageMemo('rerank')
+    monkeypatch.setattr(server, 'get_stage_memo', lambda name: memo)
+    results = {f'http://arxiv.org/abs/2101.{i:05d}': dict(title=f'title {i}', summary='') for i in range(3)}
+    urls = list(results)
+    # a repeated question, rephrased: the ranking comes from the memo, cohere isn't called
+    memo.put(memo.make_key('what is rag?', sorted(urls), 2), [urls[2], urls[0]])
+
+    assert list(server.cohere_rerank('What is  RAG?', 2, results)) == [urls[2], urls[0]]
+    assert memo.hits == 1
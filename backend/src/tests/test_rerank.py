@@ -0,0 +1,49 @@
+import numpy as np
+
+from question_answer_pipeline.src import rerank
+
+ABSTRACTS = [
+    ('Graph neural networks', 'Message passing over molecules.'),
+    ('Dense retrieval', 'Dense passage retrieval for open domain question answering.'),
+    ('Protein folding', 'Attention for protein structure.'),
+    ('Retrieval augmented generation', 'Retrieval of passages improves generation, dense retrieval works best.'),
+]
+
+
+def arxiv_results():
+    return {f'http://arxiv.org/abs/2101.{i:05d}': dict(title=title, summary=summary)
+            for i, (title, summary) in enumerate(ABSTRACTS)}
+
+
+def test_local_rerank_orders_by_bm25():
+    results = arxiv_results()
+    urls = list(results)
+
+    # the short abstract with both terms twice beats the longer one with retrieval three times, dense once
+    ranked = rerank.local_rerank('dense retrieval', 2, results)
+    assert list(ranked) == [urls[1], urls[3]]
+    assert ranked[urls[1]] is results[urls[1]]
+    assert list(rerank.local_rerank('protein structure', 1, results)) == [urls[2]]
+
+
+def test_local_rerank_keeps_arxiv_order_for_ties():
+    results = arxiv_results()
+    assert list(rerank.local_rerank('quantum computing', 3, results)) == list(results)[:3]
+    assert rerank.local_rerank('dense retrieval', 2, {}) == {}
+
+
+def test_dense_rerank_mixes_in_abstract_similarity(monkeypatch):
+    results = arxiv_results()
+    urls = list(results)
+    embedded = []
+    # the abstract embeddings disagree with BM25 about the best paper
+    similarity = {'2101.00001': 0.0, '2101.00003': 1.0}
+
+    monkeypatch.setattr(rerank, 'embed_abstracts', lambda candidates: embedded.extend(candidates))
+    monkeypatch.setattr(rerank, 'dense_scores',
+                        lambda question, unique_ids: np.array([similarity.get(i, 0.0) for i in unique_ids]))
+
+    ranked = rerank.local_rerank('dense retrieval', 1, results, dense=True, dense_candidates=2, dense_weight=0.8)
+    assert list(ranked) == [urls[3]]
+    # only the BM25 candidates are embedded and re-scored
+    assert sorted(embedded) == [urls[1], urls[3]]
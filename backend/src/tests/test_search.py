@@ -0,0 +1,51 @@
+import asyncio
+
+from question_answer_pipeline.qa_utils.docs import Answer
+from server import app as server
+
+
+def arxiv_results(n):
+    return {f'http://arxiv.org/abs/2101.{i:05d}': dict(title=f'title {i}', summary=f'abstract {i}', key=f'k{i}',
+                                                       citation=f'c{i}', authors=[], published='', pdf_url='')
+            for i in range(n)}
+
+
+def test_two_stage_filters_every_arxiv_result_before_reranking(monkeypatch):
+    results = arxiv_results(30)
+    urls = list(results)
+    calls = {}
+
+    async def search_term_refiner(search_term):
+        return ['keyword']
+
+    def select_by_abstract(question, candidates):
+        calls['select_by_abstract'] = list(candidates)
+        # the two most similar abstracts rank last with the reranker
+        selected = {url: candidates[url] for url in urls[-2:]}
+        return selected, {url: 0.9 if url in selected else 0.1 for url in candidates}
+
+    def rerank(question, top_k, parsed_arxiv_results):
+        calls['rerank'] = list(parsed_arxiv_results)
+        return dict(list(parsed_arxiv_results.items())[:top_k])
+
+    async def download_relevant_documents_async(relevant_documents):
+        return {url: dict(error=None) for url in relevant_documents}
+
+    async def qa_pdf(question, k, parsed_arxiv_results, on_evidence=None, early_exit=None, keep_rank_order=True):
+        calls['qa_pdf'] = list(parsed_arxiv_results)
+        return {}, [Answer(question)]
+
+    monkeypatch.setattr(server, 'PIPELINE_MODE', 'two_stage')
+    monkeypatch.setattr(server, 'TOKEN_BUDGET', 0)
+    monkeypatch.setattr(server, 'search_term_refiner', search_term_refiner)
+    monkeypatch.setattr(server, 'fetch_arxiv_results', lambda keyword, max_results: results)
+    monkeypatch.setattr(server, 'select_by_abstract', select_by_abstract)
+    monkeypatch.setattr(server, 'rerank', rerank)
+    monkeypatch.setattr(server, 'download_relevant_documents_async', download_relevant_documents_async)
+    monkeypatch.setattr(server, 'qa_pdf', qa_pdf)
+
+    response = asyncio.run(server.run_search('question'))
+
+    assert calls['select_by_abstract'] == urls
+    assert calls['rerank'] == calls['qa_pdf'] == urls[-2:]
+    assert (response['pdf_selection']['candidates'], response['pdf_selection']['selected']) == (30, 2)
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+from langchain.llms.fake import FakeListLLM
+
+from question_answer_pipeline.qa_utils import docs as docs_module
+from question_answer_pipeline.qa_utils.docs import Answer, Docs
+from question_answer_pipeline.qa_utils.summarizer import SummaryExecutor
+
+
+class FakeChain:
+    """summary chain answering after a delay per chunk (page_content 'delay:answer'), counting calls in flight"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.started = []
+        self.cancelled = []
+
+    async def arun(self, question, context_str, citation):
+        delay, answer = context_str.split(':', 1)
+        self.started.append(citation)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(float(delay))
+        except asyncio.CancelledError:
+            self.cancelled.append(citation)
+            raise
+        finally:
+            self.in_flight -= 1
+        return answer
+
+
+def chunk(delay, answer, citation):
+    return Document(page_content=f'{delay}:{answer}', metadata=dict(citation=citation))
+
+
+@pytest.fixture
+def executor():
+    executor = SummaryExecutor(llm=FakeListLLM(responses=['unused']), max_concurrency=2, min_concurrency=1)
+    executor.chain = FakeChain()
+    return executor
+
+
+def test_executor_is_usable_from_successive_event_loops(executor):
+    docs = [chunk(0.01, f'summary {i}', f'c{i}') for i in range(5)]
+
+    for _ in range(2):
+        summaries, stats = asyncio.run(executor.summarize_all(docs, 'question'))
+        assert summaries == [f'summary {i}' for i in range(5)]
+        assert stats['calls'] == 5
+
+    assert executor.chain.max_in_flight == 2
+    assert executor.limiter.in_flight == 0
+
+
+@pytest.mark.parametrize('keep_rank_order, expected', [(True, ['c1', 'c3']), (False, ['c3', 'c1'])])
+def test_early_exit_cancels_outstanding_summaries(keep_rank_order, expected, executor, monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    monkeypatch.setattr(docs_module, 'get_summary_executor', lambda: executor)
+    executor.limiter.limit = executor.limiter.max_limit = 8
+    # chunk i is the i-th nearest to the question, the slow ones would hold up the answer without early exit
+    delays = [(1.0, 'relevant'), (0.05, 'relevant'), (0.01, 'Not applicable'), (0.02, 'relevant'),
+              (1.0, 'relevant'), (1.0, 'relevant')]
+    docs = Docs(name='test')
+    for i, (delay, summary) in enumerate(delays):
+        vector = np.zeros(4, dtype=np.float32)
+        vector[0], vector[1] = 1, i / 10
+        metadata = dict(dockey=f'c{i}', key=f'c{i}', citation=f'c{i}', unique_id=f'c{i}')
+        docs.add_from_embeddings(f'c{i}', [f'{delay}:{summary} {i}'], [vector], [metadata])
+    answer = Answer('question', question_embedding=[1, 0, 0, 0], from_embed=True)
+
+    start = time.perf_counter()
+    answer = asyncio.run(docs.get_evidence(answer, k=6, max_sources=2, marginal_relevance=False, early_exit=True,
+                                           keep_rank_order=keep_rank_order))
+
+    assert time.perf_counter() - start < 0.9
+    assert list(answer.contexts) == expected
+    assert sorted(executor.chain.cancelled) == ['c0', 'c4', 'c5']
+    assert answer.summary_stats['cancelled'] == 3
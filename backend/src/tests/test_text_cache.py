@@ -0,0 +1,93 @@
+import pytest
+
+from question_answer_pipeline.src import text_cache, utils
+from question_answer_pipeline.src.text_cache import PaperTextCache
+
+
+@pytest.fixture
+def extracted(monkeypatch):
+    """paths whose pages were extracted, by a fake extractor yielding three pages"""
+    extracted = []
+
+    def iter_pdf_pages(path):
+        extracted.append(path)
+        for i in range(3):
+            yield f'page {i} of {path[-14:]}. ' * 20
+
+    monkeypatch.setattr(text_cache.readers, 'iter_pdf_pages', iter_pdf_pages)
+    return extracted
+
+
+def pdf(directory, unique_id):
+    path = directory / f'{unique_id}.pdf'
+    path.write_bytes(f'%PDF {unique_id}'.encode())
+    return str(path)
+
+
+def test_pages_are_cached_in_memory_and_on_disk(tmp_path, extracted):
+    path = pdf(tmp_path, '2101.00001')
+    cache = PaperTextCache(maxsize=2, directory=str(tmp_path / 'cache'))
+
+    pages = list(cache.iter_pages(path))
+    assert len(pages) == 3
+    assert list(cache.iter_pages(path)) == pages
+    # a new process finds the disk copy
+    assert list(PaperTextCache(maxsize=2, directory=str(tmp_path / 'cache')).iter_pages(path)) == pages
+
+    assert extracted == [path]
+    assert (cache.stats()['misses'], cache.stats()['hits']) == (1, 1)
+
+
+def test_pages_are_streamed(tmp_path, extracted):
+    path = pdf(tmp_path, '2101.00001')
+    cache = PaperTextCache()
+
+    pages = cache.iter_pages(path)
+    assert extracted == []
+    next(pages)
+    assert extracted == [path]
+    # stopped after the first page, nothing is cached
+    pages.close()
+    assert cache.stats()['size'] == 0
+
+    splits, metadatas = cache.parse_pdf(path, 'citation', 'key', chunk_chars=100, overlap=10)
+    assert len(splits) == len(metadatas) > 3
+    assert cache.stats()['size'] == 1
+
+
+def test_least_recently_used_paper_is_evicted(tmp_path, extracted):
+    first, second, third = (pdf(tmp_path, f'2101.0000{i}') for i in range(3))
+    cache = PaperTextCache(maxsize=2)
+
+    for path in (first, second, first, third, first, second):
+        list(cache.iter_pages(path))
+
+    # second was evicted by third, the last use of first kept it
+    assert extracted == [first, second, third, second]
+
+
+def test_citation_lookup_extracts_only_the_first_chunk(tmp_path, monkeypatch):
+    pulled = []
+
+    def iter_pdf_pages(path):
+        for i in range(100):
+            pulled.append(i)
+            yield f'page {i} ' * 100  # ~700 characters
+
+    class CiteChain:
+        def __init__(self, prompt, llm):
+            pass
+
+        def run(self, text):
+            assert len(text) == 5000
+            return 'Lewis, Patrick, et al. "Retrieval-augmented generation." 2020.'
+
+    monkeypatch.setattr(text_cache.readers, 'iter_pdf_pages', iter_pdf_pages)
+    monkeypatch.setattr(utils, 'get_text_cache', lambda: PaperTextCache())
+    monkeypatch.setattr(utils, 'ChatOpenAI', lambda **kwargs: None)
+    monkeypatch.setattr(utils, 'LLMChain', CiteChain)
+    monkeypatch.setattr(utils, 'CITATIONS_FILE', str(tmp_path / 'citations.json'))
+
+    citations = utils.get_citations([pdf(tmp_path, '2101.00001')])
+    assert citations == {'2101.00001.pdf': 'Lewis, Patrick, et al. "Retrieval-augmented generation." 2020.'}
+    assert len(pulled) < 10
@@ -0,0 +1,92 @@
+from question_answer_pipeline.qa_utils.text_quality import junk_reason, drop_junk_chunks
+
+RELATED_WORK = (
+    "Retrieval-augmented generation was introduced by Lewis et al. (2020) and extended to open-domain question "
+    "answering by Izacard and Grave (2021). Dense retrievers such as DPR (Karpukhin et al., 2020) outperform BM25 "
+    "(Robertson and Zaragoza, 2009) on most benchmarks, although Thakur et al. (2021) show that the gap closes out "
+    "of domain. Later work on arXiv corpora (Cohan et al., 2020; Beltagy et al., 2019) and in the Proceedings of "
+    "ACL 2022 (Ram et al., 2022) studies in-context retrieval, while Borgeaud et al. (2022) and Guu et al. (2020) "
+    "scale retrieval to trillions of tokens. Shi et al. (2023) and Asai et al. (2023) propose self-reflective "
+    "variants, and Gao et al. (2023) survey the field. Our approach differs from these in that we summarize each "
+    "retrieved chunk before answering, similar to Chen et al. (2017) and Nakano et al. (2021)."
+)
+
+EQUATIONS = (
+    "Let x ∈ ℝ^d be the input and W ∈ ℝ^{d×k} the projection. We minimize\n"
+    "L(θ) = −(1/N) Σ_{i=1}^{N} log p_θ(y_i | x_i) + λ‖W‖_F^2,\n"
+    "where p_θ(y | x) = exp(w_y^T x) / Σ_{y'} exp(w_{y'}^T x). Taking the gradient gives\n"
+    "∇_W L = (1/N) Σ_i x_i (p_θ(·|x_i) − e_{y_i})^T + 2λW,\n"
+    "so for a step size η ≤ 1/β the iterates W_{t+1} = W_t − η ∇_W L(W_t) satisfy\n"
+    "L(W_T) − L(W*) ≤ ‖W_0 − W*‖^2 / (2ηT). If in addition L is μ-strongly convex, then\n"
+    "‖W_T − W*‖ ≤ (1 − ημ)^T ‖W_0 − W*‖, which is the rate we use in Theorem 2. The constant β is the "
+    "smoothness of the log-sum-exp term, β ≤ max_i ‖x_i‖^2."
+)
+
+EQUATIONS_DENSE = (
+    "By (3), for all t ≥ 0:\n"
+    "‖∇f(x_t)‖² ≤ 2β(f(x_t) − f*) ⇒ f(x_{t+1}) ≤ f(x_t) − (η/2)‖∇f(x_t)‖²\n"
+    "∑_{t=0}^{T−1} ‖∇f(x_t)‖² ≤ 2(f(x_0) − f*)/η ⇒ min_t ‖∇f(x_t)‖ ≤ √(2(f(x_0) − f*)/(ηT))\n"
+    "σ²_t = 𝔼[‖g_t − ∇f(x_t)‖²] ≤ σ² ⇒ 𝔼[f(x_T)] − f* ≤ ‖x_0 − x*‖²/(2ηT) + ησ²/2\n"
+    "with η = ‖x_0 − x*‖/(σ√T): 𝔼[f(x_T)] − f* ≤ σ‖x_0 − x*‖/√T. ∎\n"
+    "where the expectation is over the samples and the bound holds for any x* in the set of minimizers."
+)
+
+NUMBERED_BIBLIOGRAPHY = (
+    "[12] P. Lewis, E. Perez, A. Piktus, F. Petroni, V. Karpukhin, N. Goyal, H. Küttler, M. Lewis, W. Yih, "
+    "T. Rocktäschel, S. Riedel, and D. Kiela. Retrieval-augmented generation for knowledge-intensive NLP tasks. "
+    "In Advances in Neural Information Processing Systems, volume 33, pages 9459–9474, 2020.\n"
+    "[13] V. Karpukhin, B. Oguz, S. Min, P. Lewis, L. Wu, S. Edunov, D. Chen, and W. Yih. Dense passage retrieval "
+    "for open-domain question answering. In Proceedings of EMNLP 2020, pages 6769–6781, 2020.\n"
+    "[14] S. Robertson and H. Zaragoza. The probabilistic relevance framework: BM25 and beyond. Foundations and "
+    "Trends in Information Retrieval, 3(4):333–389, 2009.\n"
+    "[15] G. Izacard and E. Grave. Leveraging passage retrieval with generative models for open domain question "
+    "answering. In Proceedings of EACL 2021, pages 874–880, 2021. arXiv:2007.01282.\n"
+    "[16] I. Beltagy, K. Lo, and A. Cohan. SciBERT: A pretrained language model for scientific text. In "
+    "Proceedings of EMNLP-IJCNLP 2019, pages 3615–3620, 2019. doi:10.18653/v1/D19-1371."
+)
+
+AUTHOR_YEAR_BIBLIOGRAPHY = (
+    "Asai, A., Wu, Z., Wang, Y., Sil, A., and Hajishirzi, H. (2023). Self-RAG: Learning to retrieve, generate, "
+    "and critique through self-reflection. arXiv preprint arXiv:2310.11511.\n"
+    "Borgeaud, S., Mensch, A., Hoffmann, J., Cai, T., Rutherford, E., et al. (2022). Improving language models by "
+    "retrieving from trillions of tokens. In Proceedings of ICML 2022, pages 2206–2240.\n"
+    "Chen, D., Fisch, A., Weston, J., and Bordes, A. (2017). Reading Wikipedia to answer open-domain questions. "
+    "In Proceedings of ACL 2017, pages 1870–1879.\n"
+    "Cohan, A., Feldman, S., Beltagy, I., Downey, D., and Weld, D. S. (2020). SPECTER: Document-level "
+    "representation learning using citation-informed transformers. In Proceedings of ACL 2020.\n"
+    "Gao, Y., Xiong, Y., Gao, X., Jia, K., Pan, J., et al. (2023). Retrieval-augmented generation for large "
+    "language models: A survey. arXiv preprint arXiv:2312.10997."
+)
+
+REPEATED = "mmmm nnnn mmmm nnnn " * 20
+
+GARBLED = "(cid:12)(cid:34)(cid:3)(cid:90) ÿþ ¤¥¦ §¨© ª«¬ ®¯° ±²³ ´µ¶ ·¸¹ º»¼ ½¾¿ " * 8
+
+
+def test_citation_dense_prose_is_kept():
+    assert junk_reason(RELATED_WORK) is None
+
+
+def test_equation_heavy_paragraphs_are_kept():
+    assert junk_reason(EQUATIONS) is None
+    assert junk_reason(EQUATIONS_DENSE) is None
+
+
+def test_bibliographies_are_dropped():
+    assert junk_reason(NUMBERED_BIBLIOGRAPHY) == 'references'
+    assert junk_reason(AUTHOR_YEAR_BIBLIOGRAPHY) == 'references'
+
+
+def test_failed_extraction_is_dropped_with_its_reason():
+    assert junk_reason(GARBLED) == 'garbled'
+    assert junk_reason(REPEATED) == 'low_entropy'
+    assert junk_reason('') == 'empty'
+
+
+def test_drop_junk_chunks():
+    splits = [RELATED_WORK, NUMBERED_BIBLIOGRAPHY, EQUATIONS_DENSE, GARBLED]
+    metadatas = [dict(key=i) for i in range(len(splits))]
+    kept_splits, kept_metadatas, dropped = drop_junk_chunks(splits, metadatas)
+    assert kept_splits == [RELATED_WORK, EQUATIONS_DENSE]
+    assert kept_metadatas == [dict(key=0), dict(key=2)]
+    assert dropped == {'references': 1, 'garbled': 1}
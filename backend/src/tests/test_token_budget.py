@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from question_answer_pipeline.src import token_budget, utils
+from question_answer_pipeline.src.embedding_store import EmbeddingStore
+from question_answer_pipeline.src.token_budget import TokenCounter
+
+
+class WordEncoding:
+    """stands in for tiktoken (whose encodings are downloaded on first use): one token per word"""
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts, num_threads=1):
+        return [self.encode_ordinary(text) for text in texts]
+
+
+@pytest.fixture
+def counter(monkeypatch):
+    counter = TokenCounter(encoding=WordEncoding())
+    monkeypatch.setattr(token_budget, 'get_token_counter', lambda: counter)
+    return counter
+
+
+@pytest.fixture
+def paper_store(tmp_path, monkeypatch):
+    store = EmbeddingStore(str(tmp_path))
+    # chunk i points along axis i, the question along axis 0 then 1 then 2
+    texts = ['alpha ' * 10, 'beta ' * 30, 'gamma ' * 5, 'delta ' * 5]
+    store.add('2101.00001', texts, np.eye(4, dtype=np.float32), [dict(key=f'Key{i}') for i in range(4)],
+              # INSTRUCTOR counts, including the instruction: not what the chat model is sent
+              [1000] * 4)
+    monkeypatch.setattr(utils, 'get_embedding_store', lambda directory: store)
+    monkeypatch.setattr(utils, 'embed_questions', lambda questions, use_modal: [np.array([1, 0.9, 0.8, 0.1])])
+    monkeypatch.setenv('MODAL', 'false')
+    return store
+
+
+def test_chat_context_is_budgeted_in_tokenizer_counts(counter, paper_store):
+    context, used = utils.select_chat_context('question', '2101.00001', token_budget=20)
+
+    # alpha (11 tokens with its key) and gamma (6) fit, beta (31) doesn't, delta would go over
+    assert context == f"[Key0] {'alpha ' * 10}\n\n[Key2] {'gamma ' * 5}"
+    assert used == 17
+
+
+def test_chat_context_of_a_paper_without_embeddings(counter, paper_store):
+    assert utils.select_chat_context('question', '2101.99999') == (None, 0)
+
+
+def test_counts_are_cached_with_lru_eviction():
+    counter = TokenCounter(encoding=WordEncoding(), maxsize=2)
+    assert counter.count_many(['a b', 'c', 'a b']) == [2, 1, 2]
+    assert (counter.hits, counter.misses) == (0, 2)
+    assert counter.count('a b') == 2  # a b is now the most recently used
+    counter.count('d e f')
+
+    assert counter.stats()['size'] == 2
+    counter.count('c')
+    assert (counter.hits, counter.misses) == (1, 4)
+
+
+def test_plan_drops_the_lowest_ranked_papers_over_budget(counter, monkeypatch):
+    documents = {f'http://arxiv.org/abs/2101.{i:05d}': dict(citation=f'c{i}', key=f'k{i}') for i in range(3)}
+    urls = list(documents)
+    chunks = {urls[0]: (['word ' * 50] * 4, True), urls[1]: (['word ' * 80] * 2, False), urls[2]: (None, True)}
+    monkeypatch.setattr(token_budget, 'paper_chunks', lambda relevant_documents: chunks)
+    question_tokens = counter.count('what is rag?')
+    papers = [dict(chunks=4, tokens=200, new=True), dict(chunks=2, tokens=160, new=False)]
+    two_papers = token_budget.estimate_tokens(question_tokens, papers, counter=counter)
+
+    kept, plan = token_budget.plan_token_budget('what is rag?', documents, budget=two_papers['total'])
+    # the unparsable pdf adds nothing to the estimate, so it still fits
+    assert list(kept) == urls
+    assert plan['papers'][urls[2]] == dict(chunks=0, tokens=0, new=False)
+
+    kept, plan = token_budget.plan_token_budget('what is rag?', documents, budget=two_papers['total'] - 1)
+    assert list(kept) == urls[:1]
+    assert plan['dropped'] == urls[1:]
+    assert plan['estimate'] == token_budget.estimate_tokens(question_tokens, papers[:1], counter=counter)
+    assert plan['estimate']['embedding'] == 200
+
+    # the best paper is kept whatever the budget
+    kept, plan = token_budget.plan_token_budget('what is rag?', documents, budget=0)
+    assert list(kept) == urls[:1]